@@ -12,8 +12,11 @@ def main():
     usage = "usage: %prog [options] PATH"
     parser = OptionParser(usage=usage, 
                           description="Archive a file to remote storage.")
-    parser.add_option('-t', '--threshold', type="int", dest="threshold", default=4194304000, help='Filesize at which we switch to multipart upload.')
-    parser.add_option('-c', '--chunksize', type="int", dest="chunksize", default=4194304000, help='The size to break multipart uploads into.')
+    parser.add_option('-t', '--threshold', type="int", dest="threshold", default=backup.MULTIPART_THRESHOLD, help='Filesize at which we switch to multipart upload.')
+    parser.add_option('-c', '--chunksize', type="int", dest="chunksize", default=None, help='The size to break multipart uploads into. Sized from file size and throughput if unset.')
+    parser.add_option('-w', '--workers', type="int", dest="workers", default=backup.UPLOAD_WORKERS, help='Number of multipart upload parts sent concurrently.')
+    parser.add_option('-r', '--resume', dest="resume", action="store_true", default=False, help='Resume an interrupted multipart upload, skipping parts already uploaded.')
+    parser.add_option('-s', '--sha256', dest="sha256", action="store_true", default=False, help='Record the SHA-256 of each part in PATH.sha256.')
     (options, args) = parser.parse_args()
     for arg in args:
         if os.path.isfile(arg):
@@ -21,7 +24,9 @@ def main():
             filename = os.path.basename(path)
             log.info('Moving archive to external storage.')
             try:
-                backup.Archive(path, options.threshold, options.chunksize).submit()
+                backup.Archive(path, options.threshold, options.chunksize,
+                               options.workers, options.resume,
+                               options.sha256).submit()
             except:
                 log.exception('Upload to remote storage unsuccessful.')
                 raise
@@ -34,4 +39,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
@@ -3,9 +3,14 @@ import hashlib
 import httplib
 import json
 import os
+import Queue
+import shutil
 import string
 import sys
+import tarfile
 import tempfile
+import threading
+import time
 
 from configobj import ConfigObj
 from fabric.api import *
@@ -13,10 +18,39 @@ from fabric.api import *
 import pantheon
 import logger
 import ygg
+import compression
+import dbtools
+import fileindex
 import rangeable_file
+import runner
 from vars import *
 
 ARCHIVE_SERVER = "s3.amazonaws.com"
+# Size of the parts a streamed backup is cut into while it is uploaded.
+STREAM_CHUNK_SIZE = 104857600
+# Number of multipart upload parts in flight at once.
+UPLOAD_WORKERS = 4
+# Attempts per part, and the initial delay (seconds) between them.
+UPLOAD_RETRIES = 5
+UPLOAD_BACKOFF = 2
+# File size above which archives are uploaded in parts.
+MULTIPART_THRESHOLD = 4194304000
+# Largest part read into memory (once per worker) for single-pass hashing.
+PART_BUFFER_LIMIT = 134217728
+# Content index of the last incremental backup of each project.
+BACKUP_STATE_DIR = '/var/lib/pantheon/backup'
+# Incremental backups made on top of one full backup before starting anew.
+INCREMENTAL_CHAIN_LIMIT = 7
+# backup_version of the deduplicated layout: project/blobs/<hash> holds each
+# distinct file once, project/<component>.manifest maps paths to blobs.
+# Later versions record it as 'dedup' in the config.
+DEDUP_BACKUP_VERSION = 1
+# backup_version of the database layout: env/database.sql<suffix> compressed
+# with the archive codec, or env/database/<table>.sql<suffix> per table,
+# instead of an uncompressed env/database.sql.
+DUMP_BACKUP_VERSION = 2
+# Latest backup_version written; restores refuse newer ones.
+BACKUP_VERSION = DUMP_BACKUP_VERSION
 
 def remove(archive):
     """Remove a backup tarball from the server.
@@ -28,7 +62,7 @@ def remove(archive):
         server = pantheon.PantheonServer()
         path = os.path.join(server.ftproot, archive)
         if os.path.exists(path):
-            local('rm -f %s' % path)
+            runner.remove(path)
     except:
         log.exception('Removal of local backup archive was unsuccessful.')
         raise
@@ -37,21 +71,56 @@ def remove(archive):
 
 class PantheonBackup():
 
-    def __init__(self, name, project):
+    def __init__(self, name, project, resume=False, codec=None, level=None,
+                 incremental=False, dedup=False):
         """Initialize Backup Object.
-        name: name of backup (resulting file: name.tar.gz)
+        name: name of backup (resulting file: name.tar.gz, or the extension
+              of the codec used)
         project: name of project to backup.
+        resume: bool. Keep the archive after a failed upload, and resume
+                uploading an archive left by an earlier run.
+        codec: archive compression (gzip/zstd/none). Default is gzip.
+        level: compression level. None gives the codec default.
+        incremental: bool. Only archive files and tables changed since the
+                     previous incremental backup of the project. Without a
+                     previous one (or once the chain is INCREMENTAL_CHAIN_LIMIT
+                     long) a full backup is made, which later ones build on.
+        dedup: bool. Store identical files of the environments and the repo
+               once (see DEDUP_BACKUP_VERSION). Not combined with incremental.
 
         """
         self.server = pantheon.PantheonServer()
         self.project =  project
         self.environments = pantheon.get_environments()
-        self.working_dir = tempfile.mkdtemp()
+        self.resume = resume
+        if resume:
+            # A fixed working dir lets a later run find an interrupted upload.
+            self.working_dir = os.path.join(tempfile.gettempdir(),
+                                            'backup_%s' % name)
+            runner.mkdir(self.working_dir)
+        else:
+            self.working_dir = tempfile.mkdtemp()
         self.backup_dir = os.path.join(self.working_dir, self.project)
-        self.name = name + '.tar.gz'
+        self.codec = compression.get_codec(codec)
+        self.level = compression.get_level(self.codec, level)
+        self.name = '%s.%s' % (name, compression.get_extension(self.codec))
         self.log = logger.logging.getLogger('pantheon.backup.PantheonBackup')
         self.log = logger.logging.LoggerAdapter(self.log,
                                                 {"project": project})
+        self.dedup = dedup
+        self._table_sizes = dict()
+        self._disposable_tables = None
+        self.incremental = incremental and not dedup
+        self.is_delta = False
+        if self.incremental:
+            self.state_path = os.path.join(BACKUP_STATE_DIR,
+                                           '%s.json' % project)
+            self._previous = self._load_state()
+            chain = self._previous['chain']
+            self.is_delta = 0 < len(chain) <= INCREMENTAL_CHAIN_LIMIT
+            self._state = {'chain': chain + [name] if self.is_delta else [name],
+                           'files': dict(),
+                           'tables': dict()}
 
     def get_dev_code(self, user):
         """USED FOR REMOTE DEV: Clone of dev git repo.
@@ -60,7 +129,7 @@ class PantheonBackup():
         self.log.info('Initialized archive of code.')
         try:
             server_name = _get_server_name(self.project)
-            local('mkdir -p %s' % self.backup_dir)
+            runner.mkdir(self.backup_dir)
             source = os.path.join(self.server.webroot, self.project, 'dev')
             destination = 'code'
             with cd(self.backup_dir):
@@ -84,7 +153,7 @@ class PantheonBackup():
         """
         self.log.info('Initialized archive of files.')
         try:
-            local('mkdir -p %s' % self.backup_dir)
+            runner.mkdir(self.backup_dir)
             source = os.path.join(self.server.webroot, self.project,
                                           'dev/sites/default/files')
             destination = self.backup_dir
@@ -108,7 +177,7 @@ class PantheonBackup():
         """
         self.log.info('Initialized archive of data.')
         try:
-            local('mkdir -p %s' % self.backup_dir)
+            runner.mkdir(self.backup_dir)
             drupal_vars = pantheon.parse_vhost(self.server.get_vhost_file(
                                                      self.project, 'dev'))
             destination = os.path.join(self.backup_dir, 'dev_database.sql')
@@ -127,7 +196,7 @@ class PantheonBackup():
         self.log.info('Initialized archive of drush.')
         try:
             server_name = _get_server_name(self.project)
-            local('mkdir -p %s' % self.backup_dir)
+            runner.mkdir(self.backup_dir)
             # Build the environment specific aliases
             env_aliases = ''
             template = string.Template(_get_env_alias())
@@ -151,8 +220,9 @@ class PantheonBackup():
         else:
             self.log.info('Archive of drush successful.')
 
-    def free_space(self):
+    def free_space(self, stream=False):
         """Returns bool. True if free space is greater then backup size.
+        stream: bool. If True, size for a streamed backup (see stream_backup).
 
         """
         #Get the total free space
@@ -164,12 +234,15 @@ class PantheonBackup():
         result = local('du -slc {0}'.format(' '.join(paths)))
         ns = int(result[result.rfind('\n')+1:result.rfind('\t')])
         #Calc the database size of each env
+        db_sizes = list()
         for env in self.environments:
-            result = local('mysql --execute=\'SELECT IFNULL(ROUND((' \
-                'sum(DATA_LENGTH) + sum(INDEX_LENGTH) - sum(DATA_FREE))' \
-                '/1024), 0) AS Size FROM INFORMATION_SCHEMA.TABLES where ' \
-                'TABLE_SCHEMA =  "{0}_{1}"\G\''.format(self.project, env))
-            ns += int(result[result.rfind(' ')+1:])
+            sizes = self._get_table_sizes('%s_%s' % (self.project, env))
+            db_sizes.append(sum(sizes.values()) / 1024)
+        if stream:
+            # Only one database dump and the parts in flight are ever staged.
+            parts = 2 * UPLOAD_WORKERS + 1
+            return fs > (max(db_sizes) + parts * STREAM_CHUNK_SIZE / 1024)
+        ns += sum(db_sizes)
         #Double needed space to account for tarball
         return fs > (ns*2)
 
@@ -179,27 +252,55 @@ class PantheonBackup():
         """
         self.log.info('Initialized backup of files.')
         try:
-            local('mkdir -p %s' % self.backup_dir)
+            runner.mkdir(self.backup_dir)
             for env in self.environments:
                 source = os.path.join(self.server.webroot, self.project, env)
-                local('rsync -avz %s %s' % (source, self.backup_dir))
+                if self.dedup:
+                    self._backup_blobs(source, env)
+                elif self.incremental:
+                    self._backup_changed(source, env)
+                else:
+                    local('rsync -avz %s %s' % (source, self.backup_dir))
         except:
             self.log.exception('Backing up the files was unsuccessful.')
             raise
         else:
             self.log.info('Backup of files successful.')
 
-    def backup_data(self):
+    def backup_data(self, per_table=False, workers=dbtools.DUMP_WORKERS):
         """Backup databases for environments of a project.
+        per_table: bool. Dump each table to its own file (env/database/), so
+                   they can be restored in parallel.
+        workers: number of dumps run at once. The dumps are compressed with
+                 the archive codec as they are written.
 
         """
         self.log.info('Initialized backup of data.')
         try:
+            dumper = dbtools.DatabaseDumper(workers, self.codec, self.level)
+            # (dump, tables) of increments that record dropped tables.
+            drops = list()
             for env in self.environments:
                 drupal_vars = pantheon.parse_vhost(self.server.get_vhost_file(
                                                    self.project, env))
+                runner.mkdir(os.path.join(self.backup_dir, env))
                 dest = os.path.join(self.backup_dir, env, 'database.sql')
-                self._dump_data(dest, drupal_vars)
+                if self.incremental:
+                    drops.extend(self._backup_changed_tables(dumper, dest,
+                                                             drupal_vars, env))
+                elif per_table:
+                    dumper.add(drupal_vars,
+                               os.path.join(self.backup_dir, env, 'database'),
+                               True,
+                               self._get_table_sizes(drupal_vars['db_name']),
+                               self._get_schema_only(drupal_vars['db_name']))
+                else:
+                    dumper.add(drupal_vars, dest, False,
+                               self._get_table_sizes(drupal_vars['db_name']),
+                               self._get_schema_only(drupal_vars['db_name']))
+            dumper.run()
+            for dump, tables in drops:
+                self._append_drops(dump, tables)
         except:
             self.log.exception('Backing up the data was unsuccessful.')
             raise
@@ -213,7 +314,14 @@ class PantheonBackup():
         self.log.info('Initialized backup of repo.')
         try:
             dest = os.path.join(self.backup_dir, '%s.git' % (self.project))
-            local('rsync -avz /var/git/projects/%s/ %s' % (self.project, dest))
+            source = os.path.join('/var/git/projects', self.project)
+            if self.dedup:
+                self._backup_blobs(source, '%s.git' % self.project)
+            elif self.incremental:
+                self._backup_changed(source, '%s.git' % self.project)
+            else:
+                local('rsync -avz /var/git/projects/%s/ %s' % (self.project,
+                                                                dest))
         except:
             self.log.exception('Backing up the repo was unsuccessful.')
             raise
@@ -230,8 +338,18 @@ class PantheonBackup():
         try:
             config_file = os.path.join(self.backup_dir, 'pantheon.backup')
             config = ConfigObj(config_file)
+            # Databases are always dumped in the DUMP_BACKUP_VERSION layout.
+            version = max(int(version), DUMP_BACKUP_VERSION)
             config['backup_version'] = version
+            if self.dedup:
+                config['dedup'] = True
             config['project'] = self.project
+            config['compression'] = self.codec
+            if self.level is not None:
+                config['compression_level'] = self.level
+            if self.incremental:
+                # Names of the full backup and the increments, up to this one.
+                config['incremental'] = {'chain': self._state['chain']}
             config.write()
         except:
             self.log.exception('Backing up the config was unsuccessful.')
@@ -239,50 +357,111 @@ class PantheonBackup():
         else:
             self.log.info('Backup of config successful.')
 
+    def is_resumable(self):
+        """Returns bool. True if an earlier run left a partial upload.
+
+        """
+        path = os.path.join(self.working_dir, self.name)
+        return self.resume and os.path.isfile('%s.manifest' % path)
+
     def finalize(self, destination=None):
         """ Create archive, move to destination, remove working dir.
 
         """
+        uploaded = False
         try:
-            self.make_archive()
-            self.move_archive()
+            if not self.is_resumable():
+                self.make_archive()
+                if self.incremental:
+                    self._stage_state()
+            uploaded = self.move_archive(self.resume)
+            if uploaded and self.incremental:
+                self._promote_state()
         except:
             self.log.error('Failure creating/storing backup.')
 
-        self.cleanup()
+        # Keep the archive and its upload manifest for the next run.
+        if uploaded or not self.resume:
+            self.cleanup()
+
+    def stream_backup(self, version):
+        """Stream environments, data and repo directly to remote storage.
+
+        Webroots, the database dumps and the central repo are written into a
+        single compressed tar stream that is cut into multipart upload parts as it is
+        produced. Only the backup config, one compressed database dump and the
+        parts in flight are ever staged on disk.
+        version: int. Backup schema version (see backup_config()).
+
+        """
+        self.log.info('Initialized streaming backup.')
+        try:
+            runner.mkdir(self.backup_dir)
+            self.backup_config(version)
+            archive = ArchiveStream(self.name)
+            compressed = compression.Compressor(archive, self.codec,
+                                                self.level)
+            tar = tarfile.open(mode='w|', fileobj=compressed)
+            try:
+                for env in self.environments:
+                    self._stream_environment(tar, env)
+                tar.add(os.path.join('/var/git/projects', self.project),
+                        arcname=os.path.join(self.project,
+                                             '%s.git' % self.project))
+                tar.add(os.path.join(self.backup_dir, 'pantheon.backup'),
+                        arcname=os.path.join(self.project, 'pantheon.backup'))
+                tar.close()
+                compressed.close()
+            except:
+                compressed.abort()
+                archive.abort()
+                raise
+            archive.close()
+        except:
+            self.log.exception('Streaming backup was unsuccessful.')
+            raise
+        else:
+            self.log.info('Upload %s to remote storage complete.' % self.name)
+        finally:
+            self.cleanup()
 
     def make_archive(self):
-        """Tar/gzip the files to be backed up.
+        """Tar and compress the files to be backed up.
 
         """
-        self.log.info('Making archive.')
+        self.log.info('Making %s archive.' % self.codec)
         try:
             with cd(self.working_dir):
-                local('tar czf %s %s' % (self.name, self.project))
+                local(compression.archive_command(self.name, self.project,
+                                                  self.codec, self.level))
         except:
             self.log.exception('Making of the archive was unsuccessful.')
             raise
         else:
             self.log.info('Make archive successful.')
 
-    def move_archive(self):
+    def move_archive(self, resume=False):
         """Move archive from temporary working dir to S3.
+        resume: bool. Skip parts acknowledged by an earlier upload attempt.
+        returns: bool. True if the upload completed.
 
         """
         self.log.info('Moving archive to external storage.')
         path = '%s/%s' % (self.working_dir, self.name)
         try:
-            Archive(path).submit()
+            Archive(path, resume=resume).submit()
         except:
             self.log.exception('Upload to remote storage unsuccessful.')
+            return False
         else:
             self.log.info('Upload %s to remote storage complete.' % self.name)
+            return True
 
     def cleanup(self):
         """ Remove working_dir """
         self.log.debug('Cleaning up.')
         try:
-            local('rm -rf %s' % self.working_dir)
+            runner.remove(self.working_dir)
         except:
             self.log.exception('Cleanup unsuccessful.')
             raise
@@ -290,90 +469,567 @@ class PantheonBackup():
             self.log.debug('Cleanup successful.')
 
 
+    def _stream_environment(self, tar, env):
+        """Add an environment webroot and its database dump to a tar stream.
+        tar: tarfile object opened in stream mode.
+        env: environment name.
+
+        """
+        arcname = os.path.join(self.project, env)
+        tar.add(os.path.join(self.server.webroot, self.project, env),
+                arcname=arcname)
+        drupal_vars = pantheon.parse_vhost(self.server.get_vhost_file(
+                                           self.project, env))
+        database = drupal_vars['db_name']
+        # A tar member needs its size before its data, so mysqldump cannot
+        # be piped into the stream. The dump is spooled through the archive
+        # codec instead, which keeps it at its compressed size on disk.
+        dumper = dbtools.DatabaseDumper(1, self.codec, self.level)
+        dump = dumper.add(drupal_vars,
+                          os.path.join(self.backup_dir, '%s.sql' % env), False,
+                          self._get_table_sizes(database),
+                          self._get_schema_only(database))[0]
+        try:
+            dumper.run()
+            tar.add(dump, arcname=os.path.join(arcname, 'database.sql%s' %
+                                               compression.get_suffix(
+                                                               self.codec)))
+        finally:
+            if os.path.exists(dump):
+                os.remove(dump)
+
+    def _backup_changed(self, source, component):
+        """Copy a tree into the backup, or only what changed since the last.
+        source: directory to back up.
+        component: name of the copy in backup_dir (env name or repo).
+
+        Files removed since the previous backup are listed, one per line, in
+        backup_dir/<component>.deleted.
+
+        """
+        previous = fileindex.FileIndex(
+                            self._previous['files'].get(component))
+        index = fileindex.build(source, previous)
+        self._state['files'][component] = index.entries
+        destination = os.path.join(self.backup_dir, component)
+        if not self.is_delta:
+            local('rsync -avz %s/ %s/' % (source, destination))
+            return
+        changed, removed = index.diff(previous)
+        self.log.info('%s: %d changed, %d removed files.' % (component,
+                                                              len(changed),
+                                                              len(removed)))
+        if changed:
+            files_from = os.path.join(self.working_dir,
+                                      '%s.changed' % component)
+            with open(files_from, 'w') as f:
+                f.write('\n'.join(changed) + '\n')
+            runner.mkdir(destination)
+            local('rsync -a --files-from=%s %s/ %s/' % (files_from, source,
+                                                        destination))
+            os.remove(files_from)
+        if removed:
+            with open(os.path.join(self.backup_dir,
+                                   '%s.deleted' % component), 'w') as f:
+                f.write('\n'.join(removed) + '\n')
+
+    def _backup_blobs(self, source, component):
+        """Add a tree to the deduplicated layout.
+        source: directory to back up.
+        component: name of the tree in the backup (env name or repo).
+
+        Files are stored in backup_dir/blobs by content hash, unless an
+        identical file (from any component) is already there. The paths,
+        modes and mtimes are written to backup_dir/<component>.manifest.
+
+        """
+        index = fileindex.build(source)
+        blobs = os.path.join(self.backup_dir, 'blobs')
+        manifest = {'dirs': dict(), 'files': dict()}
+        stored = 0
+        for dirpath, dirnames, filenames in os.walk(source):
+            for name in dirnames:
+                fullpath = os.path.join(dirpath, name)
+                if not os.path.islink(fullpath):
+                    manifest['dirs'][os.path.relpath(fullpath, source)] = \
+                                    os.lstat(fullpath).st_mode & 07777
+        for path, (size, mtime, inode, digest) in index.entries.iteritems():
+            mode = os.lstat(os.path.join(source, path)).st_mode & 07777
+            manifest['files'][path] = [digest, mode, mtime]
+            if digest.startswith('link:'):
+                continue
+            blob = os.path.join(blobs, digest[:2], digest)
+            if not os.path.exists(blob):
+                if not os.path.isdir(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                shutil.copyfile(os.path.join(source, path), blob)
+                stored += 1
+        with open(os.path.join(self.backup_dir,
+                               '%s.manifest' % component), 'w') as f:
+            json.dump(manifest, f)
+        self.log.info('%s: %d files, %d new blobs.' % (component, len(index),
+                                                        stored))
+
+    def _backup_changed_tables(self, dumper, destination, db_dict, env):
+        """Schedule the dump of a database, or only of the tables changed
+        since the last backup.
+        dumper: dbtools.DatabaseDumper the dump is added to.
+        destination: Full path to dump file, without the codec suffix.
+        db_dict: see _dump_data().
+        env: environment name.
+        Returns a list of (dump, tables) for _append_drops(), once the dumper
+        has run.
+
+        In an increment, tables dropped since the previous backup get a
+        DROP TABLE statement at the end of the dump, so applying it on top of
+        the previous dump gives the current database.
+
+        """
+        database = db_dict.get('db_name')
+        checksums = _table_checksums(database)
+        self._state['tables'][env] = checksums
+        sizes = self._get_table_sizes(database)
+        schema_only = self._get_schema_only(database)
+        if not self.is_delta:
+            dumper.add(db_dict, destination, False, sizes, schema_only)
+            return list()
+        previous = self._previous['tables'].get(env, dict())
+        changed = [table for table, checksum in checksums.iteritems()
+                   if checksum is None or previous.get(table) != checksum]
+        dropped = [table for table in previous if table not in checksums]
+        self.log.info('%s: %d changed, %d dropped tables.' % (env,
+                                                               len(changed),
+                                                               len(dropped)))
+        dumper.add(db_dict, destination, False, sizes, schema_only, changed)
+        if not dropped:
+            return list()
+        return [('%s%s' % (destination, compression.get_suffix(self.codec)),
+                 sorted(dropped))]
+
+    def _append_drops(self, dump, tables):
+        """Append DROP TABLE statements to a dump, compressed with the
+        archive codec. Compressed streams can be concatenated, so the dump
+        still decompresses as one.
+        dump: path of the dump (created if missing).
+        tables: tables to drop.
+
+        """
+        with open(dump, 'ab') as f:
+            compressed = compression.Compressor(f, self.codec, self.level)
+            compressed.write(''.join('DROP TABLE IF EXISTS `%s`;\n' % table
+                                     for table in tables))
+            compressed.close()
+
+    def _get_table_sizes(self, database):
+        """Return (and remember) the table sizes of a database.
+
+        """
+        if database not in self._table_sizes:
+            self._table_sizes[database] = dbtools.get_table_sizes(database)
+        return self._table_sizes[database]
+
+    def _get_schema_only(self, database):
+        """Return the tables of a database to dump without their rows.
+
+        """
+        if self._disposable_tables is None:
+            config = ygg.get_config()
+            self._disposable_tables = dbtools.get_disposable_tables(
+                                                    config.get(self.project))
+        return dbtools.match_tables(self._get_table_sizes(database),
+                                    self._disposable_tables)
+
+    def _load_state(self):
+        """Return the index saved by the last incremental backup.
+
+        """
+        if os.path.isfile(self.state_path):
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        return {'chain': list(), 'files': dict(), 'tables': dict()}
+
+    def _save_state(self):
+        """Save the index of this backup for the next incremental one.
+
+        """
+        runner.mkdir(BACKUP_STATE_DIR)
+        tmp = '%s.tmp' % self.state_path
+        with open(tmp, 'w') as f:
+            json.dump(self._state, f)
+        os.rename(tmp, self.state_path)
+
+    def _stage_state(self):
+        """Save the index of this backup next to its archive, so a resumed
+        upload (which does not index anything) can still record it.
+
+        """
+        path = os.path.join(self.working_dir, '%s.state' % self.name)
+        with open(path, 'w') as f:
+            json.dump(self._state, f)
+
+    def _promote_state(self):
+        """Record the staged index of the uploaded archive for the next
+        incremental backup. Without one the saved index is dropped, so the
+        next backup is a full one.
+
+        """
+        path = os.path.join(self.working_dir, '%s.state' % self.name)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self._state = json.load(f)
+            self._save_state()
+        else:
+            self.log.warning('No index staged with the archive; the next '
+                             'backup will be a full one.')
+            runner.remove(self.state_path)
+
     def _dump_data(self, destination, db_dict):
         """Dump a database to a .sql file.
         destination: Full path to dump file.
         db_dict: db_username
                  db_password
                  db_name
+        Disposable tables (see dbtools.DISPOSABLE_TABLES) are dumped without
+        their rows.
 
         """
-        result = local("mysqldump --single-transaction \
-                                  --user='%s' --password='%s' %s > %s" % (
-                                         db_dict.get('db_username'),
-                                         db_dict.get('db_password'),
-                                         db_dict.get('db_name'),
-                                         destination))
+        database = db_dict.get('db_name')
+        result = local('%s > %s' % (dbtools.dump_command(database, None,
+                                            self._get_schema_only(database),
+                                            db_dict.get('db_username'),
+                                            db_dict.get('db_password')),
+                                    destination))
         if result.failed:
             abort("Export of database '%s' failed." % db_dict.get('db_name'))
 
 class Archive():
-    def __init__(self, path, threshold=4194304000, chunk_size=4194304000):
+    def __init__(self, path, threshold=MULTIPART_THRESHOLD, chunk_size=None,
+                 workers=UPLOAD_WORKERS, resume=False, sha256=False):
         """Initiates an archivable file object
 
         Keyword arguements:
         path       -- the path to the file
         threshold  -- filesize at which we switch to multipart upload
-        chunk_size -- the size to break multipart uploads into
+        chunk_size -- the size to break multipart uploads into. If None,
+                      parts are sized from the file size and measured
+                      throughput (see rangeable_file.AdaptivePartSize)
+        workers    -- number of multipart upload parts sent concurrently
+        resume     -- continue the multipart upload recorded in the manifest
+                      (path.manifest), skipping parts already acknowledged
+        sha256     -- also compute SHA-256 of every part, recorded in the
+                      manifest and in path.sha256 once the upload completes
 
         """
-        self.connection = httplib.HTTPSConnection(
-                                                  API_HOST,
-                                                  API_PORT,
-                                                  key_file = VM_CERTIFICATE,
-                                                  cert_file = VM_CERTIFICATE)
         self.path = path
         self.filesize = os.path.getsize(path)
         self.threshold = threshold
-        self.filename = os.path.basename(path)
-        self.partno = 0
-        self.parts = []
-        self.chunk_size = chunk_size
+        self.resume = resume
         self.log = logger.logging.getLogger('pantheon.backup.Archive')
+        self._init_upload(os.path.basename(path), chunk_size, workers, sha256)
+        self.manifest_path = '%s.manifest' % path
+        if chunk_size is None:
+            self.part_size = rangeable_file.AdaptivePartSize(self.filesize)
 
     def is_multipart(self):
         # Amazon S3 has a minimum upload size of 5242880
         assert self.filesize >= 5242880,"File size is too small."
-        assert self.chunk_size >= 5242880,"Chunk size is too small."
+        assert self.chunk_size is None or self.chunk_size >= 5242880, \
+               "Chunk size is too small."
         return True if self.filesize > self.threshold else False
 
     def submit(self):
         if self.filesize < self.threshold:
             # Amazon S3 has a maximum upload size of 5242880000
             assert self.threshold < 5242880000,"Threshold is too large."
-            fo = open(self.path)
-            info = json.loads(self._get_upload_header(fo))
-            response = self._arch_request(fo, info)
+            mapped = rangeable_file.MappedFile(self.path)
+            try:
+                data, part_hash, sha256 = self._read_part(
+                                          mapped.range((0, self.filesize)))
+                info = json.loads(self._get_upload_header(part_hash))
+                self._arch_request(data, info)
+            finally:
+                mapped.close()
             self._complete_upload()
         elif self.is_multipart():
             self.log.info('Large backup detected. Using multipart upload ' \
                           'method.')
-            #TODO: Use boto to get upid after next release
-            #self.upid = json.loads(self._initiate_multipart_upload())
-            info = json.loads(self._initiate_multipart_upload())
-            response = self._arch_request(None, info)
-            from xml.etree import ElementTree
-            self.upid = ElementTree.XML(response.read()).getchildren()[2].text
-            for chunk in rangeable_file.fbuffer(self.path, self.chunk_size):
-                info = json.loads(self._get_multipart_upload_header(chunk))
-                self.log.info('Sending part {0}'.format(self.partno))
-                response = self._arch_request(chunk, info)
-                etag = response.getheader('etag')
-                self.parts.append((self.partno, etag))
+            if not self._load_manifest():
+                self._start_multipart_upload()
+                self._save_manifest()
+            mapped = rangeable_file.MappedFile(self.path)
+            self._start_workers()
+            try:
+                for byte_range in self._part_ranges():
+                    if self.partno + 1 in self._etags:
+                        self.partno += 1
+                        self.log.info('Part {0} already uploaded. ' \
+                                      'Skipping.'.format(self.partno))
+                        continue
+                    self._queue_part(mapped.range(byte_range), byte_range)
+            finally:
+                try:
+                    self._stop_workers()
+                finally:
+                    mapped.close()
             self._complete_multipart_upload()
-        self.connection.close()
+            if self.sha256:
+                self._write_checksums()
+            os.remove(self.manifest_path)
+        self._get_connection().close()
+
+    def _init_upload(self, filename, chunk_size, workers, sha256=False):
+        """ Set up upload state shared by files and streams."""
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.part_size = chunk_size
+        self.workers = max(1, workers)
+        self.sha256 = sha256
+        self.partno = 0
+        self.parts = []
+        self._etags = dict()
+        self._error = None
+        self._local = threading.local()
+        # Bound the queue so only a few parts are waiting at any time.
+        self._queue = Queue.Queue(maxsize=self.workers)
+        self._threads = list()
+        self.manifest_path = None
+        self._manifest_lock = threading.Lock()
+
+    def _start_workers(self):
+        """ Start the pool of part upload threads."""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._upload_worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _stop_workers(self):
+        """ Wait for queued parts, then order the etags by part number."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = list()
+        if self._error:
+            raise self._error
+        self.parts = sorted(self._etags.items())
+
+    def _queue_part(self, chunk, byte_range=None):
+        """ Number a part and hand it to the upload workers.
 
-    def _hash_file(self, fo):
-        """ Return MD5 hash of file object
+        Keyword arguements:
+        chunk      -- file object holding the part. Closed once uploaded.
+        byte_range -- (firstbyte, lastbyte) of the part within the file
+
+        """
+        if self._error:
+            chunk.close()
+            raise self._error
+        self.partno += 1
+        self._queue.put((self.partno, chunk, byte_range))
+
+    def _upload_worker(self):
+        """ Upload parts from the queue until told to stop."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            partno, chunk, byte_range = item
+            try:
+                # After a failure, keep draining so the producer never blocks.
+                if not self._error:
+                    part_hash, sha256, etag = self._upload_part(partno, chunk)
+                    self._etags[partno] = etag
+                    self._record_part(partno, byte_range, part_hash, sha256,
+                                      etag)
+            except Exception as e:
+                self.log.exception('Upload of part {0} failed.'.format(partno))
+                self._error = e
+            finally:
+                chunk.close()
+
+    def _upload_part(self, partno, chunk):
+        """ Return (md5, sha256, etag) of an uploaded part.
+
+        The part is read and hashed once, then sent (and re-sent on failure,
+        with backoff) from the same buffer.
 
         Keyword arguements:
-        fo -- the file object to hash
+        partno -- the part number
+        chunk  -- file object holding the part
+
+        """
+        data, part_hash, sha256 = self._read_part(chunk)
+        for attempt in range(UPLOAD_RETRIES):
+            try:
+                info = json.loads(self._get_multipart_upload_header(part_hash,
+                                                                    partno))
+                self.log.info('Sending part {0}'.format(partno))
+                start = time.time()
+                response = self._arch_request(data, info)
+                if hasattr(self.part_size, 'record'):
+                    self.part_size.record(len(data), time.time() - start)
+                return (part_hash, sha256, response.getheader('etag'))
+            except Exception:
+                if attempt + 1 == UPLOAD_RETRIES:
+                    raise
+                delay = UPLOAD_BACKOFF * 2 ** attempt
+                self.log.warning('Part {0} failed, retrying in {1} ' \
+                                 'seconds.'.format(partno, delay))
+                # Drop this thread's api connection, it may be broken.
+                self._local.connection = None
+                time.sleep(delay)
+
+    def _load_manifest(self):
+        """ Return True if an earlier upload of this file can be resumed.
+
+        Restores the upload id and acknowledged parts from the manifest. The
+        manifest is only trusted if the file and chunk size are unchanged.
+
+        """
+        self._manifest = {'filename': self.filename,
+                          'filesize': self.filesize,
+                          'mtime': int(os.path.getmtime(self.path)),
+                          'chunk_size': self.chunk_size,
+                          'ranges': list(),
+                          'parts': dict()}
+        if not (self.resume and os.path.isfile(self.manifest_path)):
+            return False
+        with open(self.manifest_path, 'r') as f:
+            manifest = json.load(f)
+        for key in ('filesize', 'mtime', 'chunk_size'):
+            if manifest.get(key) != self._manifest[key]:
+                self.log.warning('Archive changed since the last upload. ' \
+                                 'Starting over.')
+                return False
+        self._manifest = manifest
+        self.upid = manifest['upload_id']
+        if hasattr(self.part_size, 'parts'):
+            self.part_size.parts = len(manifest['ranges'])
+        for partno, part in manifest['parts'].iteritems():
+            self._etags[int(partno)] = part['etag']
+        self.log.info('Resuming upload {0}: {1} parts already ' \
+                      'uploaded.'.format(self.upid, len(self._etags)))
+        return True
+
+    def _part_ranges(self):
+        """ Yield the byte range of every part, in order.
+
+        Ranges planned by an earlier (resumed) run are replayed first, so
+        part numbers keep matching their bytes. New ranges are added to the
+        manifest before their part is queued.
 
         """
-        fo_hash = hashlib.md5()
-        for chunk in iter(lambda: fo.read(128*fo_hash.block_size), ''):
-            fo_hash.update(chunk)
-        return base64.b64encode(fo_hash.digest())
+        planned = self._manifest['ranges']
+        for byte_range in list(planned):
+            yield tuple(byte_range)
+        start = planned[-1][1] if planned else 0
+        for byte_range in rangeable_file.byte_ranges(self.filesize,
+                                                     self.part_size, start):
+            with self._manifest_lock:
+                planned.append(byte_range)
+                self._save_manifest()
+            yield byte_range
+
+    def _save_manifest(self):
+        """ Atomically write the upload manifest next to the archive."""
+        self._manifest['upload_id'] = self.upid
+        temp_path = '%s.tmp' % self.manifest_path
+        with open(temp_path, 'w') as f:
+            json.dump(self._manifest, f)
+        os.rename(temp_path, self.manifest_path)
+
+    def _record_part(self, partno, byte_range, part_hash, sha256, etag):
+        """ Add an acknowledged part to the manifest.
+
+        Keyword arguements:
+        partno     -- the part number
+        byte_range -- (firstbyte, lastbyte) of the part within the file
+        part_hash  -- base64 MD5 of the part
+        sha256     -- hex SHA-256 of the part, or None
+        etag       -- etag returned by remote storage
+
+        """
+        if not self.manifest_path:
+            return
+        part = {'range': byte_range, 'md5': part_hash, 'etag': etag}
+        if sha256:
+            part['sha256'] = sha256
+        with self._manifest_lock:
+            self._manifest['parts'][str(partno)] = part
+            self._save_manifest()
+
+    def _write_checksums(self):
+        """ Write the SHA-256 of each part to path.sha256.
+
+        One line per part: part number, first byte, last byte, digest.
+
+        """
+        parts = self._manifest['parts']
+        with open('%s.sha256' % self.path, 'w') as f:
+            for partno in sorted(parts, key=int):
+                part = parts[partno]
+                f.write('%s %s %s %s\n' % (partno,
+                                           part['range'][0],
+                                           part['range'][1],
+                                           part.get('sha256', '')))
+
+    def _get_connection(self):
+        """ Return the api connection for the current thread."""
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = httplib.HTTPSConnection(
+                                                  API_HOST,
+                                                  API_PORT,
+                                                  key_file = VM_CERTIFICATE,
+                                                  cert_file = VM_CERTIFICATE)
+        return self._local.connection
+
+    def _read_part(self, fo):
+        """ Return (data, md5, sha256) for a file object, reading it once.
+
+        Memory mapped ranges are hashed and sent straight from the mapping.
+        Other parts up to PART_BUFFER_LIMIT are loaded into this thread's
+        reusable buffer and hashed while they load. The returned data is that
+        buffer, so sending (and retrying) never touches the disk again. Larger
+        parts are hashed in a first pass and read again when sent.
+
+        Keyword arguements:
+        fo -- the file object to read, positioned anywhere
+
+        """
+        digests = [hashlib.md5()]
+        if self.sha256:
+            digests.append(hashlib.sha256())
+        fo.seek(0, 2)
+        size = fo.tell()
+        fo.seek(0)
+        if isinstance(fo, rangeable_file.MappedRange):
+            data = fo
+            for view in fo.views():
+                for digest in digests:
+                    digest.update(view)
+            fo.seek(0)
+        elif size <= PART_BUFFER_LIMIT:
+            data = getattr(self._local, 'buffer', None)
+            if data is None:
+                data = self._local.buffer = rangeable_file.PartBuffer()
+            data.load(fo, size, digests)
+        else:
+            data = fo
+            for chunk in iter(lambda: fo.read(1048576), ''):
+                for digest in digests:
+                    digest.update(chunk)
+        sha256 = digests[1].hexdigest() if self.sha256 else None
+        return (data, base64.b64encode(digests[0].digest()), sha256)
+
+    def _start_multipart_upload(self):
+        """ Initiate a multipart upload and store its upload id."""
+        #TODO: Use boto to get upid after next release
+        #self.upid = json.loads(self._initiate_multipart_upload())
+        info = json.loads(self._initiate_multipart_upload())
+        response = self._arch_request(None, info)
+        from xml.etree import ElementTree
+        self.upid = ElementTree.XML(response.read()).getchildren()[2].text
 
     def _initiate_multipart_upload(self):
         """ Return the upload id from api."""
@@ -384,36 +1040,33 @@ class Archive():
         path = "/sites/self/archive/{0}".format(self.filename)
         return self._api_request(path, encoded_headers)
 
-    def _get_multipart_upload_header(self, part):
+    def _get_multipart_upload_header(self, part_hash, partno):
         """ Return multipart upload headers from api.
 
         Keyword arguements:
-        part -- file object to get headers for
+        part_hash -- base64 MD5 of the part
+        partno    -- the part number
 
         """
-        # Get the MD5 hash of the file.
         self.log.debug("Archiving file at path: %s" % self.path)
-        part_hash = self._hash_file(part)
-        self.log.debug("Hash of file is: %s" % part_hash)
-        self.partno+=1
+        self.log.debug("Hash of part %s is: %s" % (partno, part_hash))
         headers = {'Content-Type': 'application/x-tar',
                    'Content-MD5': part_hash,
                    'multipart': 'upload',
                    'upload-id': self.upid,
-                   'part-number': self.partno}
+                   'part-number': partno}
         encoded_headers = json.dumps(headers)
         path = "/sites/self/archive/{0}".format(self.filename)
         return self._api_request(path, encoded_headers)
 
-    def _get_upload_header(self, fo):
+    def _get_upload_header(self, part_hash):
         """ Return upload headers from api.
 
         Keyword arguements:
-        fo -- file object to get headers for
+        part_hash -- base64 MD5 of the file
 
         """
         self.log.debug("Archiving file at path: %s" % self.path)
-        part_hash = self._hash_file(fo)
         self.log.debug("Hash of file is: %s" % part_hash)
         headers = {'Content-Type': 'application/x-tar',
                    'Content-MD5': part_hash}
@@ -448,13 +1101,14 @@ class Archive():
         Make PUT request to config server.
 
         """
-        self.connection.connect()
+        connection = self._get_connection()
+        connection.connect()
         if encoded_headers:
-            self.connection.request("PUT", path, encoded_headers)
+            connection.request("PUT", path, encoded_headers)
         else:
-            self.connection.request("PUT", path)
+            connection.request("PUT", path)
 
-        complete_response = self.connection.getresponse()
+        complete_response = connection.getresponse()
         if complete_response.status == 200:
             self.log.debug('Successfully obtained authorization.')
         else:
@@ -478,10 +1132,22 @@ class Archive():
             data.seek(0,2)
             self.log.info('Sending %s bytes to remote storage' % data.tell())
             data.seek(0)
-        arch_connection.request(info['verb'],
-                                info['path'],
-                                data,
-                                info['headers'])
+        if isinstance(data, rangeable_file.MappedRange):
+            # Send memory mapped parts straight from the mapping instead of
+            # through httplib's 8K reads.
+            headers = dict(info['headers'])
+            if 'content-length' not in [h.lower() for h in headers]:
+                headers['Content-Length'] = str(len(data))
+            arch_connection.putrequest(info['verb'], info['path'])
+            for header, value in headers.iteritems():
+                arch_connection.putheader(header, value)
+            arch_connection.endheaders()
+            data.sendto(arch_connection.sock)
+        else:
+            arch_connection.request(info['verb'],
+                                    info['path'],
+                                    data,
+                                    info['headers'])
         arch_complete_response = arch_connection.getresponse()
         if arch_complete_response.status == 200:
             if data:
@@ -491,6 +1157,77 @@ class Archive():
             raise Exception(arch_complete_response.reason)
         return arch_complete_response
 
+class ArchiveStream(Archive):
+    def __init__(self, filename, chunk_size=STREAM_CHUNK_SIZE,
+                 workers=UPLOAD_WORKERS):
+        """Initiates a writable, file-like multipart upload.
+
+        Data written to this object is buffered into parts of chunk_size,
+        which are uploaded by the worker pool while the next part fills.
+
+        Keyword arguements:
+        filename   -- name of the archive in remote storage
+        chunk_size -- the size to break multipart uploads into
+        workers    -- number of multipart upload parts sent concurrently
+
+        """
+        self.path = filename
+        self.log = logger.logging.getLogger('pantheon.backup.ArchiveStream')
+        self._init_upload(filename, chunk_size, workers)
+        assert self.chunk_size >= 5242880,"Chunk size is too small."
+
+        self._start_multipart_upload()
+        self._part = tempfile.TemporaryFile()
+        self._start_workers()
+
+    def write(self, data):
+        """Buffer data, handing the part off for upload once it is full."""
+        self._part.write(data)
+        if self._part.tell() >= self.chunk_size:
+            self._send_part()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Upload the final part and complete the multipart upload."""
+        if self._part.tell() or not self.partno:
+            self._send_part()
+        self._stop_workers()
+        self._complete_multipart_upload()
+        self._get_connection().close()
+
+    def abort(self):
+        """Stop uploading. Parts already sent are left incomplete."""
+        self._error = self._error or Exception('Upload aborted.')
+        self._part.close()
+        try:
+            self._stop_workers()
+        except Exception:
+            pass
+        self._get_connection().close()
+
+    def _send_part(self):
+        self._queue_part(self._part)
+        self._part = tempfile.TemporaryFile()
+
+def _table_checksums(database):
+    """Return dict of table name -> CHECKSUM TABLE value for a database.
+    database: name of the database.
+
+    """
+    conn = dbtools.MySQLConn(database=database)
+    try:
+        tables = [row[0] for row in conn.execute('SHOW TABLES')]
+        if not tables:
+            return dict()
+        rows = conn.execute('CHECKSUM TABLE %s' % ', '.join(
+                                           ['`%s`' % t for t in tables]))
+        return dict((name.split('.', 1)[1], checksum)
+                    for name, checksum in rows)
+    finally:
+        conn.close()
+
 def _get_server_name(project):
     """Return server name from apache alias "env.server_name.gotpantheon.com"
     """
@@ -0,0 +1,202 @@
+import os
+import pipes
+import subprocess
+import threading
+
+import logger
+
+# Codec used when none is requested.
+DEFAULT_CODEC = 'gzip'
+
+# name: archive extension, leading magic bytes, default level, compressors
+# (first one found on the PATH is used) and decompressor.
+CODECS = {'gzip': {'extension': 'tar.gz',
+                   'magic': '\x1f\x8b',
+                   'level': 6,
+                   # pigz writes standard gzip, using every core.
+                   'compress': ['pigz -c -%(level)d', 'gzip -c -%(level)d'],
+                   'decompress': ['pigz -dc', 'gzip -dc']},
+          'zstd': {'extension': 'tar.zst',
+                   'magic': '\x28\xb5\x2f\xfd',
+                   'level': 3,
+                   'compress': ['zstd -q -c -T0 -%(level)d'],
+                   'decompress': ['zstd -q -dc']},
+          'none': {'extension': 'tar',
+                   'magic': None,
+                   'level': None,
+                   'compress': None,
+                   'decompress': None}}
+
+log = logger.logging.getLogger('pantheon.compression')
+
+def get_codec(name=None):
+    """Return the codec name, validated. None gives DEFAULT_CODEC.
+    name: codec name (gzip/zstd/none).
+
+    """
+    name = (name or DEFAULT_CODEC).lower()
+    if name not in CODECS:
+        raise ValueError('Unknown compression codec: %s' % name)
+    return name
+
+def get_level(codec, level=None):
+    """Return the compression level to use for a codec.
+    codec: codec name.
+    level: requested level. None gives the codec default.
+
+    """
+    if CODECS[codec]['level'] is None:
+        return None
+    return CODECS[codec]['level'] if level in (None, '') else int(level)
+
+def get_extension(codec):
+    """Return the archive extension (e.g. tar.gz) for a codec.
+
+    """
+    return CODECS[codec]['extension']
+
+def get_suffix(codec):
+    """Return the suffix the codec adds to a file name (e.g. .gz).
+
+    """
+    return get_extension(codec)[len('tar'):]
+
+def compress_command(codec, level=None):
+    """Return the shell command compressing stdin to stdout, or None.
+    codec: codec name.
+    level: compression level. None gives the codec default.
+
+    """
+    commands = CODECS[codec]['compress']
+    if not commands:
+        return None
+    return _find_command(codec, commands) % {'level': get_level(codec, level)}
+
+def decompress_command(codec):
+    """Return the shell command decompressing stdin to stdout, or None.
+
+    """
+    commands = CODECS[codec]['decompress']
+    return _find_command(codec, commands) if commands else None
+
+def archive_command(archive, source, codec, level=None):
+    """Return the shell command that tars source into archive.
+    archive: path of the archive to write.
+    source: file or directory to archive (relative to the current dir).
+    codec: codec name.
+    level: compression level. None gives the codec default.
+
+    """
+    command = compress_command(codec, level)
+    if command is None:
+        return 'tar cf %s %s' % (archive, source)
+    pipeline = 'tar cf - %s | %s > %s' % (source, command, archive)
+    return 'bash -o pipefail -c %s' % pipes.quote(pipeline)
+
+def detect(path):
+    """Return the codec an archive was written with, from its magic bytes.
+    path: path to the archive.
+
+    """
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for name, codec in CODECS.iteritems():
+        if codec['magic'] and head.startswith(codec['magic']):
+            return name
+    return 'none'
+
+class Compressor(object):
+    """Writable file-like object that compresses into another one.
+
+    Data written is piped through the codec's compressor in a separate
+    process, so compression runs in parallel with whatever produces the
+    data (and, for pigz/zstd, on several cores).
+
+    """
+
+    def __init__(self, fileobj, codec, level=None):
+        """Start compressing into fileobj.
+        fileobj: writable file-like object receiving the compressed data.
+        codec: codec name.
+        level: compression level. None gives the codec default.
+
+        """
+        self.fileobj = fileobj
+        self.command = compress_command(codec, level)
+        self.process = None
+        self._error = None
+        if self.command:
+            self.process = subprocess.Popen(self.command, shell=True,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+            self._reader = threading.Thread(target=self._copy_output)
+            self._reader.daemon = True
+            self._reader.start()
+
+    def write(self, data):
+        if self.process:
+            self.process.stdin.write(data)
+        else:
+            self.fileobj.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Finish compressing. Raises if the compressor failed."""
+        if not self.process:
+            return
+        self.process.stdin.close()
+        self._reader.join()
+        returncode = self.process.wait()
+        if self._error:
+            raise self._error
+        if returncode:
+            raise OSError('%s exited with status %d' % (self.command,
+                                                        returncode))
+
+    def abort(self):
+        """Stop compressing, discarding any pending output."""
+        if not self.process:
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+    def _copy_output(self):
+        try:
+            for data in iter(lambda: self.process.stdout.read(1048576), ''):
+                self.fileobj.write(data)
+        except Exception, e:
+            self._error = e
+            log.exception('Writing compressed data failed.')
+            # Unblock the writer: the compressor dies once stdout closes.
+            self.process.stdout.close()
+
+def open_decompressed(path, codec):
+    """Return (stream, process) reading the decompressed archive.
+    path: path to the archive.
+    codec: codec name. Must have a decompressor.
+
+    """
+    process = subprocess.Popen('%s < %s' % (decompress_command(codec),
+                                            pipes.quote(path)),
+                               shell=True, stdout=subprocess.PIPE)
+    return (process.stdout, process)
+
+def _find_command(codec, commands):
+    """Return the first command whose program is on the PATH.
+    Raises OSError naming the codec if there is none.
+
+    """
+    for command in commands:
+        program = command.split()[0]
+        for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            if os.access(os.path.join(directory, program), os.X_OK):
+                return command
+    raise OSError('No program for the %s codec found (tried %s).' % (
+                  codec, ', '.join(c.split()[0] for c in commands)))
@@ -1,8 +1,53 @@
+import atexit
+import collections
+import fnmatch
+import hashlib
 import MySQLdb
 import os
+import Queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import compression
+import logger
 import pantheon
+import runner
 from fabric.api import local
 
+# mysqldump processes run at once by DatabaseDumper.
+DUMP_WORKERS = 3
+# Tables loaded at once (one mysql connection each) by import_db_dumps.
+IMPORT_WORKERS = 4
+# Idle connections kept open per (user, database) by the connection pool.
+POOL_SIZE = 4
+# Tables converted at once by convert_to_innodb.
+CONVERT_WORKERS = 3
+# Largest table clone_database copies with INSERT ... SELECT. Bigger tables
+# are streamed through mysqldump, which inserts in batches.
+CLONE_COPY_LIMIT = 67108864
+# Tables (fnmatch patterns) whose rows can be thrown away: they are cleared
+# on import, and dumped and cloned without rows. Projects can override the
+# list with 'disposable_tables' in their configuration.
+DISPOSABLE_TABLES = ['cache_*', 'ctools_object_cache', 'accesslog', 'watchdog']
+
+# Sections of a mysqldump file. Table sections can be loaded in parallel,
+# views, routines and events are loaded last.
+_TABLE_SECTION = re.compile(r'^-- Table structure for table `(.+)`')
+_OTHER_SECTION = re.compile(r'^-- (Temporary (table|view) structure for view|'
+                            r'Final view structure for view|'
+                            r'Dumping (routines|events))')
+_DROP_TABLE = re.compile(r'^DROP TABLE IF EXISTS `(.+)`;')
+# Lines of a dump header that are repeated in every piece: comments and
+# session settings.
+_HEADER_LINE = re.compile(r'^\s*($|--|/\*!\d+ SET |SET )', re.IGNORECASE)
+# Session settings for a bulk load; each piece is one transaction.
+_LOAD_HEADER = 'SET autocommit=0;\nSET unique_checks=0;\n' + \
+               'SET foreign_key_checks=0;\n'
+
 def export_data(self, environment, destination):
     """Export the database for a particular project/environment to destination.
 
@@ -13,21 +58,116 @@ def export_data(self, environment, destination):
     project = self.project
     filepath = os.path.join(destination, '%s_%s.sql' % (project, environment))
     username, password, db_name = pantheon.get_database_vars(self, environment)
-    local("mysqldump --single-transaction --user='%s' \
-                                          --password='%s' \
-                                            %s > %s" % (username,
-                                                       password,
-                                                       db_name,
-                                                       filepath))
+    schema_only = match_tables(get_table_sizes(db_name),
+                               get_disposable_tables(self.config))
+    local('%s > %s' % (dump_command(db_name, schema_only=schema_only,
+                                    username=username, password=password),
+                       filepath))
     return filepath
 
+def dump_command(database, tables=None, schema_only=(), username='root',
+                 password=None):
+    """Return the shell command that writes a mysqldump to stdout.
+    database: name of the database.
+    tables: list of tables to dump. Default is all of them.
+    schema_only: tables to dump without their rows.
+    username/password: credentials. No password by default.
+
+    """
+    base = "mysqldump --single-transaction --user='%s'" % username
+    if password is not None:
+        base += " --password='%s'" % password
+    if tables:
+        schema_only = [table for table in schema_only if table in tables]
+        data_tables = [table for table in tables if table not in schema_only]
+    else:
+        data_tables = list()
+    commands = list()
+    if data_tables or not tables:
+        commands.append('%s %s %s' % (base, database, ' '.join(
+                        data_tables or ['--ignore-table=%s.%s' % (database, t)
+                                        for t in schema_only])))
+    if schema_only:
+        commands.append('%s --no-data %s %s' % (base, database,
+                                                ' '.join(schema_only)))
+    if len(commands) == 1:
+        return commands[0]
+    return '{ %s; }' % ' && '.join(commands)
+
+def get_disposable_tables(config=None):
+    """Return the disposable table patterns (see DISPOSABLE_TABLES).
+    config: project configuration, which may hold 'disposable_tables'.
+
+    """
+    if config and config.get('disposable_tables') is not None:
+        return list(config['disposable_tables'])
+    return DISPOSABLE_TABLES
+
+def match_tables(tables, patterns):
+    """Return the tables matching any of the fnmatch patterns.
+
+    """
+    return sorted(table for table in tables
+                  if any(fnmatch.fnmatchcase(table, p) for p in patterns))
+
+def clone_data(self, source_env, target_env, consistent=False):
+    """Replace the database of target_env with a copy of source_env.
+    consistent: bool. Copy all tables from one snapshot (see
+                clone_database).
+
+    """
+    source_db = pantheon.get_database_vars(self, source_env)[2]
+    target_db = pantheon.get_database_vars(self, target_env)[2]
+    clone_database(source_db, target_db,
+                   disposable=get_disposable_tables(self.config),
+                   consistent=consistent)
+
+def clone_database(source, target, workers=IMPORT_WORKERS, disposable=(),
+                   consistent=False):
+    """Recreate database target as a copy of source on the same server.
+    source: name of the database to copy.
+    target: name of the database to (re)create.
+    workers: number of tables copied at once.
+    disposable: patterns of tables created empty (see DISPOSABLE_TABLES).
+    consistent: bool. Stream the whole database through a single
+                mysqldump --single-transaction instead, so every table is
+                copied as of the same instant. Use it when source is being
+                written to.
+
+    Nothing is written to disk. Tables up to CLONE_COPY_LIMIT are copied
+    server side (CREATE TABLE ... LIKE, INSERT ... SELECT); larger tables
+    and views are streamed from mysqldump straight into the target. Every
+    table is copied consistently, but not at the same instant as the others.
+
+    """
+    log = logger.logging.getLogger('pantheon.dbtools.clone_database')
+    start = time.time()
+    create_database(target)
+    tables = get_table_info(source)
+    schema_only = match_tables([name for name, table_type, size in tables],
+                               disposable)
+    if consistent:
+        _stream_tables(source, target, None, schema_only)
+        log.info('Cloned %s into %s from one snapshot in %.1fs.' % (
+                 source, target, time.time() - start))
+        return
+    run_parallel([(size, (source, target, name, size, name in schema_only))
+                  for name, table_type, size in tables
+                  if table_type != 'VIEW'], workers, _clone_table)
+    views = [name for name, table_type, size in tables if table_type == 'VIEW']
+    if views:
+        _stream_tables(source, target, views)
+    log.info('Cloned %s into %s (%d tables) in %.1fs.' % (source, target,
+                                                        len(tables),
+                                                        time.time() - start))
+
 def import_data(self, environment, source):
     """Create database then import from source.
 
     """
     (db_username, db_password, db_name) = pantheon.get_database_vars(self, environment)
     create_database(db_name)
-    import_db_dump(source, db_name)
+    import_db_dumps([source], db_name)
 
 def create_database(database):
     """Drop database if it already exists, then create a new empty db.
@@ -51,73 +191,518 @@ def set_database_grants(database, username, password):
 
 def import_db_dump(database_dump, database_name):
     """Import database_dump into database_name.
-    database_dump: full path to the database dump.
+    database_dump: full path to the database dump. May be compressed with any
+                   codec of the compression module.
     database_name: name of existing database to import into.
 
     """
-    local('mysql -u root %s < "%s"' % (database_name, database_dump))
+    decompress = compression.decompress_command(
+                                       compression.detect(database_dump))
+    # Not through fabric: imports run on threads alongside other steps.
+    if decompress:
+        runner.run_checked("bash -o pipefail -c '%s < \"%s\" | "
+                           "mysql -u root %s'" % (decompress, database_dump,
+                                                  database_name))
+    else:
+        runner.run_checked('mysql -u root %s < "%s"' % (database_name,
+                                                        database_dump))
+
+def import_db_dumps(database_dumps, database_name, workers=IMPORT_WORKERS):
+    """Import dumps into database_name, loading tables concurrently.
+    database_dumps: list of dumps (see import_db_dump), in import order. Both
+                    whole database and per table dumps are accepted.
+    database_name: name of existing database to import into.
+    workers: number of tables loaded at once.
+
+    The dumps are split by table. Every table is then loaded over its own
+    connection, as one transaction with unique and foreign key checks off.
+    Views, routines and events are loaded once all tables are in. Dumps
+    without table sections (e.g. mysqldump --compact) are loaded as they
+    are, one after the other.
+
+    """
+    log = logger.logging.getLogger('pantheon.dbtools.import_db_dumps')
+    if not database_dumps:
+        return
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(database_dumps[0]))
+    try:
+        prelude, tables, final = split_db_dumps(database_dumps, work_dir)
+        start = time.time()
+        if not tables:
+            log.info('No table sections found, importing the dumps serially.')
+            for database_dump in database_dumps:
+                import_db_dump(database_dump, database_name)
+            return
+        if prelude:
+            _load_piece(prelude, database_name)
+        run_parallel([(os.path.getsize(piece), (piece, database_name))
+                      for piece in tables], workers, _load_piece)
+        if final:
+            _load_piece(final, database_name)
+        log.info('Loaded %d tables into %s in %.1fs.' % (len(tables),
+                                                       database_name,
+                                                       time.time() - start))
+    finally:
+        shutil.rmtree(work_dir)
+
+def split_db_dumps(database_dumps, directory):
+    """Split mysqldump files by table. Returns (prelude piece, table
+    pieces, final piece).
+    database_dumps: list of dumps, in import order. May be compressed.
+    directory: where the pieces are written.
+
+    All sections (and DROP TABLE statements) of a table go to the same
+    piece, in dump order. Views, routines and events go to the final piece.
+    Every piece starts with the comments and SET statements found before
+    the first section; other statements found there go to the prelude
+    piece, loaded before the tables. The prelude and final pieces are None
+    when empty.
+
+    """
+    header = list()
+    prelude = list()
+    # Table name -> piece. The final piece is keyed ''.
+    pieces = dict()
+    current = None
+    out = None
+    for database_dump in database_dumps:
+        for line in _read_dump(database_dump):
+            match = _TABLE_SECTION.match(line) or _DROP_TABLE.match(line)
+            if match:
+                name = match.group(1)
+            elif _OTHER_SECTION.match(line):
+                name = ''
+            elif current is None:
+                # Before the first section of the first dump.
+                if _HEADER_LINE.match(line):
+                    header.append(line)
+                else:
+                    prelude.append(line)
+                continue
+            else:
+                name = current
+            if name != current:
+                if out:
+                    out.close()
+                if name in pieces:
+                    out = open(pieces[name], 'a')
+                else:
+                    pieces[name] = os.path.join(directory,
+                                                '%d.sql' % len(pieces))
+                    out = open(pieces[name], 'w')
+                    out.write(''.join(header) + _LOAD_HEADER)
+                current = name
+            out.write(line)
+    if out:
+        out.close()
+    for path in pieces.values():
+        with open(path, 'a') as f:
+            f.write('COMMIT;\n')
+    final = pieces.pop('', None)
+    if prelude:
+        path = os.path.join(directory, 'prelude.sql')
+        with open(path, 'w') as f:
+            f.write(''.join(header + prelude))
+        prelude = path
+    return (prelude or None, pieces.values(), final)
+
+def run_parallel(jobs, workers, function):
+    """Call function for every job from a pool of threads, largest first.
+    jobs: list of (size, args) tuples; function is called with *args.
+    workers: number of threads.
+    Raises the first error encountered, after the running jobs finish.
+
+    """
+    log = logger.logging.getLogger('pantheon.dbtools.run_parallel')
+    queue = Queue.Queue()
+    for job in sorted(jobs, key=lambda job: job[0], reverse=True):
+        queue.put(job[1])
+    errors = list()
+
+    def worker():
+        while not errors:
+            try:
+                args = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                function(*args)
+            except BaseException, e:
+                log.exception('%s%r failed.' % (function.__name__, args))
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max(1, int(workers)), queue.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def _clone_table(source, target, table, size, schema_only=False):
+    """Copy a table between databases, picking the method by its size.
+
+    """
+    if schema_only or size <= CLONE_COPY_LIMIT:
+        _copy_table(source, target, table, schema_only)
+    else:
+        _stream_tables(source, target, [table])
+
+def _copy_table(source, target, table, schema_only=False):
+    """Copy a table between databases, server side.
 
-def convert_to_innodb(database):
+    """
+    db = MySQLConn()
+    try:
+        db.execute('SET foreign_key_checks=0')
+        try:
+            db.execute('CREATE TABLE `%s`.`%s` LIKE `%s`.`%s`' % (
+                                                target, table, source, table))
+            if not schema_only:
+                db.execute('INSERT INTO `%s`.`%s` SELECT * FROM `%s`.`%s`' % (
+                                                target, table, source, table))
+        finally:
+            # The connection goes back to the pool; do not leak the setting.
+            db.execute('SET foreign_key_checks=1')
+    finally:
+        db.close()
+
+def _stream_tables(source, target, tables, schema_only=()):
+    """Pipe mysqldump of tables in source straight into target.
+    tables: list of tables. None copies the whole database.
+    schema_only: tables copied without their rows.
+
+    """
+    command = '%s | mysql -u root %s' % (dump_command(source, tables,
+                                                      schema_only), target)
+    if subprocess.call(['bash', '-o', 'pipefail', '-c', command]):
+        raise IOError("Copy of %s from '%s' to '%s' failed." % (
+                      ', '.join(tables or ['all tables']), source, target))
+
+def _load_piece(piece, database_name):
+    """Load an uncompressed piece of a dump over a new connection.
+
+    """
+    with open(piece, 'r') as f:
+        if subprocess.call(['mysql', '-u', 'root', database_name], stdin=f):
+            raise IOError("Import of '%s' into '%s' failed." % (piece,
+                                                             database_name))
+
+def _read_dump(database_dump):
+    """Yield the lines of a (possibly compressed) dump.
+
+    """
+    codec = compression.detect(database_dump)
+    if not compression.CODECS[codec]['decompress']:
+        with open(database_dump, 'r') as f:
+            for line in f:
+                yield line
+        return
+    stream, process = compression.open_decompressed(database_dump, codec)
+    for line in stream:
+        yield line
+    stream.close()
+    if process.wait():
+        raise IOError('Decompressing %s failed.' % database_dump)
+
+def get_db_dumps(directory):
+    """Return the database dumps of a backup environment, in import order.
+    directory: backup environment directory.
+
+    Per table dumps (directory/database/) come first, then the single dump
+    (directory/database.sql, compressed or not), then the dumps of applied
+    incremental backups (directory/database.increment.<n>.sql), oldest first.
+
+    """
+    dumps = list()
+    tables = os.path.join(directory, 'database')
+    if os.path.isdir(tables):
+        dumps.extend(os.path.join(tables, name)
+                     for name in sorted(os.listdir(tables)))
+    names = sorted(os.listdir(directory))
+    for prefix in ('database.sql', 'database.increment.'):
+        dumps.extend(os.path.join(directory, name) for name in names
+                     if name.startswith(prefix))
+    return dumps
+
+def get_table_sizes(database):
+    """Return dict of table name -> size (data + indexes) in bytes.
+    database: name of the database.
+
+    """
+    return dict((name, size) for name, table_type, size
+                in get_table_info(database))
+
+def get_table_info(database):
+    """Return list of (name, type, size in bytes) of the tables of a database.
+    database: name of the database.
+    type is 'BASE TABLE' or 'VIEW'.
+
+    """
+    db = MySQLConn()
+    rows = db.execute("SELECT TABLE_NAME, TABLE_TYPE, " + \
+                      "IFNULL(DATA_LENGTH + INDEX_LENGTH, 0) " + \
+                      "FROM information_schema.TABLES " + \
+                      "WHERE TABLE_SCHEMA = '%s'" % database)
+    db.close()
+    return [(name, table_type, int(size)) for name, table_type, size in rows]
+
+def convert_to_innodb(database, workers=CONVERT_WORKERS, skip=()):
     """Convert all table engines to InnoDB (if possible).
+    database: name of the database.
+    workers: number of tables converted at once (largest first).
+    skip: fnmatch patterns of tables to leave alone, e.g. DISPOSABLE_TABLES
+          when they are about to be truncated.
 
     """
+    log = logger.logging.getLogger('pantheon.dbtools.convert_to_innodb')
     db = MySQLConn(cursor=MySQLdb.cursors.DictCursor)
-    tables = db.execute("SELECT TABLE_NAME AS name, ENGINE AS engine " + \
+    tables = db.execute("SELECT TABLE_NAME AS name, ENGINE AS engine, " + \
+                        "IFNULL(DATA_LENGTH + INDEX_LENGTH, 0) AS size " + \
                         "FROM information_schema.TABLES "+ \
                         "WHERE TABLE_SCHEMA = '%s'" % database)
-    for table in tables:
-        if table.get('engine') != 'InnoDB':
-            db.execute("ALTER TABLE %s.%s ENGINE='InnoDB'" % (database,
-                                                    table.get('name')),
-                                                        warn_only=True)
     db.close()
-
-def clear_cache_tables(database):
+    skipped = match_tables([table.get('name') for table in tables], skip)
+    # Views have no engine.
+    tables = [table for table in tables
+              if table.get('engine') not in (None, 'InnoDB')
+              and table.get('name') not in skipped]
+    progress = {'done': 0, 'total': len(tables)}
+    lock = threading.Lock()
+
+    def convert(name):
+        start = time.time()
+        db = MySQLConn()
+        try:
+            db.execute("ALTER TABLE %s.%s ENGINE='InnoDB'" % (database, name),
+                       warn_only=True)
+        finally:
+            db.close()
+        with lock:
+            progress['done'] += 1
+            log.info('Converted %s.%s to InnoDB in %.1fs (%d/%d).' % (
+                     database, name, time.time() - start, progress['done'],
+                     progress['total']))
+
+    start = time.time()
+    run_parallel([(int(table.get('size')), (table.get('name'),))
+                  for table in tables], workers, convert)
+    log.info('Converted %d tables of %s in %.1fs (%d skipped).' % (
+             len(tables), database, time.time() - start, len(skipped)))
+
+def clear_cache_tables(database, config=None):
     """Clear Drupal cache tables.
+    database: name of the database.
+    config: project configuration, which may override the disposable tables
+            (see get_disposable_tables).
 
     """
     db = MySQLConn(cursor=MySQLdb.cursors.DictCursor)
-    # tuple of strings to match agains table_name.startswith()
-    caches = ('cache_')
-    # Other exact matches to look for and clear.
-    other = ['ctools_object_cache',
-             'accesslog',
-             'watchdog']
     tables = db.execute("SELECT TABLE_NAME AS name " + \
                         "FROM information_schema.TABLES " + \
                         "WHERE TABLE_SCHEMA = '%s'" % database)
-    for table in tables:
-        table_name = table.get('name')
-        if (table_name.startswith(caches)) or (table_name in other):
-            db.execute('TRUNCATE %s.%s' % (database, table_name))
+    for table_name in match_tables([table.get('name') for table in tables],
+                                   get_disposable_tables(config)):
+        db.execute('TRUNCATE %s.%s' % (database, table_name))
     db.close()
 
 
+class DatabaseDumper(object):
+    """Run mysqldump jobs concurrently, compressing on the fly.
+
+    Jobs are started largest first (by the table sizes in
+    information_schema), so the biggest dump is never left running alone at
+    the end.
+
+    """
+
+    def __init__(self, workers=DUMP_WORKERS, codec=None, level=None):
+        """Initialize a dumper.
+        workers: number of mysqldump processes run at once.
+        codec: compression of the dumps (see the compression module).
+        level: compression level. None gives the codec default.
+
+        """
+        self.log = logger.logging.getLogger('pantheon.dbtools.DatabaseDumper')
+        self.workers = max(1, int(workers))
+        self.codec = compression.get_codec(codec)
+        self.level = level
+        self.jobs = list()
+
+    def add(self, db_dict, destination, per_table=False, sizes=None,
+            schema_only=(), tables=None):
+        """Schedule the dump of a database. Returns the files to be written.
+        db_dict: db_username
+                 db_password
+                 db_name
+        destination: path of the dump, to which the codec suffix is added
+                     (e.g. database.sql.gz). With per_table, a directory that
+                     gets one <table>.sql dump per table.
+        per_table: bool. Dump each table separately, so they can be dumped
+                   and restored in parallel. Each table is consistent on its
+                   own, but not with the other tables.
+        sizes: dict of table name -> bytes (see get_table_sizes). Queried if
+               not given.
+        schema_only: tables dumped without their rows.
+        tables: list of tables to dump. Default is all of them.
+
+        """
+        if sizes is None:
+            sizes = get_table_sizes(db_dict.get('db_name'))
+        if tables is not None:
+            if not tables:
+                return list()
+            sizes = dict((table, sizes.get(table, 0)) for table in tables)
+        suffix = compression.get_suffix(self.codec)
+        if per_table:
+            runner.mkdir(destination)
+            jobs = [(0 if table in schema_only else size,
+                     (db_dict, [table], schema_only,
+                      os.path.join(destination, '%s.sql%s' % (table, suffix))))
+                    for table, size in sizes.iteritems()]
+        else:
+            size = sum(size for table, size in sizes.iteritems()
+                       if table not in schema_only)
+            jobs = [(size, (db_dict, sorted(tables or []), schema_only,
+                            '%s%s' % (destination, suffix)))]
+        self.jobs.extend(jobs)
+        return [job[1][3] for job in jobs]
+
+    def run(self):
+        """Run the scheduled dumps. Raises the first error encountered.
+
+        """
+        jobs, self.jobs = self.jobs, list()
+        run_parallel(jobs, self.workers, self._dump)
+
+    def _dump(self, db_dict, tables, schema_only, path):
+        """Run a single mysqldump (through the compressor) into path.
+
+        """
+        command = dump_command(db_dict.get('db_name'), tables, schema_only,
+                               db_dict.get('db_username'),
+                               db_dict.get('db_password'))
+        compress = compression.compress_command(self.codec, self.level)
+        if compress:
+            command = '%s | %s' % (command, compress)
+        start = time.time()
+        with open(path, 'wb') as f:
+            returncode = subprocess.call(['bash', '-o', 'pipefail', '-c',
+                                          command], stdout=f)
+        if returncode:
+            raise IOError("Export of database '%s' failed." % (
+                                                    db_dict.get('db_name')))
+        self.log.info('Dumped %s in %.1fs.' % (path, time.time() - start))
+
+class ConnectionPool(object):
+    """Process-wide pool of open MySQL connections, keyed by credentials
+    (user and password) and database.
+
+    MySQLConn takes its connection from here and gives it back on close(),
+    so helpers that open a MySQLConn per call no longer connect each time.
+    Safe to share between threads; a connection is only ever handed to one
+    MySQLConn at a time.
+
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        """Initialize the pool.
+        size: idle connections kept per credentials and database. Extra ones
+              are closed when released.
+
+        """
+        self.size = size
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, username, password, database):
+        """Return an open connection, reusing an idle one if possible.
+
+        """
+        with self.lock:
+            idle = self.idle.get(_pool_key(username, password, database))
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            try:
+                connection.ping()
+                return connection
+            except MySQLdb.Error:
+                # Timed out while idle.
+                self._close(connection)
+        return _mysql_connect(database, username, password)
+
+    def release(self, username, password, database, connection):
+        """Give a connection back to the pool, rolling back open work.
+
+        """
+        try:
+            connection.rollback()
+        except MySQLdb.Error:
+            self._close(connection)
+            return
+        with self.lock:
+            idle = self.idle.setdefault(_pool_key(username, password,
+                                                  database), list())
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        self._close(connection)
+
+    def close_all(self):
+        """Close every idle connection.
+
+        """
+        with self.lock:
+            idle, self.idle = self.idle, dict()
+        for connections in idle.values():
+            for connection in connections:
+                self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+
+def _pool_key(username, password, database):
+    # A digest, so the pool does not keep passwords around.
+    return (username, hashlib.sha1(password or '').hexdigest(), database)
+
+pool = ConnectionPool()
+atexit.register(pool.close_all)
+
 class MySQLConn(object):
 
     def __init__(self, username='root', password='', database=None, cursor=None):
         """Initialize generic MySQL connection object.
         If no database is specified, makes a connection with no default db.
+        The connection comes from (and returns to, on close) the pool.
 
         """
-        self.connection = self._mysql_connect(database, username, password)
+        self.log = logger.logging.getLogger('pantheon.dbtools.MySQLConn')
+        self.username = username
+        self.database = database
+        self._password = password
+        self.connection = pool.acquire(username, password, database)
         self.cursor = self.connection.cursor(cursor)
 
-    def execute(self, query, fetchall=True, warn_only=False):
+    def execute(self, query, fetchall=True, warn_only=False, args=None):
         """Execute a command on the connection.
         query: SQL statement.
+        args: optional parameters for %s placeholders in query (escaped).
 
         """
         try:
-            self.cursor.execute(query)
+            self.cursor.execute(query, args)
             self.connection.commit()
         except MySQLdb.Error, e:
             self.connection.rollback()
-            print "MySQL Error %d: %s" % (e.args[0], e.args[1])
+            self.log.error('MySQL Error %d: %s' % (e.args[0], e.args[1]))
             if not warn_only:
                 raise
         except MySQLdb.Warning, w:
-            print "MySQL Warning: %s" % (w)
+            self.log.warning('MySQL Warning: %s' % w)
         if fetchall:
             return self.cursor.fetchall()
         else:
@@ -126,24 +711,32 @@ class MySQLConn(object):
     def vget(self, name):
         """Return the value of a Drupal variable.
         name: The variable name.
+        Returns None if the variable is not set, False if the query failed.
 
         """
-        query = "SELECT value FROM variable WHERE name = '%s'" % name
         try:
-            value = self.execute(query=query, fetchall=False)
-            # Record found, unserialize value.
-            if value is not None:
-                result = _php_unserialize(value[0])
-            # No record found.
-            else:
-                result = None
+            return self.vget_many([name]).get(name)
         except:
-            print "ERROR: Unable to query for variable '%s'" % name
-            result = False
+            self.log.exception("Unable to query for variable '%s'." % name)
+            return False
+
+    def vget_many(self, names):
+        """Return dict of name -> value of Drupal variables, in one query.
+        names: variable names. Variables that are not set are left out.
+
+        """
+        names = list(names)
+        if not names:
+            return dict()
+        query = 'SELECT name, value FROM variable WHERE name IN (%s)' % \
+                ', '.join(['%s'] * len(names))
+        try:
+            rows = self.execute(query=query, args=names)
+            return dict((name, _php_unserialize(value))
+                        for name, value in rows)
         finally:
             # Use rollback in case values have changed elsewhere.
             self.connection.rollback()
-            return result
 
     def vset(self, name, value):
         """Set the value of a Drupal variable.
@@ -151,101 +744,163 @@ class MySQLConn(object):
         value: The value to set (type sensitive).
 
         """
-        result = self.vget(name)
-        # If result is False, we couldn't query the DB.
-        if result is not False:
-            value = _php_serialize(value)
-            # Update if variable exists.
-            if result is not None:
-                query = "UPDATE variable SET value='%s' WHERE name='%s'" % \
-                        (value, name)
-            # Insert if variable does not exist.
-            else:
-                query = "INSERT INTO variable (name, value) " + \
-                        "VALUES ('%s','%s')" % (name, value)
-            self.execute(query=query, fetchall=False)
-            #print 'Variable [%s] set to: %s' % (name, value)
+        self.vset_many({name: value})
+
+    def vset_many(self, values):
+        """Set Drupal variables in one statement (and transaction).
+        values: dict of variable name -> value (type sensitive).
+
+        """
+        if not values:
+            return
+        rows = list()
+        for name, value in values.iteritems():
+            rows.extend([name, _php_serialize(value)])
+        query = 'INSERT INTO variable (name, value) VALUES %s ' % \
+                ', '.join(['(%s, %s)'] * len(values)) + \
+                'ON DUPLICATE KEY UPDATE value = VALUES(value)'
+        self.execute(query=query, fetchall=False, args=rows)
 
     def close(self):
-        """Close database connection.
+        """Release the database connection to the pool.
 
         """
         self.cursor.close()
-        self.connection.close()
+        pool.release(self.username, self._password, self.database,
+                     self.connection)
 
-    def _mysql_connect(self, database, username, password):
-        """Return a MySQL connection object.
+def _mysql_connect(database, username, password):
+    """Return a MySQL connection object.
 
-        """
-        try:
-            conn = {'host': 'localhost',
-                    'user': username,
-                    'passwd': password}
+    """
+    try:
+        conn = {'host': 'localhost',
+                'user': username,
+                'passwd': password}
 
-            if database:
-                conn.update({'db': database})
+        if database:
+            conn.update({'db': database})
 
-            return MySQLdb.connect(**conn)
+        return MySQLdb.connect(**conn)
+
+    except MySQLdb.Error, e:
+        log = logger.logging.getLogger('pantheon.dbtools._mysql_connect')
+        log.error('MySQL Error %d: %s' % (e.args[0], e.args[1]))
+        raise
 
-        except MySQLdb.Error, e:
-            print "MySQL Error %d: %s" % (e.args[0], e.args[1])
-            raise
 
+class PHPObject(collections.OrderedDict):
+    """An unserialized PHP object: its properties, plus the class name.
+
+    """
+
+    def __init__(self, class_name, *args, **kwargs):
+        self.class_name = class_name
+        super(PHPObject, self).__init__(*args, **kwargs)
 
 def _php_serialize(data):
     """Convert data into php serialized format.
-    data: data to convert (type sensitive)
-
-    """
-    vtype = type(data)
-    # String
-    if vtype is str:
-        return 's:%s:"%s";' % (len(data), data)
-    # Integer
-    elif vtype is int:
-        return 'i:%s;' % data
-    # Float / Long
-    elif vtype is long or vtype is float:
-        return 'd:%f;'
-    # Boolean
-    elif vtype is bool:
-        if data:
-            return 'b:1;'
-        else:
-            return 'b:0;'
-    # None
-    elif vtype is None:
+    data: data to convert (type sensitive). Strings, unicode (as UTF-8),
+          int/long, float, bool, None, dicts, lists/tuples (as arrays) and
+          PHPObject.
+
+    """
+    # bool first: it is a subclass of int.
+    if isinstance(data, bool):
+        return 'b:%d;' % data
+    elif data is None:
         return 'N;'
-    # Dict
-    elif vtype is dict:
-        return 'a:%s:{%s}' % (len(data),
-                              ''.join([_php_serialize(k) + \
-                                       _php_serialize(v) \
-                                       for k,v in data.iteritems()]))
+    elif isinstance(data, (int, long)):
+        return 'i:%d;' % data
+    elif isinstance(data, float):
+        if data != data:
+            return 'd:NAN;'
+        elif data in (float('inf'), float('-inf')):
+            return 'd:%sINF;' % ('-' if data < 0 else '')
+        return 'd:%s;' % repr(data)
+    elif isinstance(data, unicode):
+        return _php_serialize(data.encode('utf-8'))
+    elif isinstance(data, str):
+        return 's:%d:"%s";' % (len(data), data)
+    elif isinstance(data, (list, tuple)):
+        data = collections.OrderedDict(enumerate(data))
+    if isinstance(data, dict):
+        items = ''.join([_php_serialize(k) + _php_serialize(v)
+                         for k, v in data.iteritems()])
+        if isinstance(data, PHPObject):
+            return 'O:%d:"%s":%d:{%s}' % (len(data.class_name),
+                                          data.class_name, len(data), items)
+        return 'a:%d:{%s}' % (len(data), items)
+    raise TypeError('Cannot serialize %r to PHP.' % (data,))
 
 def _php_unserialize(data):
     """Convert data from php serialize format to python data types.
     data: data to convert (string)
 
-    Currently only supports converting serialized strings.
-
-    """
-    vtype = data[0:1]
-    if vtype == 's':
-        length, value = data[2:].rstrip(';').split(':', 1)
-        return str(value)
-    elif vtype == 'i':
-        return int(data[2:-1])
-    elif vtype == 'd':
-        return float(data[2:-1])
-    elif vtype == 'b':
-        return bool(data[2:-1])
-    elif vtype == 'N':
-        return None
-    elif vtype == 'a':
-        #TODO fake it till you make it.
-        return 'Array'
-    else:
+    Arrays become OrderedDicts (PHP arrays are ordered maps) and objects
+    PHPObjects. Returns False if data is not valid serialized PHP.
+
+    """
+    try:
+        value, offset = _php_unserialize_value(data, 0)
+    except (ValueError, IndexError):
         return False
+    return value if offset == len(data) else False
 
+def _php_unserialize_value(data, offset):
+    """Return (value, offset after it) for the value at data[offset:].
 
+    """
+    vtype = data[offset]
+    if vtype == 'N':
+        _php_expect(data, offset + 1, ';')
+        return (None, offset + 2)
+    elif vtype in 'bid':
+        _php_expect(data, offset + 1, ':')
+        end = data.index(';', offset + 2)
+        raw = data[offset + 2:end]
+        if vtype == 'b':
+            value = bool(int(raw))
+        elif vtype == 'i':
+            value = int(raw)
+        else:
+            value = float(raw)
+        return (value, end + 1)
+    elif vtype == 's':
+        value, offset = _php_unserialize_string(data, offset + 1)
+        _php_expect(data, offset, ';')
+        return (value, offset + 1)
+    elif vtype in 'aO':
+        if vtype == 'O':
+            class_name, offset = _php_unserialize_string(data, offset + 1)
+            result = PHPObject(class_name)
+        else:
+            result = collections.OrderedDict()
+            offset += 1
+        _php_expect(data, offset, ':')
+        end = data.index(':', offset + 1)
+        count = int(data[offset + 1:end])
+        _php_expect(data, end + 1, '{')
+        offset = end + 2
+        for i in range(count):
+            key, offset = _php_unserialize_value(data, offset)
+            result[key], offset = _php_unserialize_value(data, offset)
+        _php_expect(data, offset, '}')
+        return (result, offset + 1)
+    raise ValueError('Unknown PHP type %r' % vtype)
+
+def _php_unserialize_string(data, offset):
+    """Return (string, offset after it) for ':<length>:"<bytes>"' at offset.
+
+    """
+    _php_expect(data, offset, ':')
+    end = data.index(':', offset + 1)
+    length = int(data[offset + 1:end])
+    _php_expect(data, end + 1, '"')
+    start = end + 2
+    _php_expect(data, start + length, '"')
+    return (data[start:start + length], start + length + 1)
+
+def _php_expect(data, offset, char):
+    if data[offset] != char:
+        raise ValueError('Expected %r at %d' % (char, offset))
@@ -6,6 +6,7 @@ from fabric.api import *
 import MySQLdb
 
 import pantheon
+import runner
 
 def updatedb(alias):
     with settings(warn_only=True):
@@ -85,7 +86,7 @@ def _get_latest_drupal_version():
         with open(temp_file, 'w') as f:
             f.write(contents)
         version = _parse_drupal_version(temp_file)
-        local('rm -f %s' % temp_file)
+        runner.remove(temp_file)
         if version:
             break
     return version
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+
+import logger
+
+log = logger.logging.getLogger('pantheon.fileindex')
+
+class FileIndex(object):
+    """Content index of a directory tree.
+
+    Maps each file path (relative to the root) to its size, mtime, inode and
+    content hash. Building an index against a previous one only re-hashes
+    files whose size, mtime or inode changed.
+
+    """
+
+    def __init__(self, entries=None):
+        """Create a FileIndex.
+        entries: dict of path -> [size, mtime, inode, hash].
+
+        """
+        self.entries = entries or dict()
+
+    @classmethod
+    def load(cls, path):
+        """Return the FileIndex saved at path (empty if there is none).
+
+        """
+        if not os.path.isfile(path):
+            return cls()
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        """Write the index to path (atomically).
+
+        """
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp, path)
+
+    def get_hash(self, path):
+        """Return the content hash of path, or None if it is not indexed.
+
+        """
+        entry = self.entries.get(path)
+        return entry[3] if entry else None
+
+    def diff(self, previous):
+        """Return (changed, removed) lists of paths relative to previous.
+        previous: FileIndex to compare against. Entries without a content
+                  hash count as changed when their size, mtime or inode did.
+
+        """
+        changed = [path for path, entry in self.entries.iteritems()
+                   if _changed(previous.entries.get(path), entry)]
+        removed = [path for path in previous.entries
+                   if path not in self.entries]
+        return (sorted(changed), sorted(removed))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+def build(root, previous=None, content=True):
+    """Return a FileIndex of every file (and symlink) under root.
+    root: directory to index.
+    previous: FileIndex of an earlier run. Hashes of files whose size, mtime
+              and inode are unchanged are reused from it.
+    content: hash file contents. When False only size, mtime and inode are
+             recorded, which is enough to find files touched since previous.
+
+    """
+    previous = previous or FileIndex()
+    entries = dict()
+    hashed = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames + [d for d in dirnames
+                                 if os.path.islink(os.path.join(dirpath, d))]:
+            fullpath = os.path.join(dirpath, name)
+            path = os.path.relpath(fullpath, root)
+            st = os.lstat(fullpath)
+            stat = [st.st_size, int(st.st_mtime), st.st_ino]
+            old = previous.entries.get(path)
+            if old and old[:3] == stat and (old[3] or not content):
+                entries[path] = old
+                continue
+            if not content:
+                entries[path] = stat + [None]
+                continue
+            if os.path.islink(fullpath):
+                digest = 'link:%s' % os.readlink(fullpath)
+            else:
+                digest = hash_file(fullpath)
+            hashed += 1
+            entries[path] = stat + [digest]
+    log.debug('Indexed %d files under %s (%d hashed).' % (len(entries), root,
+                                                          hashed))
+    return FileIndex(entries)
+
+def _changed(old, new):
+    """Return True if index entry new differs from entry old (or None).
+
+    """
+    if old is None:
+        return True
+    if new[3] and old[3]:
+        return new[3] != old[3]
+    return new[:3] != old[:3]
+
+def hash_file(path, blocksize=1048576):
+    """Return the sha1 hex digest of a file's content.
+
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,304 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+import stat
+import time
+
+import fileindex
+import logger
+import runner
+
+# Manifests of the files directory of each project environment.
+FILESYNC_STATE_DIR = '/var/lib/pantheon/filesync'
+# Threads applying a delta.
+SYNC_WORKERS = 8
+# Seconds after which a scan lists every directory again, to pick up files
+# rewritten in place.
+FULL_SCAN_AGE = 86400
+# ioctl sharing the data blocks of two files (copy-on-write clone).
+FICLONE = 0x40049409
+
+log = logger.logging.getLogger('pantheon.filesync')
+
+class Manifest(object):
+    """Files and directories of a tree, as of the last scan.
+
+    files: FileIndex of files and symlinks (hashes are only computed when
+           needed, so may be None).
+    dirs: dict of directory path -> [mtime, inode]. The root is ''. Unlike
+          files, directory mtimes keep their sub-second part.
+    scanned: time of the last scan that listed every directory.
+
+    """
+
+    def __init__(self, files=None, dirs=None, scanned=0):
+        self.files = files or fileindex.FileIndex()
+        self.dirs = dirs or dict()
+        self.scanned = scanned
+
+    @classmethod
+    def load(cls, path):
+        """Return the Manifest saved at path (empty if there is none).
+
+        """
+        if not os.path.isfile(path):
+            return cls()
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            log.warning('Ignoring unreadable manifest %s.' % path)
+            return cls()
+        return cls(fileindex.FileIndex(data['files']), data['dirs'],
+                   data.get('scanned', 0))
+
+    def save(self, path):
+        """Write the manifest to path (atomically).
+
+        """
+        runner.mkdir(os.path.dirname(path))
+        with open('%s.tmp' % path, 'w') as f:
+            json.dump({'files': self.files.entries, 'dirs': self.dirs,
+                       'scanned': self.scanned}, f)
+        os.rename('%s.tmp' % path, path)
+
+def scan(root, previous=None, full=False):
+    """Return a Manifest of root.
+    root: directory to scan.
+    previous: Manifest of an earlier scan. Directories whose mtime and inode
+              are unchanged have had no entries added, removed or renamed,
+              so their contents are taken from it without being listed.
+              Content hashes of unchanged files are kept.
+    full: list and stat every directory regardless of previous. A file
+          rewritten in place does not change its directory's mtime, so it is
+          only found by a full scan. One is done anyway when the last one is
+          older than FULL_SCAN_AGE.
+
+    """
+    previous = previous or Manifest()
+    now = time.time()
+    full = full or previous.scanned < now - FULL_SCAN_AGE
+    children = dict()
+    for path in previous.dirs:
+        if path:
+            children.setdefault(os.path.dirname(path), list()).append(path)
+    contents = dict()
+    for path in previous.files:
+        contents.setdefault(os.path.dirname(path), list()).append(path)
+
+    files = dict()
+    dirs = dict()
+    listed = 0
+    stack = ['']
+    while stack:
+        directory = stack.pop()
+        st = os.lstat(os.path.join(root, directory))
+        dirs[directory] = [st.st_mtime, st.st_ino]
+        if not full and previous.dirs.get(directory) == dirs[directory]:
+            for path in contents.get(directory, list()):
+                files[path] = previous.files.entries[path]
+            stack.extend(children.get(directory, list()))
+            continue
+        listed += 1
+        for name in os.listdir(os.path.join(root, directory)):
+            path = os.path.join(directory, name)
+            st = os.lstat(os.path.join(root, path))
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(path)
+                continue
+            entry = [st.st_size, int(st.st_mtime), st.st_ino]
+            old = previous.files.entries.get(path)
+            files[path] = old if old and old[:3] == entry else entry + [None]
+    log.debug('Scanned %s: %d files, listed %d of %d directories.' % (
+              root, len(files), listed, len(dirs)))
+    return Manifest(fileindex.FileIndex(files), dirs,
+                    now if full else previous.scanned)
+
+def sync(source, destination, source_state=None, destination_state=None,
+         link=False, full=False, workers=SYNC_WORKERS):
+    """Make destination an exact copy of source (rsync -a --delete), doing
+    only the work of what differs between the two.
+    source: directory to copy.
+    destination: directory to update (created if missing).
+    source_state: path of the manifest of source (scans start from it and
+                  it is updated).
+    destination_state: path of the manifest of destination.
+    link: hardlink new files to source instead of copying them. Only safe
+          when files are never rewritten in place.
+    full: list every directory of both trees (see scan). Otherwise only
+          directories changed since the manifests were saved are, and files
+          rewritten in place are picked up by the next full scan, at most
+          FULL_SCAN_AGE later.
+    workers: number of threads applying the delta.
+    Returns a dict of the number of files copied, moved and deleted.
+
+    The destination manifest is updated from the changes applied, without
+    scanning destination again.
+
+    """
+    runner.mkdir(destination)
+    src = scan(source, _load(source_state), full)
+    dest = scan(destination, _load(destination_state), full)
+
+    # Same size and mtime means unchanged (rsync's quick check).
+    changed = [path for path, entry in src.files.entries.iteritems()
+               if dest.files.entries.get(path, [None, None])[:2] != entry[:2]]
+    deleted = [path for path in dest.files if path not in src.files.entries]
+
+    # Files renamed on the source side are moved rather than copied again.
+    candidates = dict()
+    for path in deleted:
+        candidates.setdefault(tuple(dest.files.entries[path][:2]),
+                              list()).append(path)
+    moves = list()
+    copies = list()
+    for path in changed:
+        matches = candidates.get(tuple(src.files.entries[path][:2]))
+        if matches and path not in dest.files.entries and \
+           not os.path.islink(os.path.join(source, path)):
+            digest = _get_hash(source, src, path)
+            for match in matches:
+                if _get_hash(destination, dest, match) == digest:
+                    matches.remove(match)
+                    deleted.remove(match)
+                    moves.append((match, path))
+                    break
+            else:
+                copies.append(path)
+        else:
+            copies.append(path)
+
+    # New directories (parents first, replacing files of the same name),
+    # moves, stale directories, then file copies and removals.
+    created = sorted(set(src.dirs) - set(dest.dirs))
+    stale = sorted(set(dest.dirs) - set(src.dirs), reverse=True)
+    for path in created:
+        _remove(os.path.join(destination, path))
+        runner.mkdir(os.path.join(destination, path))
+        _copy_owner(os.path.join(source, path),
+                    os.path.join(destination, path))
+    for old, new in moves:
+        os.rename(os.path.join(destination, old),
+                  os.path.join(destination, new))
+    for path in stale:
+        runner.remove(os.path.join(destination, path))
+    runner.parallel(_link if link else _copy,
+                    [(os.path.join(source, path),
+                      os.path.join(destination, path)) for path in copies],
+                    workers)
+    runner.parallel(_remove, [(os.path.join(destination, path),)
+                              for path in deleted], workers)
+    # Directories whose entries were changed above, or whose mtime differs.
+    touched = set(os.path.dirname(path) for path in copies + deleted +
+                  created + stale + [old for old, new in moves] +
+                  [new for old, new in moves])
+    touched.update(created)
+    touched.update(path for path in src.dirs
+                   if dest.dirs.get(path, [None])[0] != src.dirs[path][0])
+    touched.intersection_update(src.dirs)
+    for path in touched:
+        shutil.copystat(os.path.join(source, path),
+                        os.path.join(destination, path))
+        _copy_owner(os.path.join(source, path),
+                    os.path.join(destination, path))
+
+    if source_state:
+        src.save(source_state)
+    if destination_state:
+        _applied(destination, src, dest, copies, moves, deleted,
+                 touched).save(destination_state)
+    result = {'copied': len(copies), 'moved': len(moves),
+              'deleted': len(deleted)}
+    log.info('Synced %s to %s: %d copied, %d moved, %d deleted.' % (
+             source, destination, result['copied'], result['moved'],
+             result['deleted']))
+    return result
+
+def get_state_path(project, environment):
+    """Return the path of the files manifest of an environment.
+
+    """
+    return os.path.join(FILESYNC_STATE_DIR, '%s_%s.json' % (project,
+                                                            environment))
+
+def _load(path):
+    return Manifest.load(path) if path else Manifest()
+
+def _applied(destination, src, dest, copies, moves, deleted, touched):
+    """Return the Manifest of destination after a sync, from its manifest
+    before (dest) and the changes applied. Only copied files and touched
+    directories are stat'ed.
+
+    """
+    files = dict(dest.files.entries)
+    for old, new in moves:
+        files[new] = files.pop(old)
+    for path in deleted:
+        files.pop(path, None)
+    for path in copies:
+        st = os.lstat(os.path.join(destination, path))
+        files[path] = [st.st_size, int(st.st_mtime), st.st_ino,
+                       src.files.entries[path][3]]
+    dirs = dict((path, dest.dirs[path]) for path in src.dirs
+                if path not in touched)
+    for path in touched:
+        st = os.lstat(os.path.join(destination, path))
+        dirs[path] = [st.st_mtime, st.st_ino]
+    return Manifest(fileindex.FileIndex(files), dirs, dest.scanned)
+
+def _get_hash(root, manifest, path):
+    """Return (and remember) the content hash of a file of a manifest.
+
+    """
+    entry = manifest.files.entries[path]
+    if entry[3] is None:
+        entry[3] = fileindex.hash_file(os.path.join(root, path))
+    return entry[3]
+
+def _copy(source, destination):
+    """Copy a file, sharing its blocks (reflink) where the filesystem can.
+    Mode, times and ownership are kept (rsync -a).
+
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), destination)
+        _copy_owner(source, destination)
+        return
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(src, dest, 1048576)
+    _copy_owner(source, destination)
+    # After the chown, which clears setuid/setgid bits.
+    shutil.copystat(source, destination)
+
+def _copy_owner(source, destination):
+    """Give destination the owner and group of source (not following
+    symlinks).
+
+    """
+    st = os.lstat(source)
+    os.lchown(destination, st.st_uid, st.st_gid)
+
+def _link(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        _copy(source, destination)
+
+def _remove(path):
+    """Remove a file or symlink (not a directory) if it exists.
+
+    """
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
@@ -4,6 +4,13 @@ import sys
 from fabric.api import *
 
 import pantheon
+import runner
+
+# Project repositories environments are cloned from.
+PROJECT_REPOS = '/var/git/projects'
+# Clone with git alternates (objects are read from the project repo) rather
+# than hardlinking a copy of every object into each clone.
+SHARED_CLONES = True
 
 def post_receive_hook(params):
     """Perform post-receive actions when changes are made to git repo.
@@ -44,6 +51,38 @@ def post_receive_hook(params):
                 local('curl http://127.0.0.1:8090/job/post_hook_status/' + \
                       'buildWithParameters?project=%s' % project)
 
+def clone(project, destination, branch=None, shared=SHARED_CLONES):
+    """Clone a project repo and check out a branch.
+    project: project name.
+    destination: directory to clone into.
+    branch: branch to check out (defaults to the project branch).
+    shared: borrow objects from the project repo through git alternates.
+
+    """
+    repo = os.path.join(PROJECT_REPOS, project)
+    branch = branch or project
+    if shared:
+        # The repo keeps the borrowed objects (see keep_borrowed_objects).
+        runner.run_checked('git clone -q --shared %s -b %s %s' % (
+                           repo, branch, destination))
+    else:
+        runner.run_checked('git clone -q -l %s -b %s %s' % (repo, branch,
+                                                            destination))
+
+def keep_borrowed_objects(repo):
+    """Stop git gc from pruning unreachable objects of a project repo.
+    repo: path of the project repo.
+
+    Clones made with --shared have no objects of their own for what they
+    cloned; they read them from the project repo. An object unreachable in
+    the repo (e.g. after a branch is rewritten) may still be checked out in
+    an environment, and pruning it would break that clone. Set once, when
+    the repo is created or restored, and only with SHARED_CLONES.
+
+    """
+    if SHARED_CLONES:
+        local('git --git-dir=%s config gc.pruneExpire never' % repo)
+
 def _parse_hook_params(params):
     """Parse the params received during a git push.
     Return project name, old revision, new revision.
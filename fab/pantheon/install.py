@@ -1,3 +1,4 @@
+import glob
 import os
 import random
 import re
@@ -8,8 +9,10 @@ import tempfile
 from fabric.api import *
 
 import drupaltools
+import gittools
 import pantheon
 import project
+import runner
 
 class InstallTools(project.BuildTools):
 
@@ -84,11 +87,9 @@ class InstallTools(project.BuildTools):
 
         # Get the .git data for the project repo, and put in the working_dir
         tempdir = tempfile.mkdtemp()
-        local('git clone /var/git/projects/%s -b %s %s' % (self.project,
-                                                           self.project,
-                                                           tempdir))
-        local('mv %s %s' % (os.path.join(tempdir, '.git'), self.working_dir))
-        local('rm -r %s' % tempdir)
+        gittools.clone(self.project, tempdir)
+        runner.move(os.path.join(tempdir, '.git'), self.working_dir)
+        runner.remove(tempdir)
 
         # Commit the result of the makefile.
         with cd(self.working_dir):
@@ -97,15 +98,16 @@ class InstallTools(project.BuildTools):
 
     def setup_database(self):
         """ Create a new database and set user grants. """
-        for env in self.environments:
-            super(InstallTools, self).setup_database(env, self.db_password)
+        runner.parallel(super(InstallTools, self).setup_database,
+                        [(env, self.db_password) for env in self.environments],
+                        len(self.environments))
 
     def setup_files_dir(self):
         """ Creates Drupal files directory and sets gitignore for all sub-files
 
         """
         path = os.path.join(self.working_dir, 'sites/default/files')
-        local("mkdir -p %s " % path)
+        runner.mkdir(path)
         with open('%s/.gitignore' % path, 'a') as f:
             f.write('*\n')
             f.write('!.gitignore\n')
@@ -127,7 +129,7 @@ class InstallTools(project.BuildTools):
         """ Remove working directory.
 
         """
-        local('rm -rf %s' % self.working_dir)
+        runner.remove(self.working_dir)
 
     def build_makefile(self, makefile):
         """ Setup Drupal site using drush make
@@ -135,12 +137,12 @@ class InstallTools(project.BuildTools):
 
         """
         tempdir = tempfile.mkdtemp()
-        local('rm -rf %s' % tempdir)
+        runner.remove(tempdir)
         local("drush make %s %s" % (makefile, tempdir))
-        local('rm -rf %s/*' % self.working_dir)
+        runner.remove(*glob.glob(os.path.join(self.working_dir, '*')))
         local('rsync -av %s/* %s' % (tempdir, self.working_dir))
         with cd(self.working_dir):
             local('git add -A .')
             local("git commit --author=\"%s\" -m 'Site from makefile'" % self.author)
-        local('rm -rf %s' % tempdir)
+        runner.remove(tempdir)
 
@@ -3,10 +3,12 @@ import tempfile
 
 import dbtools
 import drupaltools
+import gittools
 import pantheon
 import project
 import postback
 import logger
+import runner
 
 from fabric.api import *
 #TODO: Improve the logging messages
@@ -46,7 +48,7 @@ def extract(tarball):
     archive_location = os.path.dirname(tarball)
     # Downloaded by import script (known location), remove after extract.
     if archive_location.startswith('/tmp/tmp_dl_'):
-        local('rm -rf %s' % archive_location)
+        runner.remove(archive_location)
 
     return extract_location
 
@@ -103,6 +105,7 @@ class ImportTools(project.BuildTools):
         """ Create a new database and import from dumpfile.
 
         """
+        jobs = list()
         for env in self.environments:
             (db_username, db_password, db_name) = pantheon.get_database_vars(self, env)
             # The database is only imported into the dev environment initially
@@ -113,12 +116,12 @@ class ImportTools(project.BuildTools):
             else:
                 db_dump = None
 
-            super(ImportTools, self).setup_database(env,
-                                                    db_password,
-                                                    db_dump,
-                                                    True)
+            jobs.append((env, db_password, db_dump, True))
+        # One environment per thread.
+        runner.parallel(super(ImportTools, self).setup_database, jobs,
+                        len(jobs))
         # Remove the database dump from processing dir after import.
-        local('rm -f %s' % (os.path.join(self.working_dir, self.db_dump)))
+        runner.remove(os.path.join(self.working_dir, self.db_dump))
 
     def import_site_files(self):
         """Create git branch of project at same revision and platform of
@@ -127,30 +130,27 @@ class ImportTools(project.BuildTools):
         """
         # Get git metadata at correct branch/version point.
         temp_dir = tempfile.mkdtemp()
-        local('git clone -l /var/git/projects/%s -b %s %s' % (self.project,
-                                                              self.project,
-                                                              temp_dir))
+        gittools.clone(self.project, temp_dir)
         # Put the .git metadata on top of imported site.
         with cd(temp_dir):
             local('git checkout %s' % self.project)
             local('cp -R .git %s' % self.working_dir)
+        runner.remove(os.path.join(self.working_dir, 'PRESSFLOW.txt'))
         with cd(self.working_dir):
-            local('rm -f PRESSFLOW.txt')
             # Stomp on any changes to core.
             local('git reset --hard')
-        local('rm -rf %s' % temp_dir)
+        runner.remove(temp_dir)
 
         source = os.path.join(self.working_dir, 'sites/%s' % self.site)
         destination = os.path.join(self.working_dir, 'sites/default')
 
         # Move sites/site_dir to sites/default
         if self.site != 'default':
-            if os.path.exists(destination):
-                local('rm -rf %s' % destination)
-            local('mv %s %s' % (source, destination))
+            runner.remove(destination)
+            runner.move(source, destination)
             # Symlink site_dir to default
-            with cd(os.path.join(self.working_dir,'sites')):
-                local('ln -s %s %s' % ('default', self.site))
+            runner.symlink('default', os.path.join(self.working_dir, 'sites',
+                                                   self.site))
 
     def setup_files_dir(self):
         """Move site files to sites/default/files if they are not already.
@@ -171,25 +171,25 @@ class ImportTools(project.BuildTools):
         if not os.path.exists(file_dest):
             # Broken symlink at sites/default/files
             if os.path.islink(file_dest):
-                local('rm -f %s' % file_dest)
+                runner.remove(file_dest)
                 msg = 'File path was broken symlink. Site files may be missing'
                 self.log.info(msg)
                 postback.build_warning(msg)
-            local('mkdir -p %s' % file_dest)
+            runner.mkdir(file_dest)
 
         # if files are not located in default location, move them there.
         if (file_path) and (file_location != 'sites/%s/files' % self.site):
             with settings(warn_only=True):
                 local('cp -R %s/* %s' % (file_path, file_dest))
-            local('rm -rf %s' % file_path)
+            runner.remove(file_path)
             path = os.path.split(file_path)
             # Symlink from former location to sites/default/files
             if not os.path.islink(path[0]):
                 # If parent folder for files path doesn't exist, create it.
                 if not os.path.exists(path[0]):
-                    local('mkdir -p %s' % path[0])
+                    runner.mkdir(path[0])
                 rel_path = os.path.relpath(file_dest, path[0])
-                local('ln -s %s %s' % (rel_path, file_path))
+                runner.symlink(rel_path, file_path)
 
         # Change paths in the files table
         (db_username, db_password, db_name) = pantheon.get_database_vars(self, 'dev')
@@ -198,10 +198,10 @@ class ImportTools(project.BuildTools):
             file_var = 'file_directory_path'
             file_var_temp = 'file_directory_temp'
             # Change the base path in files table for Drupal 6
-            local('mysql -u root %s -e "UPDATE files SET filepath = \
-                   REPLACE(filepath,\'%s\',\'%s\');"'% (db_name,
-                                                        file_location,
-                                                        'sites/default/files'))
+            db = dbtools.MySQLConn(database = db_name)
+            db.execute('UPDATE files SET filepath = REPLACE(filepath, %s, %s)',
+                       args=(file_location, 'sites/default/files'))
+            db.close()
         elif self.version == 7:
             file_var = 'file_public_path'
             file_var_temp = 'file_temporary_path'
@@ -210,8 +210,8 @@ class ImportTools(project.BuildTools):
         db = dbtools.MySQLConn(database = db_name,
                                username = db_username,
                                password = db_password)
-        db.vset(file_var, 'sites/default/files')
-        db.vset(file_var_temp, '/tmp')
+        db.vset_many({file_var: 'sites/default/files',
+                      file_var_temp: '/tmp'})
         db.close()
 
         # Ignore files directory
@@ -288,8 +288,7 @@ class ImportTools(project.BuildTools):
         db = dbtools.MySQLConn(database = db_name,
                                username = db_username,
                                password = db_password)
-        for key, value in drupal_vars.iteritems():
-            db.vset(key, value)
+        db.vset_many(drupal_vars)
 
         # apachesolr module for drupal 7 stores config in db.
         # TODO: use drush/drupal api to do this work.
@@ -332,7 +331,7 @@ class ImportTools(project.BuildTools):
         # Remove temporary working_dir drush alias.
         alias_file = '/opt/drush/aliases/working_dir.alias.drushrc.php'
         if os.path.exists(alias_file):
-            local('rm -f %s' % alias_file)
+            runner.remove(alias_file)
 
     def setup_settings_file(self):
         site_dir = os.path.join(self.working_dir, 'sites/default')
@@ -367,8 +366,7 @@ class ImportTools(project.BuildTools):
         """ Remove leftover temporary import files..
 
         """
-        local('rm -rf %s' % self.working_dir)
-        local('rm -rf %s' % self.build_location)
+        runner.remove(self.working_dir, self.build_location)
 
     def _get_site_name(self):
         """Return the name of the site to be imported.
@@ -422,9 +420,10 @@ class ImportTools(project.BuildTools):
     def _get_files_dir(self, environment='dev'):
         (db_username, db_password, db_name) = pantheon.get_database_vars(self, environment)
         # Get file_directory_path directly from database, as we don't have a working drush yet.
-        return local("mysql -u %s -p'%s' %s --skip-column-names --batch -e \
-                      \"SELECT value FROM variable WHERE name='file_directory_path';\" | \
-                        sed 's/^.*\"\(.*\)\".*$/\\1/'" % (db_username,
-                                                          db_password,
-                                                          db_name)).rstrip('\n')
+        db = dbtools.MySQLConn(database = db_name,
+                               username = db_username,
+                               password = db_password)
+        file_dir = db.vget('file_directory_path')
+        db.close()
+        return file_dir or ''
 
@@ -3,6 +3,7 @@ import os
 import random
 import string
 import tarfile
+import threading
 import tempfile
 import time
 import urllib2
@@ -11,13 +12,22 @@ import json
 import re
 import logger
 
+import compression
+import dbtools
+import permtools
 import postback
+import runner
+import servicetools
 
 from fabric.api import *
 
 ENVIRONMENTS = set(['dev','test','live'])
 TEMPLATE_DIR = '/opt/pantheon/fab/templates'
 
+# Compiled templates: path -> (mtime, size, string.Template).
+_templates = dict()
+_templates_lock = threading.Lock()
+
 def get_environments():
     """ Return list of development environments.
 
@@ -43,8 +53,7 @@ def copy_template(template, destination):
     destination: full path to destination
 
     """
-    local('cp %s %s' % (get_template(template),
-                        destination))
+    runner.copy(get_template(template), destination)
 
 def build_template(template_file, values):
     """Return a template object of the template_file with substitued values.
@@ -52,9 +61,31 @@ def build_template(template_file, values):
     values: dictionary of values to be substituted in template file
 
     """
-    contents = local('cat %s' % template_file)
-    template = string.Template(contents)
-    template = template.safe_substitute(values)
+    return load_template(template_file).safe_substitute(values)
+
+def build_templates(template_file, values_list):
+    """Return the template_file rendered once for each dictionary of values.
+    template_file: full path to template file
+    values_list: list of dictionaries of values to be substituted
+
+    """
+    template = load_template(template_file)
+    return [template.safe_substitute(values) for values in values_list]
+
+def load_template(template_file):
+    """Return the compiled string.Template of template_file.
+    Templates are cached until the file's mtime or size changes.
+    template_file: full path to template file
+
+    """
+    st = os.stat(template_file)
+    with _templates_lock:
+        cached = _templates.get(template_file)
+        if cached and cached[:2] == (st.st_mtime, st.st_size):
+            return cached[2]
+    template = string.Template(runner.read(template_file))
+    with _templates_lock:
+        _templates[template_file] = (st.st_mtime, st.st_size, template)
     return template
 
 def random_string(length):
@@ -88,10 +119,10 @@ def is_drupal_installed(self, environment):
 
     """
     (username, password, db_name) = get_database_vars(self, environment)
-    with hide('running'):
-        status = local("mysql -u %s -p%s %s -e 'show tables;' | \
-                        awk '/system/'" % (username, password, db_name))
-    # If any data is in status, assume site is installed.
+    db = dbtools.MySQLConn(username, password, db_name)
+    status = db.execute("SHOW TABLES LIKE '%system%'")
+    db.close()
+    # If any table matches, assume site is installed.
     return bool(status)
 
 def download(url, prefix='tmp'):
@@ -266,21 +297,17 @@ class PantheonServer:
             local('apt-get -y update', capture=False)
             local('apt-get -y dist-upgrade', capture=False)
 
-    def restart_services(self):
-        if self.distro == 'ubuntu':
-            local('/etc/init.d/apache2 restart')
-            local('/etc/init.d/memcached restart')
-            with settings(warn_only=True):
-                local('/bin/bash -x /etc/init.d/tomcat6 stop', capture=False)
-                local('/bin/bash -x /etc/init.d/tomcat6 start', capture=False)
-            local('/etc/init.d/varnish restart')
-            local('/etc/init.d/mysql restart')
-        elif self.distro == 'centos':
-            local('/etc/init.d/httpd restart')
-            local('/etc/init.d/memcached restart')
-            local('/etc/init.d/tomcat5 restart')
-            local('/etc/init.d/varnish restart')
-            local('/etc/init.d/mysqld restart')
+    def restart_services(self, services=None):
+        """Reload or restart services through the restart coordinator, which
+        merges the requests of jobs finishing at about the same time.
+        services: dict of service name -> action ('reload' or 'restart') for
+                  the services the caller touched. None restarts them all.
+
+        """
+        if services is None:
+            services = dict((service, 'restart')
+                            for service in servicetools.SERVICES)
+        return servicetools.restart(self.distro, services)
 
     def setup_iptables(self, file):
         local('/sbin/iptables-restore < ' + file)
@@ -292,14 +319,21 @@ class PantheonServer:
                     environment:
                     root: full path to drupal installation
 
+        """
+        self.create_drush_aliases([drush_dict])
+
+    def create_drush_aliases(self, drush_dicts):
+        """ Create the alias.drushrc.php files of several environments.
+        drush_dicts: list of drush_dict (see create_drush_alias).
+
         """
         alias_template = get_template('drush.alias.drushrc.php')
-        alias_file = '/opt/drush/aliases/%s_%s.alias.drushrc.php' % (
-                                            drush_dict.get('project'),
-                                            drush_dict.get('environment'))
-        template = build_template(alias_template, drush_dict)
-        with open(alias_file, 'w') as f:
-            f.write(template)
+        templates = build_templates(alias_template, drush_dicts)
+        for drush_dict, template in zip(drush_dicts, templates):
+            alias_file = '/opt/drush/aliases/%s_%s.alias.drushrc.php' % (
+                                                drush_dict.get('project'),
+                                                drush_dict.get('environment'))
+            runner.write(alias_file, template)
 
     def create_solr_index(self, project, environment, version):
         """ Create solr index in: /var/solr/project/environment.
@@ -307,40 +341,50 @@ class PantheonServer:
         environment: development environment
         version: major drupal version
 
+        """
+        self.create_solr_indexes(project, [environment], version)
+
+    def create_solr_indexes(self, project, environments, version):
+        """ Create the solr indexes of several environments.
+        project: project name
+        environments: list of development environments
+        version: major drupal version
+
         """
 
         # Create project directory
         project_dir = '/var/solr/%s/' % project
         if not os.path.exists(project_dir):
-            local('mkdir %s' % project_dir)
-        local('chown %s:%s %s' % (self.tomcat_owner,
-                                  self.tomcat_owner,
-                                  project_dir))
-
-        # Create data directory from sample solr data.
-        data_dir = os.path.join(project_dir, environment)
-        if os.path.exists(data_dir):
-            local('rm -rf ' + data_dir)
+            runner.mkdir(project_dir)
+        runner.chown(project_dir, self.tomcat_owner, self.tomcat_owner)
+
+        tomcat = permtools.Permissions(owner=self.tomcat_owner,
+                                       group=self.tomcat_owner)
         data_dir_template = os.path.join(get_template_dir(),
                                          'solr%s' % version)
-        local('cp -R %s %s' % (data_dir_template, data_dir))
-        local('chown -R %s:%s %s' % (self.tomcat_owner,
-                                     self.tomcat_owner,
-                                     data_dir))
+
+        def create_data_dir(environment):
+            # Create data directory from sample solr data.
+            data_dir = os.path.join(project_dir, environment)
+            runner.remove(data_dir)
+            runner.copy(data_dir_template, data_dir)
+            permtools.fix_tree(data_dir, tomcat)
+
+        runner.parallel(create_data_dir, [(env,) for env in environments],
+                        len(environments))
 
         # Tell Tomcat where indexes are located.
         tomcat_template = get_template('tomcat_solr_home.xml')
-        values = {'solr_path': '%s/%s' % (project, environment)}
-        template = build_template(tomcat_template, values)
-        tomcat_file = "/etc/tomcat%s/Catalina/localhost/%s_%s.xml" % (
-                                                      self.tomcat_version,
-                                                      project,
-                                                      environment)
-        with open(tomcat_file, 'w') as f:
-            f.write(template)
-        local('chown %s:%s %s' % (self.tomcat_owner,
-                                  self.tomcat_owner,
-                                  tomcat_file))
+        templates = build_templates(tomcat_template,
+                                    [{'solr_path': '%s/%s' % (project, env)}
+                                     for env in environments])
+        for environment, template in zip(environments, templates):
+            tomcat_file = "/etc/tomcat%s/Catalina/localhost/%s_%s.xml" % (
+                                                          self.tomcat_version,
+                                                          project,
+                                                          environment)
+            runner.write(tomcat_file, template)
+            runner.chown(tomcat_file, self.tomcat_owner, self.tomcat_owner)
 
 
     def create_drupal_cron(self, project, environment):
@@ -349,20 +393,31 @@ class PantheonServer:
         environment: development environment
 
         """
-        # Create job directory
-        jobdir = '/var/lib/jenkins/jobs/cron_%s_%s/' % (project, environment)
-        if not os.path.exists(jobdir):
-            local('mkdir -p ' + jobdir)
+        self.create_drupal_crons(project, [environment])
 
-        # Create job from template
-        values = {'drush_alias':'@%s_%s' % (project, environment)}
-        cron_template = get_template('jenkins.drupal.cron')
-        template = build_template(cron_template, values)
-        with open(jobdir + 'config.xml', 'w') as f:
-            f.write(template)
+    def create_drupal_crons(self, project, environments):
+        """ Create the Jenkins drupal cron jobs of several environments.
+        project: project name
+        environments: list of development environments
 
-        # Set Perms
-        local('chown -R %s:%s %s' % ('jenkins', self.jenkins_group, jobdir))
+        """
+        # Create jobs from template
+        cron_template = get_template('jenkins.drupal.cron')
+        templates = build_templates(cron_template,
+                                    [{'drush_alias':'@%s_%s' % (project, env)}
+                                     for env in environments])
+        jenkins = permtools.Permissions(owner='jenkins',
+                                        group=self.jenkins_group)
+        for environment, template in zip(environments, templates):
+            # Create job directory
+            jobdir = '/var/lib/jenkins/jobs/cron_%s_%s/' % (project,
+                                                            environment)
+            if not os.path.exists(jobdir):
+                runner.mkdir(jobdir)
+            runner.write(jobdir + 'config.xml', template)
+
+            # Set Perms
+            permtools.fix_tree(jobdir, jenkins)
 
 
     def get_vhost_file(self, project, environment):
@@ -405,6 +460,8 @@ class PantheonArchive(object):
     def __init__(self, path):
         self.log = logger.logging.getLogger('pantheon.pantheon.PantheonArchive')
         self.path = path
+        self.codec = compression.detect(path)
+        self.process = None
         self.filetype = self._get_archive_type()
         self.archive = self._open_archive()
 
@@ -421,13 +478,20 @@ class PantheonArchive(object):
 
         """
         self.archive.close()
+        if self.process:
+            self.process.stdout.close()
+            self.process.wait()
 
     def _get_archive_type(self):
         """Return the generic type of archive (tar/zip).
 
         """
-        if tarfile.is_tarfile(self.path):
-            self.log.info('Tar archive found.')
+        if self.codec == 'zstd':
+            # tarfile cannot read zstd; trust the magic bytes.
+            self.log.info('Tar archive found (zstd).')
+            return 'tar'
+        elif tarfile.is_tarfile(self.path):
+            self.log.info('Tar archive found (%s).' % self.codec)
             return 'tar'
         elif zipfile.is_zipfile(self.path):
             self.log.info('Zip archive found.')
@@ -441,7 +505,19 @@ class PantheonArchive(object):
         """Return an opened archive file object.
 
         """
-        if self.filetype == 'tar':
+        if self.filetype == 'tar' and compression.CODECS[self.codec]['decompress']:
+            # Decompress in a separate process, read as a stream.
+            try:
+                stream, self.process = compression.open_decompressed(
+                                                        self.path, self.codec)
+            except OSError:
+                if self.codec != 'gzip':
+                    raise
+                self.log.warning('No gzip program found; decompressing '
+                                 'in-process.')
+                return tarfile.open(self.path, 'r:gz')
+            return tarfile.open(fileobj=stream, mode='r|')
+        elif self.filetype == 'tar':
             return tarfile.open(self.path, 'r')
         elif self.filetype == 'zip':
             return zipfile.ZipFile(self.path, 'r')
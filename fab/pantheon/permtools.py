@@ -0,0 +1,305 @@
+import errno
+import json
+import os
+import Queue
+import stat
+import subprocess
+import threading
+
+import fileindex
+import logger
+import runner
+
+try:
+    import posix1e
+except ImportError:
+    # Without pylibacl, ACLs are set with one setfacl pass per call.
+    posix1e = None
+
+# Threads applying permission changes.
+PERMISSION_WORKERS = 8
+# Paths handed to a worker (or to one setfacl call) at a time.
+PERMISSION_BATCH = 512
+# Last applied permission state of each project environment.
+PERMISSION_STATE_DIR = '/var/lib/pantheon/permissions'
+
+log = logger.logging.getLogger('pantheon.permtools')
+
+class Permissions(object):
+    """Desired mode, ownership and ACL of files and directories.
+
+    Every attribute left as None is not changed. Entries that are already
+    in the desired state are not touched.
+
+    """
+
+    def __init__(self, dir_mode=None, file_mode=None, add_mode=None,
+                 owner=None, group=None, acl_group=None):
+        """Describe the desired state.
+        dir_mode: permission bits of directories (e.g. 0770).
+        file_mode: permission bits of files (e.g. 0660).
+        add_mode: bits added to files and directories (e.g. stat.S_IWGRP
+                  for g+w).
+        owner: user name or uid owning every entry.
+        group: group name or gid of every entry.
+        acl_group: group given rwx by ACL (default ACL too, on directories).
+                   Other extended ACL entries are removed.
+
+        """
+        self.dir_mode = dir_mode
+        self.file_mode = file_mode
+        self.add_mode = add_mode or 0
+        self.uid = runner.get_uid(owner)
+        self.gid = runner.get_gid(group)
+        self.acl_group = acl_group
+
+    def fix(self, path):
+        """Bring a single path to the desired state.
+        Returns True if anything was changed.
+
+        """
+        st = os.lstat(path)
+        changed = False
+        if ((self.uid != -1 and st.st_uid != self.uid) or
+            (self.gid != -1 and st.st_gid != self.gid)):
+            os.lchown(path, self.uid, self.gid)
+            changed = True
+        # chmod and ACLs follow symlinks: leave them alone.
+        if stat.S_ISLNK(st.st_mode):
+            return changed
+        is_dir = stat.S_ISDIR(st.st_mode)
+        mode = stat.S_IMODE(st.st_mode)
+        wanted = self.dir_mode if is_dir else self.file_mode
+        if wanted is None:
+            wanted = mode
+        wanted |= self.add_mode
+        if wanted != mode:
+            os.chmod(path, wanted)
+            changed = True
+        if self.acl_group and posix1e:
+            changed = self._fix_acl(path, is_dir) or changed
+        return changed
+
+    def _fix_acl(self, path, is_dir):
+        current = posix1e.ACL(file=path)
+        entries = _acl_entries(current)
+        wanted = posix1e.ACL(text=','.join([
+                             'u::%s' % entries.get('user:', '---'),
+                             'g::%s' % entries.get('group:', '---'),
+                             'o::%s' % entries.get('other:', '---'),
+                             'g:%s:rwx' % self.acl_group,
+                             'm::rwx']))
+        changed = False
+        if _acl_entries(wanted) != entries:
+            wanted.applyto(path)
+            changed = True
+        if is_dir:
+            default = posix1e.ACL(filedef=path)
+            if _acl_entries(wanted) != _acl_entries(default):
+                wanted.applyto(path, posix1e.ACL_TYPE_DEFAULT)
+                changed = True
+        return changed
+
+    def setfacl_command(self):
+        """Return the setfacl arguments applying acl_group (used when
+        pylibacl is not installed).
+
+        """
+        return ['setfacl', '--remove-all', '--modify',
+                'mask:rwx,group:%s:rwx,default:mask:rwx,default:group:%s:rwx'
+                % (self.acl_group, self.acl_group)]
+
+def fix_tree(root, permissions, subtrees=None, workers=PERMISSION_WORKERS):
+    """Apply permissions to root and everything below it in a single pass.
+    root: top of the tree.
+    permissions: Permissions to apply.
+    subtrees: dict of path -> Permissions applied instead below that path.
+    workers: number of threads changing entries.
+    Returns the number of entries changed.
+
+    """
+    subtrees = dict((os.path.normpath(path), perms)
+                    for path, perms in (subtrees or dict()).iteritems())
+
+    def walk():
+        top = os.path.normpath(root)
+        stack = [(top, subtrees.get(top, permissions))]
+        yield (stack[0][1], [top])
+        while stack:
+            directory, perms = stack.pop()
+            try:
+                names = os.listdir(directory)
+            except OSError, e:
+                log.warning('Cannot list %s: %s' % (directory, e))
+                continue
+            batch = list()
+            for name in names:
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    child = subtrees.get(path, perms)
+                    stack.append((path, child))
+                    if child is not perms:
+                        yield (child, [path])
+                        continue
+                batch.append(path)
+                if len(batch) >= PERMISSION_BATCH:
+                    yield (perms, batch)
+                    batch = list()
+            if batch:
+                yield (perms, batch)
+
+    changed = _run(walk(), workers)
+    if not posix1e:
+        # setfacl -R descends into the subtrees too; set them afterwards.
+        if permissions.acl_group:
+            _setfacl(permissions, [root], recursive=True)
+        for path, perms in subtrees.iteritems():
+            if perms.acl_group:
+                _setfacl(perms, [path], recursive=True)
+    log.debug('Fixed permissions of %d entries under %s.' % (changed, root))
+    return changed
+
+def fix_paths(paths, permissions, workers=PERMISSION_WORKERS):
+    """Apply permissions to a list of paths (not recursively).
+    paths: files and directories to fix. Missing paths are ignored.
+    permissions: Permissions to apply.
+    workers: number of threads changing entries.
+    Returns the number of entries changed.
+
+    """
+    paths = [path for path in paths if os.path.lexists(path)]
+    batches = [(permissions, paths[i:i + PERMISSION_BATCH])
+               for i in range(0, len(paths), PERMISSION_BATCH)]
+    changed = _run(iter(batches), workers)
+    if permissions.acl_group and not posix1e:
+        _setfacl(permissions, [path for path in paths
+                               if not os.path.islink(path)])
+    return changed
+
+def with_parents(root, paths):
+    """Return paths plus every directory between them and root.
+    root: directory the paths are below (not included).
+    paths: absolute paths.
+
+    """
+    result = set()
+    root = os.path.normpath(root)
+    for path in paths:
+        path = os.path.normpath(path)
+        while path != root and path.startswith(root + os.sep):
+            if path in result:
+                break
+            result.add(path)
+            path = os.path.dirname(path)
+    return sorted(result)
+
+def load_state(project, environment):
+    """Return the permission state recorded for an environment, or None.
+    The state is a dict with the 'head' commit and 'owner' the permissions
+    were applied for, and the 'files' FileIndex of the files directory.
+
+    """
+    path = _state_path(project, environment)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            state = json.load(f)
+        state['files'] = fileindex.FileIndex.load('%s.files' % path)
+    except (IOError, ValueError), e:
+        log.warning('Ignoring unreadable permission state %s: %s' % (path, e))
+        return None
+    return state
+
+def save_state(project, environment, head, owner, files):
+    """Record the permission state of an environment.
+    head: commit of the environment working tree.
+    owner: owner the permissions were applied for.
+    files: FileIndex of the files directory.
+
+    """
+    runner.mkdir(PERMISSION_STATE_DIR)
+    path = _state_path(project, environment)
+    files.save('%s.files' % path)
+    with open('%s.tmp' % path, 'w') as f:
+        json.dump({'head': head, 'owner': owner}, f)
+    os.rename('%s.tmp' % path, path)
+
+def _state_path(project, environment):
+    return os.path.join(PERMISSION_STATE_DIR, '%s_%s.json' % (project,
+                                                              environment))
+
+def _run(batches, workers):
+    """Fix every (permissions, paths) batch from a pool of threads.
+    Raises the first error encountered, after the running batches finish.
+
+    """
+    queue = Queue.Queue(maxsize=max(1, int(workers)) * 4)
+    errors = list()
+    counts = list()
+
+    def worker():
+        changed = 0
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if errors:
+                continue
+            perms, paths = item
+            for path in paths:
+                try:
+                    if perms.fix(path):
+                        changed += 1
+                except Exception, e:
+                    # Removed while we were walking.
+                    if getattr(e, 'errno', None) == errno.ENOENT:
+                        continue
+                    log.exception('Setting permissions of %s failed.' % path)
+                    errors.append(e)
+                    break
+        counts.append(changed)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, int(workers)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for item in batches:
+            if errors:
+                break
+            queue.put(item)
+    finally:
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return sum(counts)
+
+def _setfacl(permissions, paths, recursive=False):
+    """Set permissions.acl_group on paths with setfacl, in batches.
+
+    """
+    command = permissions.setfacl_command()
+    if recursive:
+        command.append('--recursive')
+    for i in range(0, len(paths), PERMISSION_BATCH):
+        runner.profile.count('commands')
+        subprocess.check_call(command + ['--'] +
+                              paths[i:i + PERMISSION_BATCH])
+
+def _acl_entries(acl):
+    """Return the entries of a posix1e ACL as a dict of 'tag:qualifier' ->
+    'rwx' string.
+
+    """
+    entries = dict()
+    for line in str(acl).splitlines():
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        tag, qualifier, perms = line.split(':')
+        entries['%s:%s' % (tag, qualifier)] = perms
+    return entries
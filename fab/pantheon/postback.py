@@ -3,12 +3,16 @@ import httplib
 import json
 import os
 import sys
+import threading
 import urllib2
 import uuid
 import jenkinstools
 
 from fabric.api import local
 
+# Build steps may run in parallel: one writer at a time.
+_build_data_lock = threading.Lock()
+
 def postback(cargo, command='atlas'):
     """Send data back to Atlas.
     cargo: dict of data to send.
@@ -100,8 +104,9 @@ def write_build_data(response_type, data):
     """
     build_data_path = os.path.join(jenkinstools.get_workspace(), 'build_data.txt')
 
-    with open(build_data_path, 'a') as f:
-        cPickle.dump({response_type:data}, f)
+    with _build_data_lock:
+        with open(build_data_path, 'a') as f:
+            cPickle.dump({response_type:data}, f)
 
 def build_message(message):
     """Writes messages to file that will be sent back to Atlas,
@@ -1,9 +1,14 @@
 import os
-import tempfile
 
 import dbtools
 import drupaltools
+import fileindex
+import gittools
+import logger
 import pantheon
+import permtools
+import runner
+import servicetools
 import ygg
 from vars import *
 
@@ -56,8 +61,7 @@ class BuildTools(object):
         # Databases
 
         for location in locations:
-            if os.path.exists(location):
-                local('rm -rf %s' % location)
+            runner.remove(location)
 
     def setup_project_repo(self, upstream_repo=None):
         """ Create a new project repo, and download pantheon/drupal core.
@@ -98,6 +102,7 @@ class BuildTools(object):
             local('git config core.sharedRepository group')
             # Group write.
             local('chmod -R g+w .')
+        gittools.keep_borrowed_objects(project_repo)
 
         # post-receive-hook
         post_receive_hook = os.path.join(project_repo,
@@ -118,9 +123,7 @@ class BuildTools(object):
         working_dir: temp directory for project processing (import/restore)
 
         """
-        local('git clone -l /var/git/projects/%s -b %s %s' % (self.project,
-                                                              self.project,
-                                                              working_dir))
+        gittools.clone(self.project, working_dir)
 
     def setup_database(self, environment, password, db_dump=None, onramp=False):
         """ Create a new database based on project_environment, using password.
@@ -137,9 +140,9 @@ class BuildTools(object):
         dbtools.create_database(database)
         dbtools.set_database_grants(database, username, password)
         if db_dump:
-            dbtools.import_db_dump(db_dump, database)
+            dbtools.import_db_dumps([db_dump], database)
             if onramp:
-                dbtools.clear_cache_tables(database)
+                dbtools.clear_cache_tables(database, self.config)
                 dbtools.convert_to_innodb(database)
 
     def setup_settings_file(self, site_dir):
@@ -158,7 +161,7 @@ class BuildTools(object):
                                                              settings_default))
         # Make sure settings.php exists.
         if not os.path.isfile(settings_file):
-            local('cp %s %s' % (settings_default, settings_file))
+            runner.copy(settings_default, settings_file)
 
         # Comment out $base_url entries.
         local("sed -i 's/^[^#|*]*\$base_url/# $base_url/' %s" % settings_file)
@@ -171,9 +174,8 @@ class BuildTools(object):
         # Import needs a valid settings file in the tmp directory
         if hasattr(self, 'working_dir'):
             tmp_file_dir = os.path.abspath(os.path.join(self.working_dir, '..'))
-            local("cp %s %s" %
-                  (os.path.join(self.project_path, settings_pantheon),
-                   tmp_file_dir))
+            runner.copy(os.path.join(self.project_path, settings_pantheon),
+                        tmp_file_dir)
             vhost_file = '/etc/apache2/sites-available/%s_dev' % self.project
             local("sed -i -e 's|($vhost_file)|(\"%s\")|' %s/%s" %
                   (vhost_file, tmp_file_dir, settings_pantheon))
@@ -191,26 +193,73 @@ if (file_exists('../pantheon%s.settings.php')) {
         """ Create drush aliases for each environment in a project.
 
         """
-        for env in self.environments:
-            root = os.path.join(self.server.webroot, self.project, env)
-            drush_dict = {'project': self.project,
-                          'environment': env,
-                          'root': root}
-            self.server.create_drush_alias(drush_dict)
+        self.server.create_drush_aliases([
+                    {'project': self.project,
+                     'environment': env,
+                     'root': os.path.join(self.server.webroot, self.project,
+                                          env)}
+                    for env in self.environments])
 
     def setup_solr_index(self):
         """ Create solr index for each environment in a project.
 
         """
-        for env in self.environments:
-            self.server.create_solr_index(self.project, env, self.version)
+        self.server.create_solr_indexes(self.project, list(self.environments),
+                                        self.version)
 
     def setup_drupal_cron(self):
         """ Create drupal cron jobs in jenkins for each environment.
 
         """
-        for env in self.environments:
-            self.server.create_drupal_cron(self.project, env)
+        self.server.create_drupal_crons(self.project, list(self.environments))
+
+    def invalidate_cache(self, environments=None):
+        """Ban the varnish objects of the environments' hostnames (their
+        apache ServerAlias), leaving other environments and sites cached.
+        environments: names of the environments. Default is all of them.
+        Returns True if the cache was invalidated. Failures are logged but
+        not raised: the work before it has already succeeded.
+
+        """
+        log = logger.logging.getLogger('pantheon.project.invalidate_cache')
+        hostnames = list()
+        for env in environments or self.environments:
+            hostnames.extend(self._get_hostnames(env))
+        if not hostnames:
+            log.warning('No hostnames to invalidate.')
+            return False
+        log.info('Invalidating varnish cache of %s.' % ', '.join(hostnames))
+        try:
+            servicetools.ban_hosts(hostnames)
+        except:
+            log.exception('Varnish cache invalidation failed.')
+            return False
+        return True
+
+    def flush_memcache(self, environments=None):
+        """Clear the Drupal caches of environments with drush. Their
+        memcache bins are keyed by environment, so other sites keep theirs.
+        environments: names of the environments. Default is all of them.
+        Failures are logged but not raised (e.g. Drupal is not installed
+        yet, so nothing is cached).
+
+        """
+        log = logger.logging.getLogger('pantheon.project.flush_memcache')
+        for env in environments or self.environments:
+            try:
+                runner.run_checked('drush @%s_%s -y cache-clear all' % (
+                                   self.project, env))
+            except IOError, e:
+                log.warning('Clearing the caches of %s failed: %s' % (env, e))
+
+    def flush_caches(self):
+        """Flush the memcache bins and varnish objects of every environment.
+        Builds used to get this from restarting memcached and varnish, which
+        flushed every site on the server.
+
+        """
+        self.flush_memcache()
+        self.invalidate_cache()
 
     def setup_environments(self, handler=None, working_dir=None):
         """ Send code/data/files from processing to destination (dev/test/live)
@@ -223,32 +272,46 @@ if (file_exists('../pantheon%s.settings.php')) {
         """
 
         # During import, only run updates/import processes a single database.
-        # Once complete, we import this 'final' database into each environment.
-        if handler == 'import':
-            tempdir = tempfile.mkdtemp()
-            dump_file = dbtools.export_data(self, 'dev', tempdir)
-
-        for env in self.environments:
-            # Code
-            destination = os.path.join(self.project_path, env)
-            local('git clone -l /var/git/projects/%s -b %s %s' % (self.project,
-                                                                 self.project,
-                                                                 destination))
-            # On import setup environment data and files.
-            if handler == 'import':
-                # Data (already exists in 'dev' - import into other envs)
-                if env != 'dev':
-                    dbtools.import_data(self, env, dump_file)
-
-                # Files
-                source = os.path.join(working_dir, 'sites/default/files')
-                file_dir = os.path.join(self.project_path, env,
-                                                'sites/default')
-                local('rsync -av %s %s' % (source, file_dir))
-
-        # Cleanup
+        # Once complete, we clone this 'final' database into each environment.
+        # Environments are set up in parallel, one per thread.
+        environments = list(self.environments)
+        runner.parallel(self._setup_environment,
+                        [(env, handler, working_dir,
+                          env == environments[-1]) for env in environments],
+                        len(environments))
+
+    def _setup_environment(self, env, handler, working_dir, last):
+        """ Send code/data/files to one environment (see setup_environments).
+        last: bool. This is the last environment to take the working_dir
+              files, which may then be hardlinked.
+
+        """
+        # Code (objects are shared with the project repo)
+        destination = os.path.join(self.project_path, env)
+        gittools.clone(self.project, destination)
+        # On import setup environment data and files.
         if handler == 'import':
-            local('rm -rf %s' % tempdir)
+            # Data (already exists in 'dev' - import into other envs)
+            if env != 'dev':
+                dbtools.clone_data(self, 'dev', env)
+
+            # Files (reflinked where possible; the working dir is
+            # discarded, so the last environment may take its inodes)
+            source = os.path.join(working_dir, 'sites/default/files')
+            file_dir = os.path.join(self.project_path, env,
+                                            'sites/default/files')
+            runner.seed_tree(source, file_dir, link=last)
+
+    def _get_hostnames(self, env):
+        """Return the hostnames of an environment from its apache
+        ServerAlias (one or several, space separated).
+
+        """
+        aliases = self.config['environments'][env]['apache'].get(
+                                                       'ServerAlias', '')
+        if isinstance(aliases, basestring):
+            aliases = aliases.split()
+        return [alias.lower() for alias in aliases]
 
     def push_to_repo(self, tag):
         """ Commit changes in working directory and push to central repo.
@@ -265,7 +328,7 @@ if (file_exists('../pantheon%s.settings.php')) {
             local('git push')
             local('git push --tags')
 
-    def setup_permissions(self, handler, environment=None):
+    def setup_permissions(self, handler, environment=None, full=False):
         """ Set permissions on project directory, settings.php, and files dir.
 
         handler: one of: 'import','restore','update','install'. How the
@@ -277,6 +340,9 @@ if (file_exists('../pantheon%s.settings.php')) {
         the update is being run. We do this so we are not forcing permissions
         updates on files that have not changed.
 
+        full: For handler='update', fix the whole environment instead of only
+        the paths changed since permissions were last applied.
+
         """
         # Get  owner
         #TODO: Allow non-getpantheon users to set a default user.
@@ -304,54 +370,40 @@ if (file_exists('../pantheon%s.settings.php')) {
         # installs / imports / restores.
         if handler in ['install', 'import', 'restore']:
             # setup shared repo config and set gid
+            runner.run_batch(['git --git-dir=%s config core.sharedRepository '
+                              'group' % os.path.join(self.project_path, env,
+                                                     '.git')
+                              for env in environments])
+
+            # Files directory and sub files/directories.
+            # For installs, just set 770 on files dir.
+            if handler == 'install':
+                files = permtools.Permissions(dir_mode=0770,
+                                              owner=self.server.web_group,
+                                              group=self.server.web_group)
+            # For imports or restores: 770 on files dir (and subdirs). 660 on
+            # files. Apache should own files/*
+            else:
+                files = self._files_permissions()
+            subtrees = dict((os.path.join(self.project_path, env,
+                                          'sites/default/files'), files)
+                            for env in environments)
+            # Owner for the project, files dirs for apache: one pass.
+            permtools.fix_tree(self.project_path,
+                               permtools.Permissions(owner=owner, group=owner),
+                               subtrees)
+            # Later updates only need to fix what changes from here.
             for env in environments:
-                with cd(os.path.join(self.server.webroot, self.project, env)):
-                    local('git config core.sharedRepository group')
-            with cd(self.server.webroot):
-                local('chown -R %s:%s %s' % (owner, owner, self.project))
-
-
-        """
-        Files directory and sub files/directories
-
-        """
-
-        # For installs, just set 770 on files dir.
-        if handler == 'install':
-            for env in environments:
-                site_dir = os.path.join(self.project_path,
-                                        env,
-                                        'sites/default')
-                with cd(site_dir):
-                    local('chmod 770 files')
-                    local('chown %s:%s files' % (self.server.web_group,
-                                                 self.server.web_group))
-
-        # For imports or restores: 770 on files dir (and subdirs). 660 on files
-        elif handler in ['import', 'restore']:
-            for env in environments:
-                file_dir = os.path.join(self.project_path, env,
-                                        'sites/default/files')
-                with cd(file_dir):
-                    local("chmod 770 .")
-                    # All sub-files
-                    local("find . -type d -exec find '{}' -type f \; | \
-                           while read FILE; do chmod 660 \"$FILE\"; done")
-                    # All sub-directories
-                    local("find . -type d -exec find '{}' -type d \; | \
-                          while read DIR; do chmod 770 \"$DIR\"; done")
-                    # Apache should own files/*
-                    local("chown -R %s:%s ." % (self.server.web_group,
-                                                self.server.web_group))
-
-        # For updates, set apache as owner of files dir.
+                files_dir = os.path.join(self.project_path, env,
+                                         'sites/default/files')
+                permtools.save_state(self.project, env, self._get_head(env),
+                                     owner, fileindex.build(files_dir,
+                                                            content=False))
+
+        # For updates, apache owns the files dir. Code and files changed
+        # since the last time permissions were applied are fixed too.
         elif handler == 'update':
-            site_dir = os.path.join(self.project_path,
-                                    environments[0],
-                                    'sites/default')
-            with cd(site_dir):
-                local('chown %s:%s files' % (self.server.web_group,
-                                             self.server.web_group))
+            self._update_permissions(environments[0], owner, full)
 
 
         """
@@ -364,36 +416,112 @@ if (file_exists('../pantheon%s.settings.php')) {
         for env in environments:
             if pantheon.is_drupal_installed(self, env):
                 # Drupal installed, Apache does not need to own settings.php
-                settings_perms = '440'
+                settings_perms = 0440
                 settings_owner = owner
                 settings_group = self.server.web_group
             else:
                 # Drupal is NOT installed. Apache must own settings.php
-                settings_perms = '660'
+                settings_perms = 0660
                 settings_owner = self.server.web_group
                 settings_group = self.server.web_group
 
             site_dir = os.path.join(self.project_path, env, 'sites/default')
-            with cd(site_dir):
-                # settings.php
-                local('chmod %s settings.php' % settings_perms)
-                local('chown %s:%s settings.php' % (settings_owner,
-                                                    settings_group))
-                # TODO: New sites will not have a pantheon.settings.php in their
-                # repos. However, existing backups will, and if the settings
-                # file exists, we need it to have correct permissions.
-                if os.path.exists(os.path.join(site_dir,
-                                               'pantheon.settings.php')):
-                    local('chmod 440 pantheon.settings.php')
-                    local('chown %s:%s pantheon.settings.php' % (owner,
-                                                       settings_group))
+            # settings.php
+            settings_file = os.path.join(site_dir, 'settings.php')
+            runner.chmod(settings_file, settings_perms)
+            runner.chown(settings_file, settings_owner, settings_group)
+            # TODO: New sites will not have a pantheon.settings.php in their
+            # repos. However, existing backups will, and if the settings
+            # file exists, we need it to have correct permissions.
+            settings_file = os.path.join(site_dir, 'pantheon.settings.php')
+            if os.path.exists(settings_file):
+                runner.chmod(settings_file, 0440)
+                runner.chown(settings_file, owner, settings_group)
         if not self.version:
             self.version = drupaltools.get_drupal_version('%s/dev' %
                                                           self.project_path)[0]
-        with cd(self.project_path):
-            # pantheon.settings.php
-            local('chmod 440 pantheon%s.settings.php' % self.version)
-            local('chown %s:%s pantheon%s.settings.php' % (owner,
-                                                           settings_group,
-                                                           self.version))
+        # pantheon.settings.php
+        settings_file = os.path.join(self.project_path,
+                                     'pantheon%s.settings.php' % self.version)
+        runner.chmod(settings_file, 0440)
+        runner.chown(settings_file, owner, settings_group)
+
+    def _update_permissions(self, env, owner, full=False):
+        """ Make apache the owner of the files dir (not recursively), and
+        fix permissions of the paths of an environment that changed since
+        permissions were last applied to it.
+
+        Changed code is found from the git diff between the recorded and the
+        current HEAD (plus uncommitted and untracked files), changed files
+        from a size/mtime/inode index of the files dir. Without a usable
+        record (e.g. the first update of an existing site) nothing else is
+        changed: the current state is only recorded, so the next update
+        fixes what changes from here.
+
+        env: environment to update.
+        owner: owner of the project code.
+        full: walk and fix the whole environment instead.
+
+        """
+        log = logger.logging.getLogger('pantheon.project.permissions')
+        env_path = os.path.join(self.project_path, env)
+        files_dir = os.path.join(env_path, 'sites/default/files')
+        code = permtools.Permissions(owner=owner, group=owner)
+        files = self._files_permissions()
+        head = self._get_head(env)
+        state = permtools.load_state(self.project, env)
+        changed = None
+        if state and state.get('owner') == owner and not full:
+            changed = self._get_changed_paths(env, state['head'])
+
+        runner.chown(files_dir, self.server.web_group, self.server.web_group)
+        if full:
+            permtools.fix_tree(env_path, code, {files_dir: files})
+            index = fileindex.build(files_dir, content=False)
+        elif changed is None:
+            log.info('No usable permission record for %s; recording the '
+                     'current state only.' % env)
+            index = fileindex.build(files_dir, content=False)
+        else:
+            index = fileindex.build(files_dir, state['files'], content=False)
+            modified = [os.path.join(files_dir, path)
+                        for path in index.diff(state['files'])[0]]
+            permtools.fix_paths(permtools.with_parents(env_path, changed),
+                                code)
+            permtools.fix_paths(permtools.with_parents(files_dir, modified),
+                                files)
+            log.info('Fixed permissions of %d changed code paths and '
+                     '%d changed files.' % (len(changed), len(modified)))
+        permtools.save_state(self.project, env, head, owner, index)
+
+    def _get_head(self, env):
+        """ Return the commit checked out in an environment.
+
+        """
+        with cd(os.path.join(self.project_path, env)):
+            return local('git rev-parse HEAD').strip()
 
+    def _get_changed_paths(self, env, since):
+        """ Return the paths of an environment changed since a commit
+        (committed, uncommitted or untracked), or None if that is unknown.
+
+        """
+        env_path = os.path.join(self.project_path, env)
+        with cd(env_path):
+            with settings(warn_only=True):
+                result = runner.run_batch(
+                         ['git diff --name-only %s' % since,
+                          'git ls-files --others --exclude-standard'])
+        if result.failed:
+            return None
+        return [os.path.join(env_path, path)
+                for path in result.splitlines() if path]
+
+    def _files_permissions(self):
+        """ Return the Permissions of files dirs: apache owned, 770 on
+        directories, 660 on files.
+
+        """
+        return permtools.Permissions(dir_mode=0770, file_mode=0660,
+                                     owner=self.server.web_group,
+                                     group=self.server.web_group)
@@ -1,4 +1,6 @@
+import mmap
 import os
+import threading
 
 class RangeableFileObject():
     """File object wrapper to enable raw range handling.
@@ -111,6 +113,199 @@ class RangeableFileObject():
         
         self._do_seek(realoffset - self.realpos)
 
+class PartBuffer(object):
+    """Reusable memory buffer that holds one part of a file.
+
+    The part is read from disk once. Digests are updated from the same
+    buffer while it loads, and read() then serves slices of that buffer to
+    the uploader without copying.
+
+    """
+
+    def __init__(self, size=0):
+        """Create a PartBuffer.
+
+        size -- initial capacity in bytes. Grows on demand in load().
+
+        """
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.pos = 0
+
+    def load(self, fo, size, digests=(), blocksize=1048576):
+        """Read size bytes from fo into the buffer.
+
+        fo        -- a file object supporting readinto(), positioned at the
+                     start of the part.
+        size      -- number of bytes in the part.
+        digests   -- hashlib objects updated with the bytes as they are read.
+        blocksize -- bytes read (and hashed) per call.
+
+        """
+        if size > len(self.buffer):
+            self.view = None
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+        loaded = 0
+        while loaded < size:
+            block = self.view[loaded:min(loaded + blocksize, size)]
+            count = fo.readinto(block)
+            if not count:
+                break
+            for digest in digests:
+                digest.update(block[:count])
+            loaded += count
+        self.length = loaded
+        self.pos = 0
+
+    def read(self, size=None):
+        """Return a memoryview of the next size bytes (or the remainder).
+
+        """
+        if size is None or size < 0:
+            end = self.length
+        else:
+            end = min(self.pos + size, self.length)
+        chunk = self.view[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def __len__(self):
+        """Returns the length of the loaded part in bytes"""
+        return self.length
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        """Seek within the loaded part.
+
+        offset -- The byte to seek to
+        whence -- Switch between relative and absolute seeking (default 0)
+
+        """
+        assert whence in (0, 1, 2)
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.length
+        self.pos = max(0, min(offset, self.length))
+
+    def close(self):
+        """The buffer is reused, so closing only rewinds it."""
+        self.pos = 0
+
+class MappedFile(object):
+    """Read-only memory map of a whole file, shared by its ranges.
+
+    The file is opened and mapped once. Ranges taken from it read straight
+    out of the page cache, without copying into Python strings.
+
+    """
+
+    def __init__(self, fpath):
+        """Map a file.
+
+        fpath -- path to the file
+
+        """
+        self.fo = open(fpath, 'rb')
+        self.fsize = os.fstat(self.fo.fileno()).st_size
+        # Empty files cannot be mapped.
+        self.map = mmap.mmap(self.fo.fileno(), 0, access=mmap.ACCESS_READ) \
+                   if self.fsize else None
+
+    def range(self, rangetup):
+        """Return a MappedRange over (firstbyte, lastbyte) of the file."""
+        return MappedRange(self, rangetup)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.fo.close()
+
+class MappedRange(object):
+    """Zero-copy, file-like view of a byte range of a MappedFile.
+
+    read() returns buffer objects pointing into the mapping, which hashlib,
+    httplib and sockets accept as they are. Any number of ranges (and
+    threads) can share one MappedFile.
+
+    """
+
+    def __init__(self, mapped, rangetup):
+        """Create a MappedRange.
+
+        mapped   -- the MappedFile to read from.
+        rangetup -- a (firstbyte,lastbyte) tuple specifying the range to
+                    work over.
+
+        """
+        self.mapped = mapped
+        rangetup = range_tuple_normalize(rangetup) or (0, '')
+        self.firstbyte = rangetup[0]
+        self.lastbyte = rangetup[1] if rangetup[1] != '' else mapped.fsize
+        self.lastbyte = min(self.lastbyte, mapped.fsize)
+        self.pos = 0
+
+    def read(self, size=None):
+        """Return a buffer of the next size bytes (or the remainder)."""
+        remaining = len(self) - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        chunk = buffer(self.mapped.map, self.firstbyte + self.pos, size)
+        self.pos += size
+        return chunk
+
+    def views(self, blocksize=1048576):
+        """Yield the rest of the range as buffers of at most blocksize."""
+        for block in iter(lambda: self.read(blocksize), ''):
+            yield block
+
+    def sendto(self, sock, blocksize=1048576):
+        """Send the rest of the range to a connected socket.
+
+        The buffers point into the mapping and are handed to sock.sendall()
+        as they are, so no Python strings are built. (sendfile() is not
+        available on Python 2, nor usable on the TLS sockets uploads go
+        through.)
+
+        sock      -- a connected socket object.
+        blocksize -- bytes sent per call.
+
+        """
+        for block in self.views(blocksize):
+            sock.sendall(block)
+
+    def __len__(self):
+        """Returns the length of the given range in bytes"""
+        return self.lastbyte - self.firstbyte
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        """Seek within the byte range.
+
+        offset -- The byte to seek to
+        whence -- Switch between relative and absolute seeking (default 0)
+
+        """
+        assert whence in (0, 1, 2)
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self)
+        self.pos = max(0, min(offset, len(self)))
+
+    def close(self):
+        """The mapping belongs to the MappedFile, so closing only rewinds."""
+        self.pos = 0
+
 def range_tuple_normalize(range_tup):
     """Normalize a (first_byte,last_byte) range tuple.
     Return a tuple whose first element is guaranteed to be an int
@@ -135,27 +330,117 @@ def range_tuple_normalize(range_tup):
     if lb < fb: raise RangeError(9, 'Invalid byte range: %s-%s' % (fb,lb))
     return (fb,lb)
 
+class AdaptivePartSize(object):
+    """Multipart upload part size policy.
+
+    Parts are sized so that each takes about target_seconds to send at the
+    throughput measured so far, which keeps the cost of a failed part small.
+    Sizes always stay within the S3 limits: no part (but the last) below
+    min_size, and no more than max_parts parts for the whole file.
+
+    """
+
+    def __init__(self, fsize, initial_size=16777216, min_size=5242880,
+                 max_size=134217728, max_parts=10000, target_seconds=30,
+                 align=1048576):
+        """Create an AdaptivePartSize policy.
+
+        fsize          -- size of the file being uploaded.
+        initial_size   -- part size used until a throughput is measured.
+        min_size       -- smallest part size (S3 minimum is 5 MB).
+        max_size       -- largest part size, unless needed to fit max_parts.
+        max_parts      -- most parts allowed for the file (S3: 10,000).
+        target_seconds -- desired upload time of a single part.
+        align          -- part sizes are rounded up to a multiple of this.
+
+        """
+        self.fsize = fsize
+        self.initial_size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_parts = max_parts
+        self.target_seconds = target_seconds
+        self.align = align
+        self.parts = 0
+        self.throughput = None
+        self._lock = threading.Lock()
+
+    def next_size(self, offset):
+        """Return the size of the next part, starting at byte offset.
+
+        offset -- the first byte of the part.
+
+        """
+        with self._lock:
+            if self.throughput:
+                size = int(self.throughput * self.target_seconds)
+            else:
+                size = self.initial_size
+            size = min(max(size, self.min_size), self.max_size)
+            # The remaining parts must still be able to cover the file.
+            parts_left = max(1, self.max_parts - self.parts)
+            size = max(size, -(-(self.fsize - offset) // parts_left))
+            size = -(-size // self.align) * self.align
+            self.parts += 1
+            return size
+
+    def record(self, nbytes, seconds):
+        """Update the throughput estimate from a part that was sent.
+
+        nbytes  -- size of the part.
+        seconds -- time it took to send.
+
+        """
+        if seconds <= 0:
+            return
+        rate = nbytes / float(seconds)
+        with self._lock:
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = 0.7 * self.throughput + 0.3 * rate
+
+def byte_ranges(fsize, chunk_size, start=0):
+    """ Yield (firstbyte, lastbyte) tuples covering a file in chunk_size steps.
+
+    Keyword arguements:
+    fsize      -- size of the file
+    chunk_size -- size of each range, or a policy (e.g. AdaptivePartSize)
+                  whose next_size(offset) returns it. The final range holds
+                  the remainder.
+    start      -- byte to start at
+
+    """
+    byte = start
+    while byte < fsize:
+        if hasattr(chunk_size, 'next_size'):
+            size = chunk_size.next_size(byte)
+        else:
+            size = chunk_size
+        yield (byte, min(byte + size, fsize))
+        byte += size
+
 def fbuffer(fpath, chunk_size):
     """ Yield rangeable file object
 
     Keyword arguements:
     fpath      -- path to the file
-    chunk_size -- size of the chunk to buffer
-    Generator that yields a rangeable file object of a given chunk_size
+    chunk_size -- size of the chunk to buffer, or a part size policy (see
+                  byte_ranges)
+    Generator that yields a rangeable file object (a MappedRange) of a given
+    chunk_size. The last one holds whatever remains of the file. The file is
+    opened and mapped once; the ranges are valid until the generator is
+    exhausted or closed.
 
     """
-    fsize = os.path.getsize(fpath)
-    byte = 0
-    for i in range(fsize/chunk_size):
-        if (fsize > chunk_size):
-            rfo = RangeableFileObject(file(fpath), (byte, byte + chunk_size))
+    mapped = MappedFile(fpath)
+    try:
+        for byte_range in byte_ranges(mapped.fsize, chunk_size):
+            rfo = mapped.range(byte_range)
             yield rfo
             rfo.close()
-            byte += chunk_size
-    else:
-        rfo = RangeableFileObject(file(fpath), (byte, fsize))
-        yield rfo
-        rfo.close()
+    finally:
+        mapped.close()
 
 """ Test code
 import httplib
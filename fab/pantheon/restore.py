@@ -1,9 +1,16 @@
+import json
 import os
 import re
+import shutil
 
+import backup
+import dbtools
 import drupaltools
+import gittools
 import project
+import runner
 
+from configobj import ConfigObj
 from fabric.api import local
 from fabric.api import cd
 
@@ -22,35 +29,130 @@ class RestoreTools(project.BuildTools):
         """
         self.working_dir = location
         self.backup_project = os.listdir(self.working_dir)[0]
+        config = ConfigObj(os.path.join(self.working_dir, self.backup_project,
+                                        'pantheon.backup'))
+        version = int(config.get('backup_version', 0))
+        if version > backup.BACKUP_VERSION:
+            raise ValueError('Backup version %d is not supported (newest is '
+                             '%d).' % (version, backup.BACKUP_VERSION))
+        if version == backup.DEDUP_BACKUP_VERSION or \
+           str(config.get('dedup')).lower() == 'true':
+            self._expand_blobs()
         self.version = drupaltools.get_drupal_version(os.path.join(
                                                           self.working_dir,
                                                           self.backup_project,
                                                           'dev'))[0]
 
+    def apply_increments(self, locations):
+        """ Rebuild the backup as of its latest increment.
+        locations: extracted incremental backups, oldest first. Each must
+                   follow the backup before it (the parsed one, then each
+                   other in turn).
+
+        Changed files are copied over, deleted files removed, and the
+        table dumps of each increment are added after the database dumps
+        (see dbtools.get_db_dumps).
+
+        """
+        base = os.path.join(self.working_dir, self.backup_project)
+        chain = _get_chain(base)
+        components = list(self.environments) + ['%s.git' % self.backup_project]
+        for location in locations:
+            increment = os.path.join(location, os.listdir(location)[0])
+            increment_chain = _get_chain(increment)
+            if increment_chain[:-1] != chain:
+                raise ValueError('Backup %s does not follow %s.' % (
+                                     increment_chain[-1], chain[-1]))
+            for component in components:
+                source = os.path.join(increment, component)
+                target = os.path.join(base, component)
+                deleted = os.path.join(increment, '%s.deleted' % component)
+                if os.path.isfile(deleted):
+                    with open(deleted, 'r') as f:
+                        runner.remove(*[os.path.join(target, path)
+                                        for path in f.read().splitlines()
+                                        if path])
+                if component in self.environments and os.path.isdir(source):
+                    for db_dump in dbtools.get_db_dumps(source):
+                        suffix = os.path.basename(db_dump)[
+                                                    len('database.sql'):]
+                        os.rename(db_dump, os.path.join(target,
+                                  'database.increment.%03d.sql%s' % (
+                                  len(increment_chain) - 1, suffix)))
+                if os.path.isdir(source):
+                    local('rsync -a %s/ %s/' % (source, target))
+            chain = increment_chain
+            runner.remove(location)
+
+    def _expand_blobs(self):
+        """ Rebuild the environment and repo trees of a deduplicated backup.
+
+        Every file is copied out of the blob store (so environments do not
+        share inodes), then the store and manifests are removed.
+
+        """
+        base = os.path.join(self.working_dir, self.backup_project)
+        blobs = os.path.join(base, 'blobs')
+        components = list(self.environments) + ['%s.git' % self.backup_project]
+        for component in components:
+            manifest_file = os.path.join(base, '%s.manifest' % component)
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            target = os.path.join(base, component)
+            for path in sorted(manifest['dirs']):
+                directory = os.path.join(target, path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+            for path, (digest, mode, mtime) in manifest['files'].iteritems():
+                destination = os.path.join(target, path)
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination))
+                if digest.startswith('link:'):
+                    os.symlink(digest[len('link:'):], destination)
+                    continue
+                shutil.copyfile(os.path.join(blobs, digest[:2], digest),
+                                destination)
+                os.chmod(destination, mode)
+                os.utime(destination, (mtime, mtime))
+            for path, mode in manifest['dirs'].iteritems():
+                os.chmod(os.path.join(target, path), mode)
+            os.remove(manifest_file)
+        runner.remove(blobs)
+
     def setup_database(self):
         """ Restore databases from backup.
 
         """
-        for env in self.environments:
-            db_dump = os.path.join(self.working_dir,
-                                   self.backup_project,
-                                   env,
-                                   'database.sql')
-            # Create database and import from dumpfile.
-            super(RestoreTools, self).setup_database(env,
-                                                     self.db_password,
-                                                     db_dump,
-                                                     False)
-            # Cleanup dump file before copying files over.
-            local('rm -f %s' % db_dump)
+        # One environment per thread.
+        runner.parallel(self._setup_env_database,
+                        [(env,) for env in self.environments],
+                        len(self.environments))
+
+    def _setup_env_database(self, env):
+        """ Restore the database of one environment from backup.
+
+        """
+        backup_env = os.path.join(self.working_dir,
+                                  self.backup_project,
+                                  env)
+        # Create database and import from dumpfiles.
+        super(RestoreTools, self).setup_database(env,
+                                                 self.db_password,
+                                                 None,
+                                                 False)
+        database = self.config['environments'][env]['mysql']['db_name']
+        db_dumps = dbtools.get_db_dumps(backup_env)
+        dbtools.import_db_dumps(db_dumps, database)
+        # Cleanup dump files before copying files over.
+        runner.remove(*db_dumps)
+        runner.remove(os.path.join(backup_env, 'database'))
 
     def restore_site_files(self):
         """ Restore code from backup.
 
         """
         for env in self.environments:
-            if os.path.exists('%s/%s' % (self.destination, env)):
-                local('rm -rf %s/%s' % (self.destination, env))
+            runner.remove(os.path.join(self.destination, env))
             with cd(os.path.join(self.working_dir, self.backup_project)):
                 local('rsync -avz %s %s' % (env, self.destination))
             # It's possible that the backup is from a different project.
@@ -58,10 +160,11 @@ class RestoreTools(project.BuildTools):
             with cd(os.path.join(self.destination, env)):
                 self.old_branch = local('git name-rev --name-only HEAD').strip()
                 if self.old_branch != self.project:
-                    local('git branch -m %s %s' % (self.old_branch, self.project))
-                    local('git remote set-url origin /var/git/projects/%s' % self.project)
-                    local('git config branch.%s.remote origin' % self.project)
-                    local('git config branch.%s.merge refs/heads/%s' % (self.project, self.project))
+                    runner.run_batch([
+                        'git branch -m %s %s' % (self.old_branch, self.project),
+                        'git remote set-url origin /var/git/projects/%s' % self.project,
+                        'git config branch.%s.remote origin' % self.project,
+                        'git config branch.%s.merge refs/heads/%s' % (self.project, self.project)])
 
     def restore_repository(self):
         """ Restore GIT repo from backup.
@@ -71,10 +174,10 @@ class RestoreTools(project.BuildTools):
         backup_repo = os.path.join(self.working_dir,
                                    self.backup_project,
                                    '%s.git' % self.backup_project)
-        if os.path.exists(project_repo):
-            local('rm -rf %s' % project_repo)
+        runner.remove(project_repo)
         local('rsync -avz %s/ %s/' % (backup_repo, project_repo))
         local('chmod -R g+w %s' % project_repo)
+        gittools.keep_borrowed_objects(project_repo)
 
         # Enforce a specific origin remote
         with cd(project_repo):
@@ -105,5 +208,16 @@ class RestoreTools(project.BuildTools):
         """ Remove working_dir.
 
         """
-        local('rm -rf %s' % self.working_dir)
+        runner.remove(self.working_dir)
+
+def _get_chain(location):
+    """ Return the backup chain (full backup first) recorded in a backup.
+    location: extracted project directory containing pantheon.backup.
+
+    """
+    config = ConfigObj(os.path.join(location, 'pantheon.backup'))
+    chain = config.get('incremental', {}).get('chain')
+    if not chain:
+        raise ValueError('%s is not an incremental backup.' % location)
+    return [chain] if isinstance(chain, basestring) else chain
 
@@ -0,0 +1,482 @@
+import collections
+import contextlib
+import errno
+import functools
+import grp
+import os
+import pwd
+import Queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from fabric.api import local
+
+import logger
+
+# Threads copying files when a tree cannot be reflinked.
+COPY_WORKERS = 4
+# Threads running the independent steps of a Pipeline.
+PIPELINE_WORKERS = 4
+
+log = logger.logging.getLogger('pantheon.runner')
+
+class Profile(object):
+    """Wall time and command counts of the steps of a job.
+
+    Steps may nest; time and commands are attributed to the innermost step
+    that is running in the same thread.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.steps = list()
+        self._local = threading.local()
+        self._started = time.time()
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    def start(self, name):
+        entry = {'name': name,
+                 'depth': len(self._stack),
+                 'seconds': 0.0,
+                 'commands': 0,
+                 'operations': 0}
+        with self._lock:
+            self.steps.append(entry)
+        self._stack.append((entry, time.time()))
+        return entry
+
+    def stop(self):
+        entry, started = self._stack.pop()
+        entry['seconds'] = time.time() - started
+        return entry
+
+    def count(self, key):
+        if self._stack:
+            self._stack[-1][0][key] += 1
+
+    def timings(self):
+        """Return the top level steps as a list of dicts (name, seconds,
+        commands, operations), for the build data.
+
+        """
+        return [dict((key, entry[key]) for key in ('name', 'seconds',
+                                                   'commands', 'operations'))
+                for entry in self.steps if not entry['depth']]
+
+    def summary(self):
+        """Return the profile as printable text, one line per step.
+
+        """
+        total = time.time() - self._started
+        lines = ['%-48s %9s %6s %6s' % ('step', 'seconds', 'shell', 'native')]
+        for entry in self.steps:
+            lines.append('%-48s %9.2f %6d %6d' % ('  ' * entry['depth'] +
+                                                  entry['name'],
+                                                  entry['seconds'],
+                                                  entry['commands'],
+                                                  entry['operations']))
+        lines.append('%-48s %9.2f %6d %6d' % (
+                     'total', total,
+                     sum(entry['commands'] for entry in self.steps),
+                     sum(entry['operations'] for entry in self.steps)))
+        return '\n'.join(lines)
+
+# Profile of the job running in this process.
+profile = Profile()
+
+@contextlib.contextmanager
+def step(name):
+    """Context manager timing a named step of the current job.
+    name: label shown in the summary.
+
+    """
+    entry = profile.start(name)
+    try:
+        yield entry
+    finally:
+        profile.stop()
+        log.debug('%s took %.2fs.' % (name, entry['seconds']))
+
+def timed(name=None):
+    """Decorator timing every call of a function as a step.
+    name: label shown in the summary (defaults to the function name).
+
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kw):
+            with step(name or function.__name__):
+                return function(*args, **kw)
+        return wrapper
+    return decorator
+
+class Pipeline(object):
+    """Steps of a job with dependencies between them.
+
+    Every step starts as soon as the steps it requires have finished, on a
+    pool of threads, and is timed in the profile. Steps marked serial run
+    one at a time: use it for steps that rely on fabric's cd() or settings()
+    (which are process wide) or otherwise cannot overlap with each other.
+    Steps that are not serial must not depend on the working directory, and
+    shell out with run_checked() rather than fabric, whose warn_only setting
+    a serial step may have turned on meanwhile.
+
+    """
+
+    def __init__(self, workers=PIPELINE_WORKERS):
+        """Create an empty pipeline.
+        workers: number of steps run at the same time.
+
+        """
+        self.workers = max(1, int(workers))
+        self.steps = collections.OrderedDict()
+        self._serial = threading.Lock()
+
+    def add(self, name, function, requires=(), serial=False):
+        """Add a step.
+        name: step name, used in requires and the profile.
+        function: called without arguments.
+        requires: names of the steps that must finish first.
+        serial: never run at the same time as another serial step.
+
+        """
+        for required in requires:
+            if required not in self.steps:
+                raise ValueError('Step %s requires unknown step %s.' % (
+                                 name, required))
+        self.steps[name] = (function, tuple(requires), serial)
+
+    def run(self):
+        """Run every step. Once a step fails no more are started; the first
+        error is raised after the running ones finish.
+
+        """
+        pending = self.steps.keys()
+        done = set()
+        running = dict()
+        finished = Queue.Queue()
+        errors = list()
+        while pending or running:
+            ready = [name for name in pending
+                     if all(required in done
+                            for required in self.steps[name][1])]
+            while ready and not errors and len(running) < self.workers:
+                name = ready.pop(0)
+                pending.remove(name)
+                running[name] = threading.Thread(target=self._run_step,
+                                                 args=(name, finished, errors))
+                running[name].start()
+            if not running:
+                break
+            name = finished.get()
+            running.pop(name).join()
+            done.add(name)
+        if errors:
+            raise errors[0]
+        if pending:
+            raise ValueError('Steps %s were never ready (circular '
+                             'requirements).' % ', '.join(pending))
+
+    def _run_step(self, name, finished, errors):
+        function, requires, serial = self.steps[name]
+        try:
+            if serial:
+                self._serial.acquire()
+            try:
+                with step(name):
+                    function()
+            finally:
+                if serial:
+                    self._serial.release()
+        except Exception, e:
+            log.exception('Step %s failed.' % name)
+            errors.append(e)
+        finally:
+            finished.put(name)
+
+def reset():
+    """Start profiling a new job."""
+    profile.reset()
+
+def log_summary(job_log):
+    """Write the profile of the current job to job_log.
+    job_log: logger (or LoggerAdapter) of the job.
+
+    """
+    job_log.info('Step timings:\n%s' % profile.summary())
+
+def run(command, capture=True):
+    """Run a shell command through fabric, counting it against the current step.
+    command: shell command to run.
+    capture: return the output instead of printing it.
+
+    """
+    profile.count('commands')
+    return local(command, capture=capture)
+
+def run_checked(command):
+    """Run a shell command without fabric and raise if it fails.
+    command: shell command to run (by /bin/sh).
+    Returns its output. Unlike run(), this does not depend on fabric's
+    process wide cd() or settings(warn_only=True), so it is the one to use
+    in Pipeline steps that are not serial.
+
+    """
+    profile.count('commands')
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode:
+        raise IOError('%s failed with exit code %d: %s' % (
+                      command, process.returncode, err.strip()))
+    return out
+
+def run_batch(commands, capture=True):
+    """Run several shell commands in a single shell, stopping at the first
+    failure.
+    commands: list of shell commands.
+    capture: return the output instead of printing it.
+
+    """
+    commands = [command for command in commands if command]
+    if not commands:
+        return ''
+    return run(' && '.join(commands), capture)
+
+def mkdir(path, mode=None):
+    """Create a directory and any missing parents (mkdir -p).
+    path: directory to create.
+    mode: permission bits of the new directories.
+
+    """
+    profile.count('operations')
+    if not os.path.isdir(path):
+        if mode is None:
+            os.makedirs(path)
+        else:
+            os.makedirs(path, mode)
+
+def remove(*paths):
+    """Remove files, symlinks or directory trees. Missing paths are ignored
+    (rm -rf).
+    paths: paths to remove.
+
+    """
+    for path in paths:
+        profile.count('operations')
+        if os.path.islink(path) or os.path.isfile(path):
+            os.remove(path)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+
+def copy(source, destination):
+    """Copy a file or directory tree, keeping symlinks (cp -R).
+    source: file or directory to copy.
+    destination: path of the copy. If it is an existing directory the copy is
+                 placed inside it.
+
+    """
+    profile.count('operations')
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(
+                                   source.rstrip(os.sep)))
+    if os.path.isdir(source) and not os.path.islink(source):
+        shutil.copytree(source, destination, symlinks=True)
+    elif os.path.islink(source):
+        os.symlink(os.readlink(source), destination)
+    else:
+        shutil.copy(source, destination)
+
+def seed_tree(source, destination, link=False, workers=COPY_WORKERS):
+    """Copy the contents of source into destination as cheaply as the
+    filesystem allows: reflinks (copy-on-write) where supported, otherwise
+    hardlinks if link is set, otherwise a parallel copy.
+    source: directory to copy.
+    destination: directory to copy into (created if missing, merged into if
+                 it exists).
+    link: hardlink files instead of copying them when reflinks are not
+          supported. Only for sources that are discarded afterwards, as
+          later changes to a linked file show on both sides.
+    workers: number of threads copying files.
+
+    """
+    mkdir(destination)
+    profile.count('commands')
+    with open(os.devnull, 'w') as devnull:
+        if not subprocess.call(['cp', '-a', '--reflink=always',
+                                os.path.join(source, '.'), destination],
+                               stderr=devnull):
+            return 'reflink'
+    files = list()
+    for dirpath, dirnames, filenames in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(dirpath, source))
+        for name in dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                filenames.append(name)
+            else:
+                mkdir(os.path.join(target, name))
+                shutil.copystat(path, os.path.join(target, name))
+        for name in filenames:
+            files.append((os.path.join(dirpath, name),
+                          os.path.join(target, name)))
+    parallel(_link_file if link else _copy_file, files, workers)
+    shutil.copystat(source, destination)
+    return 'link' if link else 'copy'
+
+def _copy_file(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), destination)
+    else:
+        shutil.copy2(source, destination)
+
+def _link_file(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError, e:
+        # Across filesystems, or not supported: copy instead.
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        _copy_file(source, destination)
+
+def parallel(function, jobs, workers=COPY_WORKERS):
+    """Call function(*args) for every args tuple in jobs from a pool of
+    threads. Raises the first error encountered, after the running calls
+    finish.
+
+    """
+    queue = Queue.Queue()
+    for args in jobs:
+        queue.put(args)
+    errors = list()
+
+    def worker():
+        while not errors:
+            try:
+                args = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                function(*args)
+            except Exception, e:
+                log.exception('%s%r failed.' % (function.__name__, args))
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max(1, int(workers)), queue.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def move(source, destination):
+    """Move a file or directory (mv).
+
+    """
+    profile.count('operations')
+    shutil.move(source, destination)
+
+def symlink(target, path):
+    """Create a symlink at path pointing to target (ln -s).
+
+    """
+    profile.count('operations')
+    os.symlink(target, path)
+
+def read(path):
+    """Return the contents of a file (cat).
+
+    """
+    profile.count('operations')
+    with open(path, 'r') as f:
+        return f.read()
+
+def write(path, contents):
+    """Write contents to a file atomically: readers see either the old or
+    the new file, never a partial one.
+
+    """
+    profile.count('operations')
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0666 & ~_UMASK)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+def append(source, destination):
+    """Append the contents of source to destination (cat source >> dest).
+
+    """
+    profile.count('operations')
+    with open(source, 'rb') as src:
+        with open(destination, 'ab') as dest:
+            shutil.copyfileobj(src, dest, 1048576)
+
+def chmod(path, mode):
+    """Set the permission bits of a path.
+    mode: integer mode (e.g. 0440).
+
+    """
+    profile.count('operations')
+    os.chmod(path, mode)
+
+def chown(path, user=None, group=None):
+    """Set the owner and/or group of a path (does not follow symlinks).
+    user: user name or uid. None leaves the owner unchanged.
+    group: group name or gid. None leaves the group unchanged.
+
+    """
+    profile.count('operations')
+    os.lchown(path, get_uid(user), get_gid(group))
+
+def _get_umask():
+    # os.umask can only be read by setting it, which briefly affects every
+    # thread: only call this before any are started.
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Umask of the process, read once at import.
+_UMASK = _get_umask()
+
+def get_uid(user):
+    """Return the uid of a user name (-1 for None)."""
+    if user is None:
+        return -1
+    if isinstance(user, (int, long)):
+        return user
+    return pwd.getpwnam(user).pw_uid
+
+def get_gid(group):
+    """Return the gid of a group name (-1 for None)."""
+    if group is None:
+        return -1
+    if isinstance(group, (int, long)):
+        return group
+    return grp.getgrnam(group).gr_gid
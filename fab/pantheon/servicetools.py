@@ -0,0 +1,267 @@
+import contextlib
+import fcntl
+import httplib
+import json
+import os
+import socket
+import time
+
+from fabric.api import settings
+
+import logger
+import runner
+
+# Restart requests waiting to be applied, shared by every job on the server.
+SERVICE_STATE = '/var/lib/pantheon/services.json'
+# Seconds the first request waits for other jobs to join it.
+RESTART_WINDOW = 5
+# Seconds after which a batch still being applied is taken as failed (the
+# job applying it died).
+APPLY_TIMEOUT = 900
+# Actions from least to most disruptive. Requests for the same service are
+# merged into the most disruptive one.
+ACTIONS = ('reload', 'restart')
+# Services to act on after building a project: apache for its vhosts,
+# tomcat for its solr contexts, and varnish so a VCL regenerated by bcfg2
+# takes effect (a reload keeps the cache). Not restarted any more:
+# memcached, as the project's bins and varnish objects are flushed on their
+# own (see project.BuildTools.flush_caches) instead of emptying every site's
+# cache, and mysql, as databases and grants are created over SQL and take
+# effect at once.
+PROJECT_SERVICES = {'apache': 'reload',
+                    'tomcat': 'restart',
+                    'varnish': 'reload'}
+# Runs varnish management commands (ban expressions).
+VARNISHADM = 'varnishadm -T 127.0.0.1:6082'
+# 'purge' on varnish 2.x, 'ban' from 3.0.
+VARNISH_BAN = 'purge'
+# Where varnish takes HTTP BAN requests when varnishadm is unavailable. The
+# VCL is expected to turn a BAN into a ban of the request's Host.
+VARNISH_HTTP = ('127.0.0.1', 80)
+
+# distro -> service -> action -> commands. A service without a command for
+# the requested action gets the next more disruptive one.
+COMMANDS = {
+    'ubuntu': {
+        'apache': {'reload': ['apache2ctl -k graceful'],
+                   'restart': ['/etc/init.d/apache2 restart']},
+        'memcached': {'restart': ['/etc/init.d/memcached restart']},
+        'tomcat': {'restart': ['/bin/bash -x /etc/init.d/tomcat6 stop',
+                               '/bin/bash -x /etc/init.d/tomcat6 start']},
+        # reload loads the VCL again and keeps the cache.
+        'varnish': {'reload': ['/etc/init.d/varnish reload'],
+                    'restart': ['/etc/init.d/varnish restart']},
+        'mysql': {'reload': ['/etc/init.d/mysql reload'],
+                  'restart': ['/etc/init.d/mysql restart']}},
+    'centos': {
+        'apache': {'reload': ['apachectl -k graceful'],
+                   'restart': ['/etc/init.d/httpd restart']},
+        'memcached': {'restart': ['/etc/init.d/memcached restart']},
+        'tomcat': {'restart': ['/etc/init.d/tomcat5 restart']},
+        'varnish': {'reload': ['/etc/init.d/varnish reload'],
+                    'restart': ['/etc/init.d/varnish restart']},
+        'mysql': {'reload': ['/etc/init.d/mysqld reload'],
+                  'restart': ['/etc/init.d/mysqld restart']}}}
+# Order services are acted on, and whether their failures are ignored.
+SERVICES = ('apache', 'memcached', 'tomcat', 'varnish', 'mysql')
+WARN_ONLY = set(['tomcat'])
+
+log = logger.logging.getLogger('pantheon.servicetools')
+
+def request(services):
+    """Queue service reloads/restarts without applying them.
+    services: dict of service name -> action ('reload' or 'restart').
+    Returns the generation (batch number) the requests joined.
+
+    """
+    for service, action in services.iteritems():
+        if service not in SERVICES:
+            raise ValueError('Unknown service: %s' % service)
+        if action not in ACTIONS:
+            raise ValueError('Unknown action for %s: %s' % (service, action))
+    with _state() as state:
+        pending = state.setdefault('services', dict())
+        for service, action in services.iteritems():
+            pending[service] = _merge(pending.get(service), action)
+        if 'due' not in state:
+            state['due'] = time.time() + RESTART_WINDOW
+        generation = state.setdefault('generation', 1)
+    log.debug('Requested %s.' % ', '.join('%s %s' % (action, service)
+              for service, action in sorted(services.iteritems())))
+    return generation
+
+def flush(distro, generation=None):
+    """Wait for a batch of requests to be applied.
+    The first job to find the batch due (its window is over) applies it,
+    with every request other jobs queued meanwhile. The other jobs wait
+    until it has been applied, or raise if applying it failed. Batches are
+    applied one at a time.
+    distro: 'ubuntu' or 'centos'.
+    generation: batch to wait for, as returned by request(). Default is the
+                batch being queued now, if any.
+    Returns the dict of service -> action applied by this call (empty if
+    another job applied the batch).
+
+    """
+    while True:
+        with _state() as state:
+            now = time.time()
+            current = state.get('generation', 1)
+            if generation is None:
+                if not state.get('services'):
+                    return dict()
+                generation = current
+            applying = state.get('applying')
+            if applying and applying['started'] < now - APPLY_TIMEOUT:
+                log.warning('Batch %d was never completed.' %
+                            applying['generation'])
+                _record(state, applying['generation'], False)
+                applying = None
+            if generation in state.get('failed', list()):
+                raise IOError('Applying service requests (batch %d) failed '
+                              'in another job.' % generation)
+            if state.get('applied', 0) >= generation:
+                return dict()
+            if generation != current and (not applying or
+                                          applying['generation'] != generation):
+                raise IOError('Service requests (batch %d) were lost.' %
+                              generation)
+            if (generation == current and not applying and
+                state.get('due', now) <= now):
+                pending = state.pop('services', dict())
+                state.pop('due', None)
+                state['generation'] = current + 1
+                state['applying'] = {'generation': generation, 'started': now}
+                break
+            wait = state.get('due', now) - now
+        time.sleep(min(max(wait, 1), RESTART_WINDOW))
+    try:
+        _apply(distro, pending)
+    except:
+        log.exception('Applying service requests (batch %d) failed.' %
+                      generation)
+        with _state() as state:
+            _record(state, generation, False)
+        raise
+    with _state() as state:
+        _record(state, generation, True)
+    return pending
+
+def restart(distro, services):
+    """Request services and wait for them to be applied.
+    distro: 'ubuntu' or 'centos'.
+    services: dict of service name -> action ('reload' or 'restart').
+
+    """
+    return flush(distro, request(services))
+
+def ban(expression):
+    """Invalidate the varnish objects matching a ban expression (e.g.
+    'req.http.host ~ "^example[.]com$"'). Unlike a restart, the rest of the
+    cache is kept.
+    Returns the command output; raises IOError if varnishadm fails.
+
+    """
+    return runner.run_checked('%s "%s %s"' % (VARNISHADM, VARNISH_BAN,
+                                              expression.replace('"', '\\"')))
+
+def ban_hosts(hostnames):
+    """Invalidate the varnish objects of requests for any of the hostnames,
+    with varnishadm or, if that fails, an HTTP BAN per hostname.
+    hostnames: list of hostnames. Wildcards (*.example.com) match one
+               subdomain level (with varnishadm only).
+    Raises IOError if neither works.
+
+    """
+    try:
+        ban(_host_expression(hostnames))
+        return
+    except IOError, e:
+        log.warning('varnishadm ban failed (%s); trying HTTP BAN.' % e)
+    for hostname in hostnames:
+        conn = httplib.HTTPConnection(*VARNISH_HTTP)
+        try:
+            conn.request('BAN', '/', headers={'Host': hostname})
+            status = conn.getresponse().status
+        except (httplib.HTTPException, socket.error), e:
+            raise IOError('BAN of %s failed: %s' % (hostname, e))
+        finally:
+            conn.close()
+        if status >= 400:
+            raise IOError('BAN of %s returned %s.' % (hostname, status))
+
+def _host_expression(hostnames):
+    """Return a ban expression matching requests for any of the hostnames,
+    with or without a port.
+
+    """
+    patterns = list()
+    for hostname in hostnames:
+        pattern = ''
+        for char in hostname:
+            if char == '.':
+                pattern += '[.]'
+            elif char == '*':
+                pattern += '[^.]+'
+            elif char.isalnum() or char == '-':
+                pattern += char
+            else:
+                raise ValueError('Invalid hostname: %s' % hostname)
+        patterns.append(pattern)
+    return 'req.http.host ~ "^(%s)(:[0-9]+)?$"' % '|'.join(patterns)
+
+def _apply(distro, services):
+    commands = COMMANDS[distro]
+    for service in SERVICES:
+        if service not in services:
+            continue
+        action = services[service]
+        for candidate in ACTIONS[ACTIONS.index(action):]:
+            if candidate in commands[service]:
+                action = candidate
+                break
+        log.info('Running %s of %s.' % (action, service))
+        with settings(warn_only=service in WARN_ONLY):
+            for command in commands[service][action]:
+                runner.run(command, capture=service not in WARN_ONLY)
+
+def _record(state, generation, applied):
+    """Record the outcome of a batch in the state.
+
+    """
+    if state.get('applying', dict()).get('generation') == generation:
+        del state['applying']
+    if applied:
+        state['applied'] = max(state.get('applied', 0), generation)
+    else:
+        # Only the latest failures are kept for waiting jobs to find.
+        state['failed'] = (state.get('failed', list()) + [generation])[-20:]
+
+def _merge(current, action):
+    if current is None:
+        return action
+    return max(current, action, key=ACTIONS.index)
+
+@contextlib.contextmanager
+def _state():
+    """Lock the request state file and yield its contents as a dict, which
+    is written back on exit.
+
+    """
+    runner.mkdir(os.path.dirname(SERVICE_STATE))
+    with open('%s.lock' % SERVICE_STATE, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            state = dict()
+            if os.path.isfile(SERVICE_STATE):
+                try:
+                    with open(SERVICE_STATE, 'r') as f:
+                        state = json.load(f)
+                except ValueError:
+                    log.warning('Ignoring unreadable %s.' % SERVICE_STATE)
+            yield state
+            with open('%s.tmp' % SERVICE_STATE, 'w') as f:
+                json.dump(state, f)
+            os.rename('%s.tmp' % SERVICE_STATE, SERVICE_STATE)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
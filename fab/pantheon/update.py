@@ -1,9 +1,9 @@
 import httplib
 import json
 import os
-import tempfile
 
 import dbtools
+import filesync
 import pantheon
 import project
 import postback
@@ -112,7 +112,8 @@ class Updater(project.BuildTools):
         else:
             self.log.info('Code update successful.')
         self.log.info('Gracefully restarting apache.')
-        local("apache2ctl -k graceful", capture=False)
+        self.server.restart_services({'apache': 'reload'})
+        self.invalidate_cache()
 
     def code_commit(self, message):
         try:
@@ -129,33 +130,48 @@ class Updater(project.BuildTools):
         else:
             self.log.info('Code commit successful.')
 
-    def data_update(self, source_env):
+    def data_update(self, source_env, consistent=True):
+        """Replace the database with a copy of source_env's.
+        consistent: bool. Copy every table as of the same instant, through
+                    a single mysqldump stream. Otherwise tables are copied
+                    in parallel, server side: faster, but each table is
+                    copied at a different instant, so rows written to source
+                    meanwhile can leave the tables out of step.
+
+        """
         self.log.info('Initialized data sync')
         try:
-            tempdir = tempfile.mkdtemp()
-            export = dbtools.export_data(self, source_env, tempdir)
-            dbtools.import_data(self, self.update_env, export)
-            local('rm -rf %s' % tempdir)
+            dbtools.clone_data(self, source_env, self.update_env, consistent)
         except:
             self.log.exception('Data sync encountered a fatal error.')
             raise
         else:
             self.log.info('Data sync successful.')
+            self.invalidate_cache()
+
+    def files_update(self, source_env, full=False):
+        """Make the files directory an exact copy of source_env's.
+        full: list every directory, to pick up files rewritten in place
+              before the periodic full scan does (see filesync.scan).
 
-    def files_update(self, source_env):
+        """
         self.log.info('Initialized file sync')
         try:
-            self.log.info('Attempting Rsync...')
             source = os.path.join(self.project_path,
                                   '%s/sites/default/files' % source_env)
             dest = os.path.join(self.project_path,
-                                '%s/sites/default/' % self.update_env)
-            local('rsync -av --delete %s %s' % (source, dest))
+                                '%s/sites/default/files' % self.update_env)
+            filesync.sync(source, dest,
+                          filesync.get_state_path(self.project, source_env),
+                          filesync.get_state_path(self.project,
+                                                  self.update_env),
+                          full=full)
         except:
             self.log.exception('File sync encountered a fatal error.')
             raise
         else:
             self.log.info('File sync successful.')
+            self.invalidate_cache()
 
     def drupal_updatedb(self):
         self.log.info('Initiated Updatedb.')
@@ -194,18 +210,29 @@ class Updater(project.BuildTools):
             pantheon.log_drush_backend(result, self.log)
 
     def restart_varnish(self):
-        self.log.info('Restarting varnish.')
+        """Reload the varnish configuration. The cache is kept, unlike with
+        a restart.
+
+        """
+        self.log.info('Reloading varnish.')
         try:
-            with settings(warn_only=True):
-                local("/etc/init.d/varnish restart")
+            self.server.restart_services({'varnish': 'reload'})
         except:
-            self.log.exception('Encountered an error during restart.')
+            self.log.exception('Encountered an error during reload.')
             raise
 
-    def permissions_update(self):
+    def invalidate_cache(self, environments=None):
+        """Ban the varnish objects of the environment being updated (see
+        BuildTools.invalidate_cache).
+
+        """
+        return super(Updater, self).invalidate_cache(environments or
+                                                     [self.update_env])
+
+    def permissions_update(self, full=False):
         self.log.info('Initialized permissions update.')
         try:
-            self.setup_permissions('update', self.update_env)
+            self.setup_permissions('update', self.update_env, full)
         except Exception as e:
             self.log.exception('Permissions update encountered a fatal error.')
             raise
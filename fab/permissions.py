@@ -1,11 +1,13 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
 import os
+import stat
 import string
 import tempfile
 
 from fabric.api import *
 from pantheon import pantheon
 from pantheon import logger
+from pantheon import permtools
 from pantheon import ygg
 
 #TODO: Move logging into pantheon libraries for better coverage.
@@ -74,17 +76,14 @@ def configure_permissions(base_domain = "example.com",
         # Write the group to a file for later reference.
         server.set_ldap_group(require_group)
 
-        # Make the git repo and www directories writable by the group
-        local("chown -R %s:%s /var/git/projects" % (require_group, require_group))
-        local("chmod -R g+w /var/git/projects")
-
-        # Make the git repo and www directories writable by the group
-        local("chown -R %s:%s /var/www" % (require_group, require_group))
-        local("chmod -R g+w /var/www")
-
-        # Set ACLs
-        set_acl_groupwritability(require_group, '/var/www')
-        set_acl_groupwritability(require_group, '/var/git/projects')
+        # Make the git repo and www directories owned and writable by the
+        # group, with ACLs keeping new entries group writable.
+        writable = permtools.Permissions(add_mode=stat.S_IWGRP,
+                                         owner=require_group,
+                                         group=require_group,
+                                         acl_group=require_group)
+        permtools.fix_tree('/var/git/projects', writable)
+        permtools.fix_tree('/var/www', writable)
     except:
         log.exception('Permission configuration unsuccessful.')
         raise
@@ -97,9 +96,6 @@ def _ldap_domain_to_ldap(domain):
 
 def set_acl_groupwritability(require_group, directory):
     """Set up ACLs for a directory."""
-    local('setfacl --recursive --remove-all %s' % directory)
-    local('setfacl --recursive --no-mask --modify mask:rwx %s' % directory)
-    local('setfacl --recursive --no-mask --modify group:%s:rwx %s' % (require_group, directory))
-    local('setfacl --recursive --modify default:mask:rwx %s' % directory)
-    local('setfacl --recursive --modify default:group:%s:rwx %s' % (require_group, directory))
+    permtools.fix_tree(directory,
+                       permtools.Permissions(acl_group=require_group))
 
@@ -1,21 +1,60 @@
 from pantheon import backup
 from pantheon import logger
 
-def backup_site(archive_name, project='pantheon'):
+def backup_site(archive_name, project='pantheon', stream=False, resume=False,
+                codec=None, level=None, incremental=False, dedup=False,
+                split_tables=False):
+    """Backup all environments, data and the repo of a project.
+    archive_name: name of the backup (resulting file: archive_name.tar.gz, or
+                  the extension of the codec used)
+    project: name of the project to backup.
+    stream: bool. Stream the backup straight to remote storage instead of
+            staging a full copy (and tarball) on disk first.
+    resume: bool. Resume the upload of an archive left by an earlier run that
+            failed, instead of building a new one.
+    codec: archive compression. gzip (multi-threaded when pigz is
+           installed), zstd, or none for already-compressed content.
+    level: compression level. Default depends on the codec.
+    incremental: bool. Only archive files and tables changed since the last
+                 incremental backup (see backup.PantheonBackup). Always
+                 staged on disk, so it cannot be combined with stream.
+    dedup: bool. Store files shared by the environments and the repo once.
+           Staged on disk and always a full backup.
+    split_tables: bool. Dump each database table to its own file, so they can
+                  be restored in parallel.
+
+    """
     log = logger.logging.getLogger('pantheon.site_backup')
-    archive = backup.PantheonBackup(archive_name, project)
+    stream = str(stream).lower() in ('1', 'true', 'yes')
+    resume = str(resume).lower() in ('1', 'true', 'yes')
+    incremental = str(incremental).lower() in ('1', 'true', 'yes')
+    dedup = str(dedup).lower() in ('1', 'true', 'yes')
+    split_tables = str(split_tables).lower() in ('1', 'true', 'yes')
+    if (incremental or dedup) and stream:
+        log.warning('Incremental and deduplicated backups are not streamed.')
+        stream = False
+    if incremental and dedup:
+        log.warning('Deduplicated backups are always full.')
+    archive = backup.PantheonBackup(archive_name, project, resume, codec, level,
+                                    incremental, dedup)
+    if archive.is_resumable():
+        log.info('Resuming upload of an existing archive.')
+        archive.finalize()
+        return
     log.info('Calculating necessary disk space.')
-    if archive.free_space():
+    if archive.free_space(stream):
         log.info('Sufficient disk space found.')
-        archive.backup_files()
-        archive.backup_data()
-        archive.backup_repo()
-        archive.backup_config(version=0)
-        archive.finalize()
+        if stream:
+            archive.stream_backup(version=0)
+        else:
+            archive.backup_files()
+            archive.backup_data(split_tables)
+            archive.backup_repo()
+            archive.backup_config(version=0)
+            archive.finalize()
     else:
         log.error('Insufficient disk space to perform archive.')
         raise IOError('Insufficient disk space to perform archive.')
 
 def remove_backup(archive):
     backup.remove(archive)
-
@@ -1,6 +1,9 @@
 from pantheon import install
 from pantheon import status
 from pantheon import logger
+from pantheon import postback
+from pantheon import runner
+from pantheon import servicetools
 
 def install_site(project='pantheon', version=6, profile='pantheon'):
     """ Create a new Pantheon Drupal installation.
@@ -26,55 +29,80 @@ def _installer(**kw):
     log = logger.logging.getLogger('pantheon.install.site')
     log = logger.logging.LoggerAdapter(log, kw)
     log.info('Site installation of project %s initiated.' % kw.get('project'))
+    runner.reset()
     try:
-        installer = install.InstallTools(**kw)
-
+        with runner.step('initialize'):
+            installer = install.InstallTools(**kw)
+
+        def setup_project():
+            if kw['profile'] == 'pantheon':
+                installer.setup_project_repo()
+                installer.setup_project_branch()
+                installer.setup_working_dir()
+            elif kw['profile'] == 'makefile':
+                installer.process_makefile(kw['url'])
+            elif kw['profile'] == 'gitsource':
+                installer.process_gitsource(kw['url'])
+
+        def send_status():
+            status.git_repo_status(installer.project)
+            status.drupal_update_status(installer.project)
+
+        # Steps that use the shell from a working directory are serial. The
+        # databases, non-code site features and environment clones run
+        # alongside them.
+        pipeline = runner.Pipeline()
         # Remove existing project.
-        installer.remove_project()
-
+        pipeline.add('remove_project', installer.remove_project)
         # Create a new project
-        if kw['profile'] == 'pantheon':
-            installer.setup_project_repo()
-            installer.setup_project_branch()
-            installer.setup_working_dir()
-        elif kw['profile'] == 'makefile':
-            installer.process_makefile(kw['url'])
-        elif kw['profile'] == 'gitsource':
-            installer.process_gitsource(kw['url'])
-
+        pipeline.add('setup_project', setup_project,
+                     ['remove_project'], serial=True)
         # Run bcfg2 project bundle.
-        installer.bcfg2_project()
-
+        pipeline.add('bcfg2_project', installer.bcfg2_project,
+                     ['setup_project'], serial=True)
         # Setup project
-        installer.setup_database()
-        installer.setup_files_dir()
-        installer.setup_settings_file()
-
+        pipeline.add('setup_database', installer.setup_database,
+                     ['remove_project'])
+        pipeline.add('setup_files_dir', installer.setup_files_dir,
+                     ['setup_project'])
+        pipeline.add('setup_settings_file', installer.setup_settings_file,
+                     ['bcfg2_project', 'setup_files_dir'], serial=True)
         # Push changes from working directory to central repo
-        installer.push_to_repo()
-
+        pipeline.add('push_to_repo', installer.push_to_repo,
+                     ['setup_settings_file'], serial=True)
         # Build non-code site features.
-        installer.setup_solr_index()
-        installer.setup_drupal_cron()
-        installer.setup_drush_alias()
-
+        pipeline.add('setup_solr_index', installer.setup_solr_index,
+                     ['setup_project'])
+        pipeline.add('setup_drupal_cron', installer.setup_drupal_cron,
+                     ['remove_project'])
+        pipeline.add('setup_drush_alias', installer.setup_drush_alias,
+                     ['remove_project'])
         # Clone project to all environments
-        installer.setup_environments()
-
+        pipeline.add('setup_environments', installer.setup_environments,
+                     ['push_to_repo'])
         # Cleanup and restart services
-        installer.cleanup()
-        installer.server.restart_services()
-
+        pipeline.add('cleanup', installer.cleanup, ['setup_environments'])
+        pipeline.add('restart_services',
+                     lambda: installer.server.restart_services(
+                         servicetools.PROJECT_SERVICES),
+                     ['setup_database', 'setup_solr_index',
+                      'setup_drupal_cron', 'setup_drush_alias',
+                      'setup_environments'], serial=True)
+        pipeline.add('flush_caches', installer.flush_caches,
+                     ['restart_services'])
         # Send back repo status.
-        status.git_repo_status(installer.project)
-        status.drupal_update_status(installer.project)
-
+        pipeline.add('status', send_status, ['restart_services'], serial=True)
         # Set permissions on project
-        installer.setup_permissions()
+        pipeline.add('setup_permissions', installer.setup_permissions,
+                     ['setup_database', 'setup_environments'], serial=True)
+        pipeline.run()
 
     except:
         log.exception('Site installation was unsuccessful')
         raise
     else:
         log.info('Site installation successful')
+    finally:
+        runner.log_summary(log)
+        postback.write_build_data('step_timings', runner.profile.timings())
 
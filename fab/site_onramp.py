@@ -1,13 +1,19 @@
 from pantheon import onramp
 from pantheon import pantheon
+from pantheon import postback
 from pantheon import restore
 from pantheon import status
 from pantheon import logger
+from pantheon import runner
+from pantheon import servicetools
 
-def onramp_site(project='pantheon', url=None, profile=None, **kw):
+def onramp_site(project='pantheon', url=None, profile=None, increments=None,
+                **kw):
     """Create a new Drupal installation.
     project: Installation namespace.
     profile: The installation type (e.g. pantheon/openatrium)
+    increments: Comma separated urls of incremental backups to apply on top
+                of the backup at url (restore only), oldest first.
     **kw: Optional dictionary of values to process on installation.
 
     """
@@ -15,18 +21,31 @@ def onramp_site(project='pantheon', url=None, profile=None, **kw):
     log = logger.logging.getLogger('pantheon.onramp.site')
     log = logger.logging.LoggerAdapter(log,
                                        {"project": project})
-    archive = onramp.download(url)
-    location = onramp.extract(archive)
-    handler = _get_handler(profile, project, location)
+    runner.reset()
+    with runner.step('download'):
+        archive = onramp.download(url)
+        location = onramp.extract(archive)
+        handler = _get_handler(profile, project, location)
+        if increments and not isinstance(handler, _RestoreProfile):
+            raise ValueError('Increments can only be applied to a restore.')
+        if increments:
+            increments = [onramp.extract(onramp.download(increment))
+                          for increment in increments.split(',')]
 
     log.info('Initiated site build.')
     try:
-        handler.build(location)
+        if increments:
+            handler.build(location, increments)
+        else:
+            handler.build(location)
     except:
         log.exception('Site build encountered an exception.')
         raise
     else:
         log.info('Site build was successful.')
+    finally:
+        runner.log_summary(log)
+        postback.write_build_data('step_timings', runner.profile.timings())
 
 def _get_handler(profile, project, location):
     """Return instantiated profile object.
@@ -56,76 +75,116 @@ class _ImportProfile(onramp.ImportTools):
     def build(self, location):
 
         self.build_location = location
-        # Parse the extracted archive.
-        self.parse_archive(location)
 
-        # Remove existing project.
-        self.remove_project()
+        def send_status():
+            status.git_repo_status(self.project)
+            status.drupal_update_status(self.project)
 
+        # Steps that use the shell from a working directory are serial. The
+        # database import, non-code site features and environment clones run
+        # alongside them.
+        pipeline = runner.Pipeline()
+        # Parse the extracted archive.
+        pipeline.add('parse_archive', lambda: self.parse_archive(location),
+                     serial=True)
+        # Remove existing project.
+        pipeline.add('remove_project', self.remove_project, ['parse_archive'])
         # Create a new project
-        self.setup_project_repo()
-        self.setup_project_branch()
-
+        pipeline.add('setup_project_repo', self.setup_project_repo,
+                     ['remove_project'], serial=True)
+        pipeline.add('setup_project_branch', self.setup_project_branch,
+                     ['setup_project_repo'], serial=True)
         # Run bcfg2 project bundle.
-        self.bcfg2_project()
-
-         # Import existing site into the project.
-        self.setup_database()
-        self.import_site_files()
-        self.setup_files_dir()
-        self.setup_settings_file()
-
+        pipeline.add('bcfg2_project', self.bcfg2_project,
+                     ['setup_project_branch'], serial=True)
+        # Import existing site into the project.
+        pipeline.add('setup_database', self.setup_database, ['remove_project'])
+        pipeline.add('import_site_files', self.import_site_files,
+                     ['setup_project_branch'], serial=True)
+        pipeline.add('setup_files_dir', self.setup_files_dir,
+                     ['import_site_files', 'setup_database'], serial=True)
+        pipeline.add('setup_settings_file', self.setup_settings_file,
+                     ['bcfg2_project', 'setup_files_dir'], serial=True)
         # Push imported project from working directory to central repo
-        self.push_to_repo()
-
+        pipeline.add('push_to_repo', self.push_to_repo,
+                     ['setup_settings_file'], serial=True)
         # Build non-code site features
-        self.setup_solr_index()
-        self.setup_drupal_cron()
-        self.setup_drush_alias()
-
+        pipeline.add('setup_solr_index', self.setup_solr_index,
+                     ['remove_project'])
+        pipeline.add('setup_drupal_cron', self.setup_drupal_cron,
+                     ['remove_project'])
+        pipeline.add('setup_drush_alias', self.setup_drush_alias,
+                     ['remove_project'])
         # Turn on modules, set variables
-        self.enable_pantheon_settings()
-
+        pipeline.add('enable_pantheon_settings', self.enable_pantheon_settings,
+                     ['setup_drush_alias', 'setup_settings_file'], serial=True)
         # Clone project to all environments
-        self.setup_environments()
-
+        pipeline.add('setup_environments', self.setup_environments,
+                     ['push_to_repo', 'enable_pantheon_settings'])
         # Set permissions on project.
-        self.setup_permissions()
-
+        pipeline.add('setup_permissions', self.setup_permissions,
+                     ['setup_environments'], serial=True)
         # Cleanup and restart services.
-        self.cleanup()
-        self.server.restart_services()
-
+        pipeline.add('cleanup', self.cleanup, ['setup_environments'])
+        pipeline.add('restart_services',
+                     lambda: self.server.restart_services(
+                         servicetools.PROJECT_SERVICES),
+                     ['setup_solr_index', 'setup_drupal_cron',
+                      'setup_permissions'], serial=True)
+        pipeline.add('flush_caches', self.flush_caches, ['restart_services'])
         # Send version and repo status.
-        status.git_repo_status(self.project)
-        status.drupal_update_status(self.project)
+        pipeline.add('status', send_status, ['restart_services'], serial=True)
+        pipeline.run()
 
 
 class _RestoreProfile(restore.RestoreTools):
     """Generic Pantheon Restore Profile.
 
     """
-    def build(self, location):
+    def build(self, location, increments=None):
 
+        def send_status():
+            status.git_repo_status(self.project)
+            status.drupal_update_status(self.project)
+
+        pipeline = runner.Pipeline()
         # Parse the backup.
-        self.parse_backup(location)
+        pipeline.add('parse_backup', lambda: self.parse_backup(location),
+                     serial=True)
+        parsed = ['parse_backup']
+        if increments:
+            pipeline.add('apply_increments',
+                         lambda: self.apply_increments(increments),
+                         parsed, serial=True)
+            parsed = ['apply_increments']
 
         # Run bcfg2 project bundle.
-        self.bcfg2_project()
+        pipeline.add('bcfg2_project', self.bcfg2_project, parsed, serial=True)
 
-        self.setup_database()
-        self.restore_site_files()
-        self.restore_repository()
+        # Databases are imported alongside the serial steps; the dumps are
+        # removed before the code is copied.
+        pipeline.add('setup_database', self.setup_database, parsed)
+        pipeline.add('restore_site_files', self.restore_site_files,
+                     ['bcfg2_project', 'setup_database'], serial=True)
+        pipeline.add('restore_repository', self.restore_repository,
+                     ['bcfg2_project'], serial=True)
 
         # Build non-code site features
-        self.setup_solr_index()
-        self.setup_drupal_cron()
-        self.setup_drush_alias()
-
-        self.setup_permissions()
-        self.server.restart_services()
-
+        pipeline.add('setup_solr_index', self.setup_solr_index,
+                     ['bcfg2_project'])
+        pipeline.add('setup_drupal_cron', self.setup_drupal_cron, parsed)
+        pipeline.add('setup_drush_alias', self.setup_drush_alias, parsed)
+
+        pipeline.add('setup_permissions', self.setup_permissions,
+                     ['restore_site_files', 'restore_repository'],
+                     serial=True)
+        pipeline.add('restart_services',
+                     lambda: self.server.restart_services(
+                         servicetools.PROJECT_SERVICES),
+                     ['setup_permissions', 'setup_solr_index',
+                      'setup_drupal_cron', 'setup_drush_alias'], serial=True)
+
+        pipeline.add('flush_caches', self.flush_caches, ['restart_services'])
         # Send version and repo status.
-        status.git_repo_status(self.project)
-        status.drupal_update_status(self.project)
-
+        pipeline.add('status', send_status, ['restart_services'], serial=True)
+        pipeline.run()
@@ -31,7 +31,8 @@ def main():
     parser.add_option('-c', '--cron', dest="cron", action="store_true",
                       default=False, help='Run cron on an environment.')
     parser.add_option('-v', '--varnish', dest="varnish", action="store_true",
-                      default=False, help='Restart varnish.')
+                      default=False,
+                      help='Invalidate the varnish cache of an environment.')
     (options, args) = parser.parse_args()
     log = logger.logging.getLogger('pantheon.update')
 
@@ -53,8 +54,8 @@ def main():
                 log.info('Running cron on {0}.'.format(env))
                 site.run_cron()
             if options.varnish:
-                log.info('Restarting varnish.')
-                site.restart_varnish()
+                log.info('Invalidating varnish cache of {0}.'.format(env))
+                site.invalidate_cache()
         log.info('Update complete.', extra=dict({"job_complete": 1}))
 
 def update_pantheon(postback=True):
@@ -202,12 +203,17 @@ def rebuild_environment(project, environment):
     updater.files_update('live')
     updater.data_update('live')
 
-def update_data(project, environment, source_env, updatedb='True', taskid=None):
+def update_data(project, environment, source_env, updatedb='True', taskid=None,
+                consistent='True'):
     """Update the data in project/environment using data from source_env.
+    consistent: copy all tables from one snapshot (default). 'False' copies
+                them in parallel, faster but not as of the same instant (see
+                Updater.data_update).
 
     """
     updater = update.Updater(environment)
-    updater.data_update(source_env)
+    updater.data_update(source_env,
+                        str(consistent).lower() in ('1', 'true', 'yes'))
 
 def update_files(project, environment, source_env, taskid=None):
     """Update the files in project/environment using files from source_env.